@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Local stand-ins of the Copernicus and EarthExplorer APIs
+
+A single HTTP server answers the requests done by download_sentinel and
+download_landsat, with the same URLs under the root of the server:
+
+/apihub/search?                                 Copernicus OpenSearch (JSON feed)
+/apihub/odata/v1/Products('<uuid>')/Checksum/Value/$value
+/apihub/download/<uuid>                         Sentinel archive
+/inventory/json/v/1.4.1/login?                  EarthExplorer API key
+/inventory/json/v/1.4.1/search                  EarthExplorer JSON search
+/ers/login/                                     ERS login form and cookie
+/download/<entityId>                            Landsat archive
+
+The archives are served in chunks with Range support and an optional
+bandwidth limit per connection. Example:
+
+    server = mock_server(sentinel_products, landsat_products, rate=50e6)
+    server.start()
+    s = download_sentinel(...)
+    s.api_url = server.url + '/apihub/'
+    ...
+    server.stop()
+"""
+
+#APIs
+import os
+import re
+import json
+import time
+import threading
+
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LANDSAT_API = '/inventory/json/v/1.4.1/'
+
+LOGIN_PAGE = '''<html><body><form method="post">
+<input type="hidden" name="csrf_token" value="{csrf}">
+<input type="hidden" name="__ncforminfo" value="{form}">
+</form></body></html>'''
+
+
+class handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, content_type='text/plain', status=200):
+
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_archive(self, path, content_type):
+        """
+        Stream a file honouring the Range header, limited to server.rate bytes/s
+        """
+
+        size = os.path.getsize(path)
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_text('', status=416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        chunk_size = 256 * 1024
+        rate = self.server.rate
+        t0 = time.time()
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if rate:
+                    delay = sent / rate - (time.time() - t0)
+                    if delay > 0:
+                        time.sleep(delay)
+        self.server.count('bytes_served', size - start)
+
+    def read_body(self):
+
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8') if length else ''
+
+    def do_GET(self):
+
+        url = urlparse(self.path)
+        path = unquote(url.path)
+
+        match = re.match(r"^/apihub/odata/v1/Products\('(.+?)'\)/Checksum/Value/\$value$", path)
+        if match and match.group(1) in self.server.sentinel:
+            self.send_text(self.server.sentinel[match.group(1)]['md5'].upper())
+            return
+
+        match = re.match(r'^/apihub/download/(.+)$', path)
+        if match and match.group(1) in self.server.sentinel:
+            self.server.count('downloads')
+            self.send_archive(self.server.sentinel[match.group(1)]['path'], 'application/zip')
+            return
+
+        if path == '/ers/login/':
+            self.send_text(LOGIN_PAGE.format(csrf='bench-csrf', form='bench-form'), content_type='text/html')
+            return
+
+        match = re.match(r'^/download/(.+)$', path)
+        if match and match.group(1) in self.server.landsat:
+            # without the ERS cookie EarthExplorer answers with the login page
+            if 'EROSSSO=' not in self.headers.get('Cookie', ''):
+                self.send_text(LOGIN_PAGE.format(csrf='bench-csrf', form='bench-form'), content_type='text/html')
+                return
+            self.server.count('downloads')
+            self.send_archive(self.server.landsat[match.group(1)]['path'], 'application/x-gzip')
+            return
+
+        self.send_text('Not found', status=404)
+
+    def do_POST(self):
+
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        body = self.read_body()
+
+        if path == '/apihub/search':
+            self.server.count('searches')
+            form = parse_qs(body)
+            start, rows = int(form.get('start', ['0'])[0]), int(form.get('rows', ['100'])[0])
+            self.send_json(self.server.sentinel_feed(start, rows))
+            return
+
+        if path == LANDSAT_API + 'login':
+            self.send_json({'error': '', 'errorCode': None, 'data': 'bench-api-key'})
+            return
+
+        if path == LANDSAT_API + 'search':
+            self.server.count('searches')
+            request = json.loads(parse_qs(url.query)['jsonRequest'][0])
+            self.send_json(self.server.landsat_page(int(request['startingNumber']), int(request['maxResults'])))
+            return
+
+        if path == '/ers/login/':
+            self.send_response(302)
+            self.send_header('Location', '/')
+            self.send_header('Set-Cookie', 'EROSSSO=bench-cookie; Path=/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_text('Not found', status=404)
+
+
+class mock_server(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, sentinel_products=(), landsat_products=(), rate=None, host='127.0.0.1', port=0):
+        """
+        Parameters
+        ----------
+        sentinel_products : list
+            Products of synthetic.sentinel_product
+        landsat_products : list
+            Scenes of synthetic.landsat_product
+        rate : float
+            Bandwidth limit of every download in bytes/s, None for no limit
+        port : int
+            0 picks a free port
+        """
+
+        ThreadingHTTPServer.__init__(self, (host, port), handler)
+        self.sentinel = {p['uuid']: p for p in sentinel_products}
+        self.sentinel_order = [p['uuid'] for p in sentinel_products]
+        self.landsat = {p['entityId']: p for p in landsat_products}
+        self.landsat_order = [p['entityId'] for p in landsat_products]
+        self.rate = rate
+        self.counters = {'searches': 0, 'downloads': 0, 'bytes_served': 0}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counters[key] += n
+
+    def sentinel_feed(self, start, rows):
+
+        entries = []
+        for uuid in self.sentinel_order[start:start + rows]:
+            p = self.sentinel[uuid]
+            entries.append({'title': p['title'],
+                            'id': uuid,
+                            'link': [{'href': "{}/apihub/download/{}".format(self.url, uuid)}],
+                            'date': [{'name': 'beginposition', 'content': p['date'].strftime('%Y-%m-%dT%H:%M:%S.024Z')}],
+                            # the reported size is the one of a real product, the smaller ones are omitted as corners
+                            'str': [{'name': 'size', 'content': '800.00 MB'},
+                                    {'name': 'producttype', 'content': 'S2MSI1C'}]})
+            if p.get('footprint'):
+                entries[-1]['str'].append({'name': 'footprint', 'content': 'MULTIPOLYGON ((({})))'.format(
+                    ','.join('{} {}'.format(lon, lat) for lon, lat in p['footprint']))})
+        return {'feed': {'opensearch:totalResults': str(len(self.sentinel_order)), 'entry': entries}}
+
+    def landsat_page(self, start, rows):
+
+        ids = self.landsat_order[start - 1:start - 1 + rows]
+        results = [{'entityId': i, 'displayId': self.landsat[i]['displayId'],
+                    'acquisitionDate': self.landsat[i]['date'].strftime('%Y-%m-%d')} for i in ids]
+        for r in results:
+            if self.landsat[r['entityId']].get('footprint'):
+                r['spatialFootprint'] = {'type': 'Polygon', 'coordinates': [self.landsat[r['entityId']]['footprint']]}
+        return {'error': '', 'errorCode': None,
+                'data': {'results': results, 'totalHits': len(self.landsat_order), 'nextRecord': start + len(ids)}}
+
+    def start(self):
+
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
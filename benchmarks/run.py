@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Offline benchmarks of the service
+
+The benchmarks run on synthetic products (see synthetic) served by a local
+mock of the Copernicus and EarthExplorer APIs (see mock_servers), so no
+account or network access is needed. Every benchmark runs in a new process
+and reports the processed scenes per hour, the MB/s of archives and the
+peak resident memory of the process. A benchmark that crashes or does not
+finish in --timeout seconds is reported as failed.
+
+The results can be compared with those of a previous run (--json) with
+--baseline, the run fails if the scenes per hour or MB/s drop, or the peak
+memory grows, more than --max-regression.
+
+Benchmarks
+----------
+sentinel.load_bands : sentinel_utils.sentinel(...).load_bands() of extracted products
+landsat.load_bands : landsat_utils.landsat(...).load_bands() of extracted scenes
+download_sentinel : search, download, extraction and processing of the products
+download_landsat : search, ERS login, download, extraction and processing of the scenes
+
+The download benchmarks import sat_modules.utils, so sat_modules/config.py
+has to exist (a copy of config.py.example is enough). Example:
+
+    python -m benchmarks.run --scenes 4 --s2-size 1098 --l8-size 1000 --json results.json
+    python -m benchmarks.run --only landsat.load_bands --writer zarr --encoding int16
+    python -m benchmarks.run --baseline results.json --max-regression 0.1
+"""
+
+#APIs
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import tarfile
+import argparse
+import datetime
+import tempfile
+import resource
+import traceback
+import multiprocessing
+from queue import Empty
+
+from benchmarks import synthetic
+from benchmarks.mock_servers import mock_server
+
+#Metrics compared with the baseline: name, True if higher is better
+METRICS = [('scenes_per_hour', True), ('mb_per_s', True), ('peak_rss_mb', False)]
+
+#Options that do not change the results, the others have to match the baseline
+RUN_OPTIONS = {'only', 'workdir', 'keep', 'json', 'baseline', 'max_regression', 'timeout'}
+
+#Region covered by the synthetic scenes
+COORDINATES = {'W': -4.1, 'S': 42.3, 'E': -4.0, 'N': 42.4}
+
+INIDATE = datetime.datetime(2018, 12, 1)
+ENDDATE = datetime.datetime(2020, 1, 1)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def archive_bytes(products):
+    return sum(os.path.getsize(p['path']) for p in products)
+
+
+def sentinel_load_bands(products, workdir, options):
+
+    from sat_modules import sentinel_utils
+
+    rss = peak_rss_mb()
+    for p in products:
+        output_path = os.path.join(workdir, 'output', p['title'])
+        os.makedirs(output_path)
+        sentinel_utils.sentinel(p['tile_path'], output_path, encoding=options['encoding'],
+                                latlon=options['latlon'], writer=options['writer']).load_bands()
+    return {'scenes': len(products), 'bytes': archive_bytes(products), 'rss_start_mb': rss}
+
+
+def landsat_load_bands(products, workdir, options):
+
+    from sat_modules import landsat_utils
+
+    rss = peak_rss_mb()
+    for p in products:
+        output_path = os.path.join(workdir, 'output', p['entityId'])
+        os.makedirs(output_path)
+        landsat_utils.landsat(p['tile_path'], output_path, encoding=options['encoding'],
+                              blockwise=options['blockwise'], band_workers=options['band_workers'],
+                              latlon=options['latlon'], writer=options['writer']).load_bands()
+    return {'scenes': len(products), 'bytes': archive_bytes(products), 'rss_start_mb': rss}
+
+
+def download_sentinel(products, workdir, options):
+
+    from sat_modules.download_sentinel import download_sentinel
+
+    rss = peak_rss_mb()
+    s = download_sentinel(INIDATE, ENDDATE, 'bench', coordinates=COORDINATES, username='bench', password='bench',
+                          path=workdir, workers=options['workers'], use_cache=False, extract=options['extract'],
+                          encoding=options['encoding'], latlon=options['latlon'], writer=options['writer'])
+    s.api_url = options['server_url'] + '/apihub/'
+    s.download()
+    return {'scenes': s.journal.summary()['processed'], 'bytes': archive_bytes(products), 'rss_start_mb': rss}
+
+
+def download_landsat(products, workdir, options):
+
+    from sat_modules.download_landsat import download_landsat
+
+    rss = peak_rss_mb()
+    l8 = download_landsat(INIDATE, ENDDATE, 'bench', coordinates=COORDINATES, username='bench', password='bench',
+                          path=workdir, workers=options['workers'], use_cache=False, extract=options['extract'],
+                          encoding=options['encoding'], blockwise=options['blockwise'],
+                          band_workers=options['band_workers'], latlon=options['latlon'], writer=options['writer'])
+    l8.api_url = options['server_url'] + '/inventory/json/v/1.4.1/'
+    l8.login_url = options['server_url'] + '/ers/login/'
+    l8.download_url = options['server_url'] + '/download/{}'
+    l8.download()
+    return {'scenes': l8.journal.summary()['processed'], 'bytes': archive_bytes(products), 'rss_start_mb': rss}
+
+
+#name: (function, sensor, products extracted before the benchmark)
+BENCHMARKS = {'sentinel.load_bands': (sentinel_load_bands, 'sentinel', True),
+              'landsat.load_bands': (landsat_load_bands, 'landsat', True),
+              'download_sentinel': (download_sentinel, 'sentinel', False),
+              'download_landsat': (download_landsat, 'landsat', False)}
+
+
+def child(name, products, workdir, options, queue):
+    """
+    Run a benchmark in the current (new) process and put its result in the queue
+    """
+
+    try:
+        t0 = time.time()
+        result = BENCHMARKS[name][0](products, workdir, options)
+        result['seconds'] = time.time() - t0
+        result['peak_rss_mb'] = peak_rss_mb()
+    except Exception:
+        result = {'error': traceback.format_exc()}
+    queue.put(result)
+
+
+def wait_result(process, queue, timeout):
+    """
+    Result of a benchmark process, or an error if the process dies without
+    a result (eg. killed by the OOM killer) or does not finish in timeout seconds
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            pass
+        if not process.is_alive():
+            # the result may have been put just before exiting
+            try:
+                return queue.get(timeout=1)
+            except Empty:
+                return {'error': 'The benchmark process exited with code {} without a result'.format(
+                    process.exitcode)}
+        if time.time() > deadline:
+            process.terminate()
+            return {'error': 'The benchmark did not finish in {} s'.format(timeout)}
+
+
+def load_products(folder, sensor, n, size):
+    """
+    Synthetic products of a sensor, generated once and reused by the next runs
+    """
+
+    folder = os.path.join(folder, '{}_{}'.format(sensor, size))
+    index_path = os.path.join(folder, 'index.json')
+    products = []
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            products = json.load(f)
+        for p in products:
+            p['date'] = datetime.datetime.strptime(p['date'], '%Y-%m-%dT%H:%M:%S')
+        products = [p for p in products if os.path.isfile(p['path'])]
+
+    if len(products) < n:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        print('Generating {} synthetic {} products of {} pixels ...'.format(n - len(products), sensor, size))
+        for i in range(len(products), n):
+            if sensor == 'sentinel':
+                products.append(synthetic.sentinel_product(folder, index=i, size=size))
+            else:
+                products.append(synthetic.landsat_product(folder, index=i, size=size))
+        with open(index_path, 'w') as f:
+            json.dump([dict(p, date=p['date'].strftime('%Y-%m-%dT%H:%M:%S')) for p in products], f, indent=1)
+
+    return products[:n]
+
+
+def extract(products, sensor, folder):
+
+    extracted = []
+    for p in products:
+        if sensor == 'sentinel':
+            with zipfile.ZipFile(p['path']) as zf:
+                zf.extractall(folder)
+            extracted.append(dict(p, tile_path=os.path.join(folder, '{}.SAFE'.format(p['title']))))
+        else:
+            tile_path = os.path.join(folder, p['entityId'])
+            with tarfile.open(p['path']) as tar:
+                tar.extractall(tile_path)
+            extracted.append(dict(p, tile_path=tile_path))
+    return extracted
+
+
+def run(names, products, workdir, options):
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    server = mock_server(products['sentinel'], products['landsat'], rate=options['rate']).start()
+    try:
+        for name in names:
+            function, sensor, extracted = BENCHMARKS[name]
+            bench_dir = os.path.join(workdir, name)
+            shutil.rmtree(bench_dir, ignore_errors=True)
+            os.makedirs(bench_dir)
+
+            bench_products = products[sensor]
+            if extracted:
+                bench_products = extract(bench_products, sensor, os.path.join(bench_dir, 'extracted'))
+
+            print('Running {} ...'.format(name))
+            queue = context.Queue()
+            process = context.Process(target=child, args=(name, bench_products, bench_dir,
+                                                           dict(options, server_url=server.url), queue))
+            process.start()
+            result = wait_result(process, queue, options['timeout'])
+            process.join()
+
+            result['benchmark'] = name
+            if 'error' not in result:
+                result['scenes_per_hour'] = result['scenes'] / result['seconds'] * 3600
+                result['mb_per_s'] = result['bytes'] / 1e6 / result['seconds']
+            results.append(result)
+
+            if not options['keep']:
+                shutil.rmtree(bench_dir, ignore_errors=True)
+    finally:
+        server.stop()
+    return results
+
+
+def report(results):
+
+    print('{:<22}{:>8}{:>10}{:>12}{:>10}{:>14}'.format('benchmark', 'scenes', 'seconds', 'scenes/h', 'MB/s',
+                                                       'peak RSS MB'))
+    for r in results:
+        if 'error' in r:
+            print('{:<22} failed\n{}'.format(r['benchmark'], r['error']))
+            continue
+        print('{:<22}{:>8}{:>10.1f}{:>12.1f}{:>10.1f}{:>14.1f}'.format(r['benchmark'], r['scenes'], r['seconds'],
+                                                                       r['scenes_per_hour'], r['mb_per_s'],
+                                                                       r['peak_rss_mb']))
+
+
+def compare(results, baseline, max_regression):
+    """
+    Regressions of the results against a baseline (the --json file of a previous run)
+
+    Parameters
+    ----------
+    results : list
+        Results of run
+    baseline : dict
+        {'options': ..., 'results': ...} of the previous run
+    max_regression : float
+        Fraction of change of a metric tolerated (eg. 0.1 is 10%)
+
+    Returns
+    -------
+    list of str describing the regressions
+    """
+
+    previous = {r['benchmark']: r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for r in results:
+        b = previous.get(r['benchmark'])
+        if b is None or 'error' in r:
+            continue
+        for key, higher_is_better in METRICS:
+            if not b.get(key):
+                continue
+            change = (r[key] - b[key]) / b[key]
+            if (-change if higher_is_better else change) > max_regression:
+                regressions.append('{} {}: {:.1f} -> {:.1f} ({:+.1%})'.format(r['benchmark'], key, b[key], r[key],
+                                                                              change))
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the satellite service')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('--scenes', type=int, default=4, help='Number of products of every sensor')
+    parser.add_argument('--s2-size', type=int, default=1098, help='Pixels per side of the Sentinel-2 10 m bands')
+    parser.add_argument('--l8-size', type=int, default=1000, help='Pixels per side of the Landsat-8 30 m bands')
+    parser.add_argument('--rate', type=float, default=None, help='Bandwidth limit of every download in MB/s')
+    parser.add_argument('--workers', type=int, default=2, help='Parallel downloads')
+    parser.add_argument('--extract', default='all', choices=['all', 'bands', 'none'])
+    parser.add_argument('--encoding', default='legacy')
+    parser.add_argument('--writer', default='netcdf')
+    parser.add_argument('--blockwise', action='store_true')
+    parser.add_argument('--band-workers', type=int, default=1)
+    parser.add_argument('--latlon', action='store_true')
+    parser.add_argument('--workdir', default=None, help='Folder of the products and outputs (default: temporary)')
+    parser.add_argument('--keep', action='store_true', help='Keep the outputs of the benchmarks')
+    parser.add_argument('--json', default=None, help='Write the results to this file')
+    parser.add_argument('--timeout', type=float, default=3600, help='Seconds before a benchmark is stopped')
+    parser.add_argument('--baseline', default=None, help='Results (--json) of a previous run to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='Change of a metric against the baseline tolerated (default: 0.1, 10%%)')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changed = sorted(k for k, v in vars(args).items()
+                         if k not in RUN_OPTIONS and baseline['options'].get(k) != v)
+        if changed:
+            print('Warning: the options {} differ from the baseline'.format(', '.join(changed)))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sat_bench_')
+    options = {'rate': args.rate * 1e6 if args.rate else None, 'workers': args.workers, 'extract': args.extract,
+               'encoding': args.encoding, 'writer': args.writer, 'blockwise': args.blockwise,
+               'band_workers': args.band_workers, 'latlon': args.latlon, 'keep': args.keep,
+               'timeout': args.timeout}
+
+    sensors = {BENCHMARKS[name][1] for name in args.only}
+    products = {sensor: [] for sensor in ('sentinel', 'landsat')}
+    for sensor, size in (('sentinel', args.s2_size), ('landsat', args.l8_size)):
+        if sensor in sensors:
+            products[sensor] = load_products(os.path.join(workdir, 'products'), sensor, args.scenes, size)
+
+    try:
+        results = run(args.only, products, workdir, options)
+    finally:
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': dict(vars(args)), 'results': results}, f, indent=1)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, args.max_regression)
+        for message in regressions:
+            print('Regression {}'.format(message))
+        if not regressions:
+            print('No regressions against {}'.format(args.baseline))
+
+    return 1 if regressions or any('error' in r for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
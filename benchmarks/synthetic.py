@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Synthetic Sentinel-2 and Landsat-8 products for the benchmarks
+
+The products have the structure read by the service and by the GDAL
+drivers: a SAFE (compact naming) zip with the product and tile XML files and
+JPEG2000 bands, and a Landsat Collection 1 tarball with the MTL file and
+GeoTIFF bands. The bands are smooth fields with noise, so they compress like
+real scenes, and their size is configurable.
+"""
+
+#APIs
+import os
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import datetime
+import numpy as np
+
+from osgeo import gdal, osr
+
+#Sentinel-2 bands and their resolution
+S2_BANDS = {'B01': 60, 'B02': 10, 'B03': 10, 'B04': 10, 'B05': 20, 'B06': 20, 'B07': 20,
+            'B08': 10, 'B8A': 20, 'B09': 60, 'B10': 60, 'B11': 20, 'B12': 20}
+
+#Landsat-8 bands: (resolution, radiance mult, radiance add, radiance maximum)
+L8_BANDS = {'B1': (30, 1.2483E-02, -62.41, 748.2), 'B2': (30, 1.2783E-02, -63.91, 766.2),
+            'B3': (30, 1.1779E-02, -58.89, 706.0), 'B4': (30, 9.9328E-03, -49.66, 595.4),
+            'B5': (30, 6.0783E-03, -30.39, 364.3), 'B6': (30, 1.5116E-03, -7.55, 90.6),
+            'B7': (30, 5.0949E-04, -2.55, 30.5), 'B8': (15, 1.1241E-02, -56.20, 673.8),
+            'B9': (30, 2.3755E-03, -11.87, 142.4), 'B10': (30, 3.3420E-04, 0.1, 22.0),
+            'B11': (30, 3.3420E-04, 0.1, 22.0)}
+
+#Upper left corner of the synthetic scenes (UTM zone 30N)
+EPSG = 32630
+ULX, ULY = 399960., 4700040.
+
+
+def utm_srs():
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def footprint(width):
+    """
+    Corners (lon, lat) of a square scene of `width` metres
+    """
+
+    lonlat = osr.SpatialReference()
+    lonlat.ImportFromEPSG(4326)
+    if hasattr(lonlat, 'SetAxisMappingStrategy'):
+        lonlat.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ct = osr.CoordinateTransformation(utm_srs(), lonlat)
+    corners = [(ULX, ULY), (ULX + width, ULY), (ULX + width, ULY - width), (ULX, ULY - width), (ULX, ULY)]
+    return [ct.TransformPoint(x, y)[:2] for x, y in corners]
+
+
+def synthetic_band(rows, cols, low, high, seed, border=0):
+    """
+    uint16 band with a smooth field plus noise between low and high, and
+    a frame of 0's (no data) of `border` pixels
+    """
+
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    field = np.sin(x / max(cols, 1) * 6 + seed) * np.cos(y / max(rows, 1) * 4 - seed)
+    field = (field + 1) / 2 * 0.8 + rng.uniform(0, 0.2, (rows, cols)).astype(np.float32)
+    band = (low + field * (high - low)).astype(np.uint16)
+    if border:
+        band[:border], band[-border:], band[:, :border], band[:, -border:] = 0, 0, 0, 0
+    return band
+
+
+def write_raster(path, driver, arr, resolution, options=()):
+
+    mem = gdal.GetDriverByName('MEM').Create('', arr.shape[1], arr.shape[0], 1, gdal.GDT_UInt16)
+    mem.SetGeoTransform((ULX, resolution, 0, ULY, 0, -resolution))
+    mem.SetProjection(utm_srs().ExportToWkt())
+    mem.GetRasterBand(1).WriteArray(arr)
+    out = gdal.GetDriverByName(driver).CreateCopy(path, mem, 0, list(options))
+    if out is None:
+        raise IOError('Unable to write {}'.format(path))
+    out = None
+
+
+def md5sum(path):
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def sentinel_product(folder, index=0, size=1098, tile='30TVM'):
+    """
+    Write a synthetic Sentinel-2 L1C product
+
+    Parameters
+    ----------
+    folder : str
+        Folder where the zip is written
+    index : int
+        Number of the product, it gives the acquisition date and the data
+    size : int
+        Pixels per side of the 10 m bands, multiple of 6
+
+    Returns
+    -------
+    dict with the name (title), uuid, path, md5 and acquisition date of the product
+    """
+
+    size -= size % 6
+    date = datetime.datetime(2019, 1, 1, 10, 54, 41) + datetime.timedelta(days=5 * index)
+    stamp = date.strftime('%Y%m%dT%H%M%S')
+    name = 'S2A_MSIL1C_{}_N0207_R051_T{}_{}'.format(stamp, tile, stamp)
+    granule = 'L1C_T{}_A{:06d}_{}'.format(tile, 18000 + index, stamp)
+    work = os.path.join(folder, '{}.work'.format(name))
+    safe = os.path.join(work, '{}.SAFE'.format(name))
+    img_data = os.path.join(safe, 'GRANULE', granule, 'IMG_DATA')
+    os.makedirs(img_data)
+
+    image_files = []
+    for i, (band, resolution) in enumerate(sorted(S2_BANDS.items())):
+        n = size * 10 // resolution
+        image = 'T{}_{}_{}'.format(tile, stamp, band)
+        write_raster(os.path.join(img_data, '{}.jp2'.format(image)), 'JP2OpenJPEG',
+                     synthetic_band(n, n, 500, 4000, seed=index * 100 + i), resolution,
+                     ['REVERSIBLE=YES', 'QUALITY=100'])
+        image_files.append('GRANULE/{}/IMG_DATA/{}'.format(granule, image))
+
+    corners = footprint(size * 10)
+    positions = ' '.join('{} {}'.format(lat, lon) for lon, lat in corners)
+    spectral = '\n'.join('<Spectral_Information bandId="{}" physicalBand="{}"><RESOLUTION>{}</RESOLUTION>'
+                         '</Spectral_Information>'.format(i, b.replace('B0', 'B'), r)
+                         for i, (b, r) in enumerate(sorted(S2_BANDS.items(), key=lambda k: k[0].replace('8A', '8Z'))))
+
+    with open(os.path.join(safe, 'MTD_MSIL1C.xml'), 'w') as f:
+        f.write('''<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-1C.xsd">
+<n1:General_Info>
+<Product_Info>
+<PRODUCT_START_TIME>{start}</PRODUCT_START_TIME>
+<PRODUCT_STOP_TIME>{start}</PRODUCT_STOP_TIME>
+<PRODUCT_URI>{name}.SAFE</PRODUCT_URI>
+<PROCESSING_LEVEL>Level-1C</PROCESSING_LEVEL>
+<PRODUCT_TYPE>S2MSI1C</PRODUCT_TYPE>
+<PROCESSING_BASELINE>02.07</PROCESSING_BASELINE>
+<GENERATION_TIME>{start}</GENERATION_TIME>
+<Datatake datatakeIdentifier="GS2A_{stamp}_018000_N02.07">
+<SPACECRAFT_NAME>Sentinel-2A</SPACECRAFT_NAME>
+<DATATAKE_TYPE>INS-NOBS</DATATAKE_TYPE>
+<DATATAKE_SENSING_START>{start}</DATATAKE_SENSING_START>
+<SENSING_ORBIT_NUMBER>51</SENSING_ORBIT_NUMBER>
+<SENSING_ORBIT_DIRECTION>DESCENDING</SENSING_ORBIT_DIRECTION>
+</Datatake>
+<Query_Options completeSingleTile="true"><PRODUCT_FORMAT>SAFE_COMPACT</PRODUCT_FORMAT></Query_Options>
+<Product_Organisation>
+<Granule_List>
+<Granule datastripIdentifier="S2A_OPER_MSI_L1C_DS_{stamp}" granuleIdentifier="{granule_id}" imageFormat="JPEG2000">
+{image_files}
+</Granule>
+</Granule_List>
+</Product_Organisation>
+</Product_Info>
+<Product_Image_Characteristics>
+<QUANTIFICATION_VALUE unit="none">10000</QUANTIFICATION_VALUE>
+<Spectral_Information_List>
+{spectral}
+</Spectral_Information_List>
+</Product_Image_Characteristics>
+</n1:General_Info>
+<n1:Geometric_Info>
+<Product_Footprint><Product_Footprint><Global_Footprint>
+<EXT_POS_LIST>{positions}</EXT_POS_LIST>
+</Global_Footprint></Product_Footprint></Product_Footprint>
+<Coordinate_Reference_System><GEO_TABLES version="1">EPSG</GEO_TABLES><Horizontal_CS><HORIZONTAL_CS_TYPE>GEOGRAPHIC</HORIZONTAL_CS_TYPE><HORIZONTAL_CS_CODE>EPSG:4326</HORIZONTAL_CS_CODE></Horizontal_CS></Coordinate_Reference_System>
+</n1:Geometric_Info>
+<n1:Quality_Indicators_Info>
+<Cloud_Coverage_Assessment>{cloud}</Cloud_Coverage_Assessment>
+</n1:Quality_Indicators_Info>
+</n1:Level-1C_User_Product>
+'''.format(start=date.strftime('%Y-%m-%dT%H:%M:%S.024Z'), name=name, stamp=stamp, granule_id=granule,
+           image_files='\n'.join('<IMAGE_FILE>{}</IMAGE_FILE>'.format(i) for i in image_files),
+           spectral=spectral, positions=positions, cloud=float(index * 7 % 100)))
+
+    sizes = '\n'.join('<Size resolution="{0}"><NROWS>{1}</NROWS><NCOLS>{1}</NCOLS></Size>'.format(r, size * 10 // r)
+                      for r in (10, 20, 60))
+    geopositions = '\n'.join('<Geoposition resolution="{0}"><ULX>{1}</ULX><ULY>{2}</ULY><XDIM>{0}</XDIM>'
+                             '<YDIM>-{0}</YDIM></Geoposition>'.format(r, int(ULX), int(ULY)) for r in (10, 20, 60))
+
+    with open(os.path.join(safe, 'GRANULE', granule, 'MTD_TL.xml'), 'w') as f:
+        f.write('''<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-1C_Tile_ID xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-1C_Tile_Metadata.xsd">
+<n1:General_Info>
+<TILE_ID>S2A_OPER_MSI_L1C_TL_{stamp}_N02.07</TILE_ID>
+<SENSING_TIME>{start}</SENSING_TIME>
+</n1:General_Info>
+<n1:Geometric_Info>
+<Tile_Geocoding metadataLevel="Brief">
+<HORIZONTAL_CS_NAME>WGS84 / UTM zone 30N</HORIZONTAL_CS_NAME>
+<HORIZONTAL_CS_CODE>EPSG:{epsg}</HORIZONTAL_CS_CODE>
+{sizes}
+{geopositions}
+</Tile_Geocoding>
+<Tile_Angles>
+<Mean_Sun_Angle>
+<ZENITH_ANGLE unit="deg">{zenith}</ZENITH_ANGLE>
+<AZIMUTH_ANGLE unit="deg">162.1</AZIMUTH_ANGLE>
+</Mean_Sun_Angle>
+</Tile_Angles>
+</n1:Geometric_Info>
+</n1:Level-1C_Tile_ID>
+'''.format(stamp=stamp, start=date.strftime('%Y-%m-%dT%H:%M:%S.024Z'), epsg=EPSG, sizes=sizes,
+           geopositions=geopositions, zenith=40. + index % 30))
+
+    # the bands are already compressed, only the XML files are deflated
+    path = os.path.join(folder, '{}.zip'.format(name))
+    with zipfile.ZipFile(path, 'w') as zf:
+        for root, dirs, files in os.walk(safe):
+            for file in files:
+                filename = os.path.join(root, file)
+                compression = zipfile.ZIP_DEFLATED if file.endswith('.xml') else zipfile.ZIP_STORED
+                zf.write(filename, os.path.relpath(filename, work), compress_type=compression)
+    shutil.rmtree(work)
+
+    return {'title': name, 'uuid': hashlib.md5(name.encode('utf-8')).hexdigest(), 'path': path,
+            'md5': md5sum(path), 'date': date, 'footprint': [list(c) for c in corners]}
+
+
+def landsat_product(folder, index=0, size=1000, wrs_path=201, wrs_row=32):
+    """
+    Write a synthetic Landsat-8 Collection 1 L1TP scene
+
+    Parameters
+    ----------
+    folder : str
+        Folder where the tarball is written
+    index : int
+        Number of the scene, it gives the acquisition date and the data
+    size : int
+        Pixels per side of the 30 m bands
+
+    Returns
+    -------
+    dict with the entityId, displayId, path, md5 and acquisition date of the scene
+    """
+
+    date = datetime.datetime(2019, 1, 1, 10, 52, 12) + datetime.timedelta(days=16 * index)
+    product_id = 'LC08_L1TP_{:03d}{:03d}_{}_{}_01_T1'.format(wrs_path, wrs_row, date.strftime('%Y%m%d'),
+                                                             (date + datetime.timedelta(days=10)).strftime('%Y%m%d'))
+    entity_id = 'LC8{:03d}{:03d}{}LGN00'.format(wrs_path, wrs_row, date.strftime('%Y%j'))
+    work = os.path.join(folder, '{}.work'.format(entity_id))
+    os.makedirs(work)
+
+    files = []
+    for i, (band, (resolution, mult, add, rad_max)) in enumerate(sorted(L8_BANDS.items())):
+        n = size * 30 // resolution
+        low, high = (20000, 30000) if band in ('B10', 'B11') else (6000, 20000)
+        file = '{}_{}.TIF'.format(product_id, band)
+        write_raster(os.path.join(work, file), 'GTiff',
+                     synthetic_band(n, n, low, high, seed=index * 100 + i, border=n // 20), resolution,
+                     ['COMPRESS=DEFLATE', 'TILED=YES'])
+        files.append(file)
+
+    corners = footprint(size * 30)
+    names = ('UL', 'UR', 'LR', 'LL')
+    corner_lines = '\n'.join('    CORNER_{0}_LAT_PRODUCT = {2:.5f}\n    CORNER_{0}_LON_PRODUCT = {1:.5f}'.format(c, *p)
+                             for c, p in zip(names, corners))
+
+    def band_lines(fmt, values):
+        return '\n'.join('    {} = {}'.format(fmt.format(b[1:]), v) for b, v in values)
+
+    reflective = [(b, v) for b, v in sorted(L8_BANDS.items(), key=lambda k: int(k[0][1:])) if b not in ('B10', 'B11')]
+    ordered = sorted(L8_BANDS.items(), key=lambda k: int(k[0][1:]))
+    mtl = '''GROUP = L1_METADATA_FILE
+  GROUP = METADATA_FILE_INFO
+    ORIGIN = "Image courtesy of the U.S. Geological Survey"
+    LANDSAT_SCENE_ID = "{entity_id}"
+    LANDSAT_PRODUCT_ID = "{product_id}"
+    COLLECTION_NUMBER = 01
+    FILE_DATE = {file_date}
+  END_GROUP = METADATA_FILE_INFO
+  GROUP = PRODUCT_METADATA
+    DATA_TYPE = "L1TP"
+    SPACECRAFT_ID = "LANDSAT_8"
+    SENSOR_ID = "OLI_TIRS"
+    WRS_PATH = {wrs_path}
+    WRS_ROW = {wrs_row}
+    DATE_ACQUIRED = {date}
+    SCENE_CENTER_TIME = "{time}"
+{corners}
+{files}
+  END_GROUP = PRODUCT_METADATA
+  GROUP = IMAGE_ATTRIBUTES
+    CLOUD_COVER = {cloud}
+    CLOUD_COVER_LAND = {cloud}
+    SUN_AZIMUTH = 160.3
+    SUN_ELEVATION = {elevation}
+    EARTH_SUN_DISTANCE = 0.9833
+  END_GROUP = IMAGE_ATTRIBUTES
+  GROUP = MIN_MAX_RADIANCE
+{rad_max}
+{rad_min}
+  END_GROUP = MIN_MAX_RADIANCE
+  GROUP = MIN_MAX_REFLECTANCE
+{ref_max}
+{ref_min}
+  END_GROUP = MIN_MAX_REFLECTANCE
+  GROUP = RADIOMETRIC_RESCALING
+{mult}
+{add}
+  END_GROUP = RADIOMETRIC_RESCALING
+  GROUP = TIRS_THERMAL_CONSTANTS
+    K1_CONSTANT_BAND_10 = 774.8853
+    K2_CONSTANT_BAND_10 = 1321.0789
+    K1_CONSTANT_BAND_11 = 480.8883
+    K2_CONSTANT_BAND_11 = 1201.1442
+  END_GROUP = TIRS_THERMAL_CONSTANTS
+END_GROUP = L1_METADATA_FILE
+END
+'''.format(entity_id=entity_id, product_id=product_id, file_date=date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+           wrs_path=wrs_path, wrs_row=wrs_row, date=date.strftime('%Y-%m-%d'),
+           time=date.strftime('%H:%M:%S.0000000Z'), corners=corner_lines,
+           files='\n'.join('    FILE_NAME_BAND_{} = "{}"'.format(f.split('_B')[-1][:-4], f) for f in files),
+           cloud=float(index * 7 % 100), elevation=20. + index % 40,
+           rad_max=band_lines('RADIANCE_MAXIMUM_BAND_{}', [(b, v[3]) for b, v in ordered]),
+           rad_min=band_lines('RADIANCE_MINIMUM_BAND_{}', [(b, -v[3] / 12.) for b, v in ordered]),
+           ref_max=band_lines('REFLECTANCE_MAXIMUM_BAND_{}', [(b, 1.2107) for b, v in reflective]),
+           ref_min=band_lines('REFLECTANCE_MINIMUM_BAND_{}', [(b, -0.09998) for b, v in reflective]),
+           mult=band_lines('RADIANCE_MULT_BAND_{}', [(b, v[1]) for b, v in ordered]),
+           add=band_lines('RADIANCE_ADD_BAND_{}', [(b, v[2]) for b, v in ordered]))
+
+    mtl_file = '{}_MTL.txt'.format(product_id)
+    with open(os.path.join(work, mtl_file), 'w') as f:
+        f.write(mtl)
+    files.append(mtl_file)
+
+    path = os.path.join(folder, '{}.tar.gz'.format(entity_id))
+    with tarfile.open(path, 'w:gz', compresslevel=1) as tar:
+        for file in files:
+            tar.add(os.path.join(work, file), arcname=file)
+    shutil.rmtree(work)
+
+    return {'entityId': entity_id, 'displayId': product_id, 'path': path, 'md5': md5sum(path), 'date': date,
+            'footprint': [list(c) for c in corners]}
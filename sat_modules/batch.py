@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Download and process the scenes of many regions at once.
+
+The bounding boxes of the regions are merged into a few query boxes, so
+neighbouring regions share one search. Every product found is assigned to
+the regions its footprint intersects, downloaded and extracted once into
+the scene store and then processed for each of its regions (a link to the
+output of the whole tile, or the window of the region). All the providers
+and regions share the CPU and bandwidth budget of one supervisor.
+"""
+
+#APIs
+import os
+
+from sat_modules import metrics
+from sat_modules.pipeline import pipeline
+from sat_modules.search_cache import footprint_intersects
+
+#Name of the downloaders searching and fetching the products of the batch, their journal is path/.batch
+BATCH_REGION = '.batch'
+
+
+def area(box):
+    return max(box['E'] - box['W'], 0) * max(box['N'] - box['S'], 0)
+
+
+def union(a, b):
+    return {'W': min(a['W'], b['W']), 'S': min(a['S'], b['S']), 'E': max(a['E'], b['E']), 'N': max(a['N'], b['N'])}
+
+
+def intersects(a, b):
+    return a['W'] <= b['E'] and a['E'] >= b['W'] and a['S'] <= b['N'] and a['N'] >= b['S']
+
+
+def processed(job, r):
+    """
+    Check if the downloader of a region already has the output of a search result
+    """
+
+    scene = job.scene(r)
+    return job.journal.state(scene['tile_id']) == 'processed' and os.path.isdir(scene['output_path'])
+
+
+def merge_boxes(regions, max_waste=0.5):
+    """
+    Group the regions whose bounding boxes can be searched together
+
+    Two groups are merged while the area of their common box is at most
+    (1 + max_waste) times the sum of their areas, so overlapping and
+    neighbouring regions share a query but distant ones do not make a
+    query covering everything between them.
+
+    Parameters
+    ----------
+    regions : dict
+        Name and coordinates of the regions.
+        Example: {"CdP": {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}}
+    max_waste : float
+
+    Returns
+    -------
+    list of (box, names of the regions)
+    """
+
+    groups = [(dict(regions[name]), [name]) for name in sorted(regions)]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                (a, names_a), (b, names_b) = groups[i], groups[j]
+                box = union(a, b)
+                if intersects(a, b) or area(box) <= (area(a) + area(b)) * (1 + max_waste):
+                    groups[i] = (box, names_a + names_b)
+                    del groups[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return groups
+
+
+class batch:
+
+    def __init__(self, regions, providers, store, supervisor=None, max_waste=0.5):
+        """
+        Parameters
+        ----------
+        regions : dict
+            Name and coordinates of the regions
+        providers : dict
+            Name of the provider (eg. 'Sentinel2') and function(region, coordinates)
+            returning its downloader (download_sentinel or download_landsat)
+            for a region. The downloaders must use `store`.
+        store : scene_store
+            Store where the products are downloaded once for all the regions
+        supervisor : supervisor
+            CPU and bandwidth budget shared by all the providers and regions
+        max_waste : float
+            See merge_boxes
+        """
+
+        self.regions = regions
+        self.providers = providers
+        self.store = store
+        self.supervisor = supervisor
+        self.groups = merge_boxes(regions, max_waste=max_waste)
+
+    def search(self, searcher):
+        """
+        Search the products of all the regions with a query per group of regions
+
+        Returns
+        -------
+        list of (search result, names of the regions intersecting it), every
+        product appears once even if it is found by several queries
+        """
+
+        products = {}
+        for box, names in self.groups:
+            searcher.coord = box
+            metrics.log('Searching {} regions: {}'.format(len(names), ', '.join(names)))
+            for r in searcher.search():
+                tile_id = searcher.scene(r)['tile_id']
+                footprint = searcher.footprint(r)
+                hits = [n for n in names if footprint is None or footprint_intersects(footprint, self.regions[n])]
+                if tile_id not in products:
+                    products[tile_id] = (r, [])
+                products[tile_id][1].extend(n for n in hits if n not in products[tile_id][1])
+        return [p for p in products.values() if p[1]]
+
+    def download(self, name):
+        """
+        Download the products of a provider once and process them for every region
+        """
+
+        factory = self.providers[name]
+        searcher = factory(BATCH_REGION, self.groups[0][0])
+        jobs = {region: factory(region, coordinates) for region, coordinates in self.regions.items()}
+        products = self.search(searcher)
+        metrics.log('{}: {} products for {} regions'.format(name, len(products), len(self.regions)))
+
+        # EarthExplorer needs the ERS login to download (or the cookies of a previous run)
+        if hasattr(searcher, 'ers_login'):
+            searcher.ers_login()
+
+        def items():
+            for r, regions in products:
+                scene = searcher.scene(r)
+                #the product is not fetched again (eg. evicted from the store) for the regions already done
+                regions = [region for region in regions if not processed(jobs[region], r)]
+                if not regions:
+                    metrics.log('File {} already processed for all its regions'.format(scene['tile_id']))
+                    continue
+                searcher.journal.searched(scene['tile_id'])
+                yield dict(scene, result=r, regions=regions)
+
+        def process(item):
+            """
+            The product is in the store, every region only links or crops it
+            """
+            for region in item['regions']:
+                job = jobs[region]
+                scene = job.scene(item['result'])
+                try:
+                    with self.store.lock(scene['tile_id']):
+                        if job.fetch(scene) is None:
+                            continue
+                        job.process(job.unpack(scene))
+                except Exception as e:
+                    # a failed region does not stop the others
+                    metrics.error('Error processing {} for {}: {}'.format(scene['tile_id'], region, e))
+                finally:
+                    job.release(scene)
+            return item
+
+        stages = [('fetch', self.store.locked(searcher.fetch), searcher.workers),
+                  ('extract', self.store.locked(searcher.unpack), 1),
+                  ('process', process, 1),
+                  ('clean', searcher.clean, 1)]
+        if self.supervisor is None:
+            pipeline(stages, provider=name, on_error=searcher.release).run(items())
+        else:
+            pipeline(stages, limits=self.supervisor.limits(threads=getattr(searcher, 'band_workers', 1)),
+                     provider=name, on_error=searcher.release,
+                     on_done=lambda stage: self.supervisor.update(name, stage)).run(items())
+
+    def run(self):
+        """
+        Run all the providers, at the same time if there is a supervisor
+
+        Returns
+        -------
+        dict with the errors of the failed providers
+        """
+
+        if self.supervisor is not None:
+            return self.supervisor.run({name: (lambda name=name: self.download(name)) for name in self.providers})
+
+        errors = {}
+        for name in self.providers:
+            try:
+                self.download(name)
+            except Exception as e:
+                errors[name] = e
+                metrics.error('Error in {}: {}'.format(name, e))
+        return errors
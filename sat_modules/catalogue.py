@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Local catalogue of the processed scenes.
+
+The metadata of every processed scene (identifier, acquisition date, sun
+angles, cloud cover, footprint and output files) is stored in a SQLite
+database, so the scenes of a region can be selected with an indexed query
+instead of opening the archives again. Example:
+
+    catalogue(db_path).query(region='CdP', min_sun_elevation=30)
+"""
+
+#APIs
+import os
+import json
+import time
+import sqlite3
+import contextlib
+
+
+COLUMNS = ('scene_id', 'region', 'sensor', 'tile', 'date', 'cloud_cover', 'sun_elevation', 'sun_azimuth',
+           'footprint', 'west', 'south', 'east', 'north', 'output_path', 'outputs', 'processed')
+
+
+class catalogue:
+
+    def __init__(self, db_path):
+        """
+        Parameters
+        ----------
+        db_path : str
+            Path of the SQLite database
+        """
+
+        self.db_path = db_path
+
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS scenes ('
+                       'scene_id TEXT, region TEXT, sensor TEXT, tile TEXT, date TEXT, '
+                       'cloud_cover REAL, sun_elevation REAL, sun_azimuth REAL, '
+                       'footprint TEXT, west REAL, south REAL, east REAL, north REAL, '
+                       'output_path TEXT, outputs TEXT, processed REAL, '
+                       'PRIMARY KEY (scene_id, region))')
+            db.execute('CREATE INDEX IF NOT EXISTS scenes_region_date ON scenes (region, date)')
+            db.execute('CREATE INDEX IF NOT EXISTS scenes_sensor_date ON scenes (sensor, date)')
+            db.execute('CREATE INDEX IF NOT EXISTS scenes_tile_date ON scenes (tile, date)')
+            db.execute('CREATE INDEX IF NOT EXISTS scenes_sun_elevation ON scenes (sun_elevation)')
+            db.execute('CREATE INDEX IF NOT EXISTS scenes_cloud_cover ON scenes (cloud_cover)')
+            db.execute('CREATE INDEX IF NOT EXISTS scenes_bbox ON scenes (west, east, south, north)')
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        A new connection is used in every call, so the catalogue can be
+        shared by the pipeline threads. The transaction is committed and
+        the connection closed on exit.
+        """
+        folder = os.path.dirname(self.db_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, scene):
+        """
+        Add or update a processed scene
+
+        Parameters
+        ----------
+        scene : dict
+            Metadata of the scene (see COLUMNS). The bounding box is computed
+            from 'footprint' (list of [lon, lat]) and the output files are
+            listed from 'output_path'.
+        """
+
+        scene = dict(scene)
+        footprint = scene.get('footprint') or []
+        if footprint:
+            lons, lats = [p[0] for p in footprint], [p[1] for p in footprint]
+            scene.update({'west': min(lons), 'south': min(lats), 'east': max(lons), 'north': max(lats)})
+            scene['footprint'] = json.dumps(footprint)
+        else:
+            scene['footprint'] = None
+        output_path = scene.get('output_path')
+        if output_path and os.path.isdir(output_path):
+            scene['outputs'] = json.dumps(sorted(os.listdir(output_path)))
+        scene['processed'] = time.time()
+
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO scenes VALUES ({})'.format(', '.join('?' * len(COLUMNS))),
+                       tuple(scene.get(c) for c in COLUMNS))
+
+    def query(self, region=None, sensor=None, tile=None, start=None, end=None,
+              min_sun_elevation=None, max_cloud_cover=None, bbox=None):
+        """
+        Processed scenes matching all the given conditions, sorted by date
+
+        Parameters
+        ----------
+        start, end : str
+            Acquisition dates in ISO format (eg. '2019-01-01')
+        bbox : dict
+            Only the scenes whose footprint intersects the box.
+            Example: {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}
+        """
+
+        # the dates include the acquisition time, '~' sorts after it so the end date is included
+        conditions, args = [], []
+        for column, op, value in (('region', '=', region), ('sensor', '=', sensor), ('tile', '=', tile),
+                                  ('date', '>=', start), ('date', '<', end and '{}~'.format(end)),
+                                  ('sun_elevation', '>=', min_sun_elevation),
+                                  ('cloud_cover', '<=', max_cloud_cover)):
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, op))
+                args.append(value)
+        if bbox is not None:
+            conditions.append('west <= ? AND east >= ? AND south <= ? AND north >= ?')
+            args.extend([bbox['E'], bbox['W'], bbox['N'], bbox['S']])
+
+        sql = 'SELECT * FROM scenes'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY date'
+
+        with self.connect() as db:
+            rows = db.execute(sql, args).fetchall()
+
+        scenes = []
+        for row in rows:
+            scene = dict(zip(COLUMNS, row))
+            for c in ('footprint', 'outputs'):
+                scene[c] = json.loads(scene[c]) if scene[c] else []
+            scenes.append(scene)
+        return scenes
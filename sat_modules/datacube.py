@@ -0,0 +1,268 @@
+"""
+Time series datacube of a region
+
+Every sensor and dataset (eg. Sentinel2_Bands_10, Landsat8_Spectral_Bands)
+of a region is stored in a netCDF file with an unlimited time dimension.
+The grid of the file is the bounding box of the region snapped to the
+pixels of the scenes (see cube_coordinates), so it does not depend on the
+framing of a scene and all the acquisitions of a tile or Landsat path/row
+go to the same file, cropped or not. The scenes of another projection or
+pixel alignment can not be stacked and go to their own file. Every
+processed scene is appended as a new time slice chunked as (1, y, x), so
+an append only writes the chunks of the new scene and never rewrites the
+previous ones. The pixels of the region outside of a scene are fill values.
+
+The slices are stored in the order they are appended. The variable
+time_order holds the indices of the slices sorted by time and the
+attribute n_scenes the number of complete slices, a slice is only counted
+once all its bands have been written (a crash leaves it to be overwritten
+by the next append). See read().
+"""
+
+#APIs
+import os
+import re
+import time
+import hashlib
+import datetime
+import numpy as np
+
+from netCDF4 import Dataset, date2num, num2date
+
+from sat_modules import geo_utils
+from sat_modules import metrics
+from sat_modules import nc_encoding
+
+TIME_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+#Chunks of the profiles without spatial chunks
+DEFAULT_CHUNKS = (512, 512)
+
+
+def parse_date(date):
+    """
+    Datetime of an acquisition date in ISO format (eg. 2019-01-01T10:54:41.024Z)
+    """
+
+    match = re.match(r'(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}:\d{2})(\.\d+)?', date)
+    if match is None:
+        raise ValueError('Unknown date format {}'.format(date))
+    d = datetime.datetime.strptime('{}T{}'.format(*match.groups()[:2]), '%Y-%m-%dT%H:%M:%S')
+    return d + datetime.timedelta(seconds=float(match.group(3) or 0))
+
+
+def cube_coordinates(coordinates, region):
+    """
+    Grid of the datacube of a region for a scene: the projected bounding box
+    of the region snapped outwards to the pixels of the scene
+
+    Parameters
+    ----------
+    coordinates : dict
+        geotransform, geoprojection, Xsize and Ysize of the scene (north up)
+    region : dict
+        Bounding box of the region. Example: {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}
+
+    Returns
+    -------
+    geotransform, geoprojection, Xsize and Ysize of the datacube
+    """
+
+    gt, projection = coordinates['geotransform'], coordinates['geoprojection']
+    if gt[2] or gt[4]:
+        raise ValueError('The datacube only supports north up rasters')
+
+    xmin, ymin, xmax, ymax = geo_utils.aoi_bounds(projection, region)
+    col0, col1 = np.floor((xmin - gt[0]) / gt[1]), np.ceil((xmax - gt[0]) / gt[1])
+    row0, row1 = np.floor((ymax - gt[3]) / gt[5]), np.ceil((ymin - gt[3]) / gt[5])
+
+    # rounded so that the scenes with another origin on the same pixels give the same grid
+    x0, y0 = round(gt[0] + col0 * gt[1], 3), round(gt[3] + row0 * gt[5], 3)
+    return {'geotransform': (x0, gt[1], 0., y0, 0., gt[5]),
+            'geoprojection': projection,
+            'Xsize': int(col1 - col0),
+            'Ysize': int(row1 - row0)}
+
+
+def grid_id(coordinates):
+
+    key = repr((geo_utils.crs_key(coordinates['geoprojection']), tuple(coordinates['geotransform']),
+                coordinates['Xsize'], coordinates['Ysize']))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+class datacube_writer:
+
+    extension = '.nc'
+
+    def __init__(self, path, description, coordinates, bands, encoding='legacy', latlon=False, grid_cache=None,
+                 scene=None, region=None):
+        """
+        Same parameters as writers.netcdf_writer, path is the prefix of the
+        datacube files and coordinates those of the scene (or its window).
+
+        scene : dict
+            scene_id and date of the appended scene (see scene_metadata)
+        region : dict
+            Bounding box of the region covered by the datacube
+        """
+
+        if scene is None:
+            raise ValueError('The datacube writer needs the scene_id and date of the scene')
+        if region is None:
+            raise ValueError('The datacube writer needs the bounding box of the region')
+
+        cube = cube_coordinates(coordinates, region)
+        rows, cols = cube['Ysize'], cube['Xsize']
+        self.path = '{}_{}{}'.format(path, grid_id(cube), self.extension)
+        self.scene = scene
+        self.shape = (rows, cols)
+
+        # position of the scene in the datacube and pixels of the datacube it covers
+        gt, cube_gt = coordinates['geotransform'], cube['geotransform']
+        self.offset = (int(round((gt[0] - cube_gt[0]) / gt[1])), int(round((gt[3] - cube_gt[3]) / gt[5])))
+        xsize = min(self.offset[0] + coordinates['Xsize'], cols) - max(self.offset[0], 0)
+        ysize = min(self.offset[1] + coordinates['Ysize'], rows) - max(self.offset[1], 0)
+        self.pixels = {name: 0 for name, thermal in bands}
+        self.size = max(xsize, 0) * max(ysize, 0)
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        with nc_encoding.NETCDF_LOCK:
+            if os.path.isfile(self.path):
+                self.dsout = Dataset(self.path, 'a')
+            else:
+                self.dsout = Dataset(self.path, 'w', format='NETCDF4')
+                self.dsout.description = description
+                self.dsout.history = 'Created {}'.format(time.ctime(time.time()))
+                self.dsout.source = 'netCDF4 python module'
+                self.dsout.n_scenes = 0
+
+                geo_utils.write_coordinates(self.dsout, cube, latlon=latlon, grid_cache=grid_cache)
+
+                self.dsout.createDimension('time', None)
+                times = self.dsout.createVariable('time', 'f8', ('time',))
+                times.standard_name = 'time'
+                times.units = TIME_UNITS
+                times.calendar = 'standard'
+                times.axis = 'T'
+                self.dsout.createVariable('scene_id', str, ('time',))
+                order = self.dsout.createVariable('time_order', 'i4', ('time',))
+                order.long_name = 'indices of the complete time slices sorted by time'
+
+            for name, thermal in bands:
+                if name in self.dsout.variables:
+                    continue
+                datatype, kwargs, attrs = nc_encoding.variable_encoding(encoding, (rows, cols), thermal=thermal)
+                chunks = kwargs.get('chunksizes') or tuple(min(c, s) for c, s in zip(DEFAULT_CHUNKS, (rows, cols)))
+                kwargs['chunksizes'] = (1,) + tuple(chunks)
+                band = self.dsout.createVariable(name, datatype, ('time', 'y', 'x'), **kwargs)
+
+                band.setncatts(attrs)
+                band.standard_name = name
+                band.units = 'rad'
+                band.setncattr('grid_mapping', 'spatial_ref')
+                if latlon:
+                    band.coordinates = 'lat lon'
+
+            # the scene is appended after the complete slices, overwriting an incomplete one
+            self.index = int(self.dsout.n_scenes)
+            scene_ids = self.dsout.variables['scene_id'][:self.index] if self.index else []
+            self.skip = scene['scene_id'] in list(scene_ids)
+            if self.skip:
+                metrics.log('Scene {} already in {}'.format(scene['scene_id'], self.path))
+            elif self.size == 0:
+                self.skip = True
+                metrics.log('Scene {} is outside of {}'.format(scene['scene_id'], self.path))
+            elif self.index < len(self.dsout.dimensions['time']) and self.size < rows * cols:
+                # the incomplete slice of a crash is cleared, the scene does not overwrite all of it
+                for name, thermal in bands:
+                    self.dsout.variables[name][self.index] = np.ma.masked_all(self.shape)
+
+    def write(self, name, arr, window=None):
+
+        if self.skip:
+            return
+        xoff, yoff, xsize, ysize = window or (0, 0, arr.shape[-1], arr.shape[-2])
+
+        # window of the datacube, clipped to the region
+        x0, y0 = max(xoff + self.offset[0], 0), max(yoff + self.offset[1], 0)
+        x1 = min(xoff + self.offset[0] + xsize, self.shape[1])
+        y1 = min(yoff + self.offset[1] + ysize, self.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return
+        arr = arr[y0 - yoff - self.offset[1]:y1 - yoff - self.offset[1],
+                  x0 - xoff - self.offset[0]:x1 - xoff - self.offset[0]]
+
+        with nc_encoding.NETCDF_LOCK:
+            var = self.dsout.variables[name]
+            var[self.index, y0:y1, x0:x1] = nc_encoding.prepare(var, arr)
+        self.pixels[name] += arr.size
+
+    def close(self):
+        """
+        Commit the slice if all the bands have been written completely and
+        close the file
+        """
+
+        with nc_encoding.NETCDF_LOCK:
+            try:
+                if not self.skip and all(n >= self.size for n in self.pixels.values()):
+                    times = self.dsout.variables['time']
+                    times[self.index] = date2num(parse_date(self.scene['date']), TIME_UNITS, times.calendar)
+                    self.dsout.variables['scene_id'][self.index] = self.scene['scene_id']
+                    n = self.index + 1
+                    self.dsout.variables['time_order'][:n] = np.argsort(times[:n], kind='stable')
+                    self.dsout.sync()
+                    self.dsout.n_scenes = n
+            finally:
+                self.dsout.close()
+
+
+def read(path, variable, start=None, end=None, window=None):
+    """
+    Time series of a variable of a datacube file sorted by time
+
+    Parameters
+    ----------
+    path : str
+        Path of the datacube file
+    variable : str
+        Name of the band
+    start, end : datetime
+        Only the slices in [start, end]
+    window : tuple
+        (xoff, yoff, xsize, ysize) read, a single pixel is (x, y, 1, 1)
+
+    Returns
+    -------
+    dates : list of datetime
+    values : array (time, y, x)
+    scene_ids : list of str
+    """
+
+    with nc_encoding.NETCDF_LOCK, Dataset(path) as ds:
+        n = int(ds.n_scenes)
+        times = ds.variables['time']
+        order = ds.variables['time_order'][:n]
+        dates = num2date(times[:n][order], times.units, times.calendar,
+                         only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        keep = [(start is None or d >= start) and (end is None or d <= end) for d in dates]
+        indices = order[np.array(keep, dtype=bool)]
+
+        slices = (slice(None), slice(None))
+        if window is not None:
+            xoff, yoff, xsize, ysize = window
+            slices = (slice(yoff, yoff + ysize), slice(xoff, xoff + xsize))
+
+        # a single read of the range of slices, reordered by time
+        if len(indices):
+            first, last = int(indices.min()), int(indices.max())
+            values = ds.variables[variable][(slice(first, last + 1),) + slices][indices - first]
+        else:
+            values = ds.variables[variable][(slice(0, 0),) + slices]
+        scene_ids = list(ds.variables['scene_id'][:n][indices])
+
+    return [d for d, k in zip(dates, keep) if k], values, scene_ids
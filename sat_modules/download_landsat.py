@@ -28,6 +28,18 @@ Example: {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}}
 producttype : str; Dataset type. A list of productypes can be found in https://mapbox.github.io/usgs/reference/catalog/ee.html
 username: str
 password : str
+workers : int; Number of scenes downloaded in parallel
+use_cache : bool; Reuse the results of previous searches
+cache_ttl : int; Seconds a cached search is valid
+extract : str; Members of the tarball extracted to disk: 'all', 'bands' or 'none'
+supervisor : supervisor; Shares the CPU and bandwidth budget with other providers
+crop : bool; Only process and save the window of the scene covering the coordinates
+encoding : str or dict; Encoding profile of the netCDF bands: 'legacy', 'deflate', 'int16' or a custom dict
+blockwise : bool; Process the bands window by window with bounded memory
+band_workers : int; Number of threads processing the bands of a scene in parallel
+latlon : bool; Add the 2D longitudes and latitudes of the pixels to the outputs
+writer : str; Output backend of the bands: 'netcdf', 'zarr', 'cog' or 'datacube' (time series of the region)
+store : scene_store; Products and outputs shared by the regions, None to keep them in path
 
 Author: Daniel Garcia Diaz
 Date: Sep 2018
@@ -35,17 +47,29 @@ Date: Sep 2018
 #APIs
 import os, re, shutil
 import json
-
-import requests
+import threading
+import hashlib
+import tarfile, zlib
 
 #subfunctions
 from sat_modules import utils
 from sat_modules import landsat_utils
+from sat_modules.search_cache import search_cache
+from sat_modules.pipeline import pipeline
+from sat_modules.session_cache import session_cache, dump_cookies, load_cookies
+from sat_modules.manifest import manifest
+from sat_modules.catalogue import catalogue
+from sat_modules.journal import journal
+from sat_modules import metrics
+from sat_modules import scene_store
 
 class download_landsat:
 
     def __init__(self, inidate, enddate, region, coordinates=None, producttype='LANDSAT_8_C1', cloud=100,
-                 username=None, password=None, path=None):
+                 username=None, password=None, path=None, workers=4,
+                 use_cache=True, cache_ttl=24*3600, extract='all',
+                 supervisor=None, crop=False, encoding='legacy', blockwise=False,
+                 band_workers=1, latlon=False, writer='netcdf', store=None):
         """
         Parameters
         ----------
@@ -60,8 +84,34 @@ class download_landsat:
             Dataset type. A list of productypes can be found in https://mapbox.github.io/usgs/reference/catalog/ee.html
         username: str
         password : str
+        path : str
+        workers : int
+            Number of scenes downloaded in parallel
+        use_cache : bool
+            Reuse the results of previous searches
+        cache_ttl : int
+            Seconds a cached search is valid
+        extract : str
+            Members of the tarball extracted to disk: 'all', 'bands' (only
+            the files read) or 'none' (read through /vsitar/)
+        supervisor : supervisor
+            Shares the CPU and bandwidth budget with other providers
+        crop : bool
+            Only process and save the window of the scene covering the coordinates
+        encoding : str or dict
+            Encoding profile of the netCDF bands: 'legacy', 'deflate', 'int16' or a custom dict
+        blockwise : bool
+            Process the bands window by window with bounded memory
+        band_workers : int
+            Number of threads processing the bands of a scene in parallel
+        latlon : bool
+            Add the 2D longitudes and latitudes of the pixels to the outputs
+        writer : str
+            Output backend of the bands: 'netcdf', 'zarr', 'cog' or 'datacube' (time series of the region)
+        store : scene_store
+            Products and outputs shared by the regions, None to keep them in path
         """
-        self.session = requests.Session()
+        self.session = utils.new_session(pool_size=workers + 2)
 
         # Search parameters
         self.inidate = inidate.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -74,15 +124,72 @@ class download_landsat:
         #work path
         self.path = path
 
+        #number of scenes downloaded at the same time
+        self.workers = workers
+
         # API
         api_version = '1.4.1'
         self.api_url = 'https://earthexplorer.usgs.gov/inventory/json/v/{}/'.format(api_version)
         self.login_url = 'https://ers.cr.usgs.gov/login/'
+        self.download_url = 'https://earthexplorer.usgs.gov/download/12864/{}/STANDARD/EE'
+        self.page_size = 100
         self.credentials = {'username': username, 'password': password}
 
-        # Fetching the API key
-        data = {'username': username,
-                'password': password,
+        # size and checksum of the downloaded archives
+        self.manifest = manifest(os.path.join(path, 'manifest.json'))
+
+        # metadata of the processed scenes
+        self.catalogue = catalogue(os.path.join(path, 'catalogue.db'))
+
+        # state of the scenes of the region, a re-run only redoes the unfinished work
+        self.journal = journal(os.path.join(path, region, 'journal.db'))
+
+        #budget shared with the other providers
+        self.supervisor = supervisor
+
+        #members of the archive written to disk
+        self.extract = extract
+
+        #processing options
+        self.crop = crop
+        self.encoding = encoding
+        self.latlon = latlon
+        self.writer = writer
+        self.blockwise = blockwise
+        self.band_workers = band_workers
+
+        #products and outputs shared with the other regions
+        self.store = store
+
+        #cache of the search results
+        self.cache = search_cache(os.path.join(path, 'search_cache.db'), ttl=cache_ttl) if use_cache else None
+
+        # API key and ERS cookies are reused between runs, the login is only done when they expire
+        self.sessions = session_cache(os.path.join(path, '.sessions.json'))
+        self.login_lock = threading.Lock()
+        self._api_key = None
+        self.ers_cookies = False
+        # incremented at every login, the workers rejected by the same cookies only log in once
+        self.ers_generation = 0
+
+    @property
+    def api_key(self):
+        """
+        API key of the JSON API, read from the session cache or requested on first use
+        """
+        if self._api_key is None:
+            self._api_key = self.sessions.load('earthexplorer', self.credentials['username'])
+            if self._api_key is None:
+                self.login()
+        return self._api_key
+
+    def login(self):
+        """
+        Fetch a new API key
+        """
+
+        data = {'username': self.credentials['username'],
+                'password': self.credentials['password'],
                 'catalogID': 'EE'}
         response = self.session.post(self.api_url + 'login?',
                                      data={'jsonRequest': json.dumps(data)})
@@ -90,17 +197,92 @@ class download_landsat:
         json_feed = response.json()
         if json_feed['error']:
             raise Exception('Error while searching: {}'.format(json_feed['error']))
-        self.api_key = json_feed['data']
+        self._api_key = json_feed['data']
+        self.sessions.save('earthexplorer', self.credentials['username'], self._api_key, ttl=3600)
+
+    def ers_login(self, force=False, generation=None):
+        """
+        Log in the ERS site to download the scenes. The cookies of a previous
+        run are reused unless `force` is set (eg. they were rejected).
+        `generation` is the ers_generation of the rejected cookies, the login
+        is skipped if another worker already logged in again since then.
+        """
+
+        with self.login_lock:
+            if self.ers_cookies and not force:
+                return
+            if force and generation is not None and generation != self.ers_generation:
+                return
+
+            cookies = None if force else self.sessions.load('ers', self.credentials['username'])
+            if cookies is not None:
+                load_cookies(self.session.cookies, cookies)
+                self.ers_cookies = True
+                self.ers_generation += 1
+                return
+
+            response = self.session.get(self.login_url)
+            data = {'username': self.credentials['username'],
+                    'password': self.credentials['password'],
+                    'csrf_token': re.findall(r'name="csrf_token" value="(.+?)"', response.text),
+                    '__ncforminfo': re.findall(r'name="__ncforminfo" value="(.+?)"', response.text)
+                    }
+            response = self.session.post(self.login_url, data=data, allow_redirects=False)
+            response.raise_for_status()
+
+            self.sessions.save('ers', self.credentials['username'], dump_cookies(self.session.cookies), ttl=8*3600)
+            self.ers_cookies = True
+            self.ers_generation += 1
+
+    def search_page(self, query, start):
+        """
+        Request one page of results to EarthExplorer
+
+        Returns
+        -------
+        results : list of scenes in the page
+        next_start : number of the next record, None if this is the last page
+        """
+
+        for attempt in range(2):
+            request = dict(query, startingNumber=start, maxResults=self.page_size, apiKey=self.api_key)
+
+            response = self.session.post(self.api_url + 'search',
+                                         params={'jsonRequest': json.dumps(request)})
+            response.raise_for_status()
+            json_feed = response.json()
+
+            # the cached API key expired, log in again
+            if (json_feed.get('errorCode') or '').startswith('AUTH') and attempt == 0:
+                self.login()
+                continue
+            break
+
+        if json_feed['error']:
+            raise Exception('Error while searching: {}'.format(json_feed['error']))
+        data = json_feed['data']
+        results = data['results']
+
+        if start == 1:
+            metrics.log('Found {} results from Landsat'.format(data['totalHits']))
+
+        next_start = data.get('nextRecord')
+        if not results or not next_start or next_start <= start or next_start > data['totalHits']:
+            next_start = None
+
+        return results, next_start
 
     def search(self):
         """
-        build the query and get the Landsat Collections scenes from request def
+        build the query and iterate over the Landsat Collections scenes from request def.
+        The results are requested page by page, the next page is fetched in
+        background while the scenes of the current one are consumed.
         """
 
         # Post the query
         query = {'datasetName': self.producttype,
                  'includeUnknownCloudCover': False,
-                 'maxResults': 100,
+                 'maxCloudCover': self.cloud,
                  'temporalFilter': {'startDate': self.inidate,
                                     'endDate': self.enddate},
                  'spatialFilter': {'filterType': 'mbr',
@@ -108,60 +290,246 @@ class download_landsat:
                                                  'longitude': self.coord['W']},
                                    'upperRight': {'latitude': self.coord['N'],
                                                   'longitude': self.coord['E']}
-                                   },
-                 'apiKey': self.api_key
+                                   }
                  }
 
-        response = self.session.post(self.api_url + 'search',
-                                     params={'jsonRequest': json.dumps(query)})
-        response.raise_for_status()
-        json_feed = response.json()
-        if json_feed['error']:
-            raise Exception('Error while searching: {}'.format(json_feed['error']))
-        results = json_feed['data']['results']
+        results = utils.paginate(lambda start: self.search_page(query, start), 1, provider='Landsat8')
 
-        print('Found {} results from Landsat'.format(len(results)))
-        return results
+        if self.cache is None:
+            return results
+        params = {'provider': 'Landsat', 'producttype': self.producttype, 'coordinates': self.coord,
+                  'inidate': self.inidate, 'enddate': self.enddate, 'cloud': self.cloud}
+        return self.cache.iterate(params, results, footprint=self.footprint, date=self.acquisition_date)
 
-    def download(self):
+    @property
+    def throttle(self):
+        return None if self.supervisor is None else self.supervisor.throttle
 
-        #results of the search
-        results = self.search()
-        if not isinstance(results, list):
-            results = [results]
+    def fetch(self, scene):
+        """
+        Stage of the pipeline: download the tarball of a scene
+        """
 
-        # Make the login
-        response = self.session.get(self.login_url)
-        data = {'username': self.credentials['username'],
-                'password': self.credentials['password'],
-                'csrf_token': re.findall(r'name="csrf_token" value="(.+?)"', response.text),
-                '__ncforminfo': re.findall(r'name="__ncforminfo" value="(.+?)"', response.text)
-                }
-        response = self.session.post(self.login_url, data=data, allow_redirects=False)
-        response.raise_for_status()
+        state = self.journal.state(scene['tile_id'])
+        if state == 'processed' and os.path.isdir(scene['output_path']):
+            metrics.log('File {} already processed'.format(scene['tile_id']))
+            return None
 
-        # Download the files
-        for r in results:
-            tile_id = r['entityId']
+        # the product is kept in the store while the scene goes through the pipeline
+        if self.store is not None:
+            scene['lease'] = self.store.lease(scene['tile_id'])
 
-            save_dir = os.path.join(self.path, tile_id)
-            output_path = os.path.join(self.path, self.region, tile_id)
+        if state == 'extracted' and os.path.isdir(scene['save_dir']):
+            metrics.log('File {} already extracted'.format(scene['tile_id']))
+            return scene
 
-            if not os.path.isdir(save_dir):
-                os.mkdir(save_dir)
-                os.mkdir(output_path)
-            else:
-                print('File {} already downloaded'.format(tile_id))
-                continue
+        if self.store is not None:
+            folder = os.path.dirname(scene['archive'])
+            if self.store.get(folder) is not None and os.path.isdir(scene['save_dir']):
+                metrics.log('File {} already in the store'.format(scene['tile_id']))
+                self.journal.set(scene['tile_id'], 'extracted')
+                return scene
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+        metrics.log('Downloading {} ...'.format(scene['tile_id']))
+
+        if self.manifest.is_verified(scene['archive']):
+            metrics.log('Archive {} already verified'.format(scene['tile_id']))
+            self.journal.set(scene['tile_id'], 'downloaded')
+            return scene
+
+        #an interrupted download is resumed from the partial file and its size checked
+        #against the one announced by EarthExplorer, the MD5 is computed while downloading
+        url = self.download_url.format(scene['tile_id'])
+        md5 = hashlib.md5()
+        generation = self.ers_generation
+        try:
+            _, checked = utils.download_file(self.session, url, scene['archive'], throttle=self.throttle, hasher=md5)
+        except utils.AuthenticationError:
+            # the cached cookies were rejected, log in again
+            self.ers_login(force=True, generation=generation)
+            _, checked = utils.download_file(self.session, url, scene['archive'], throttle=self.throttle, hasher=md5)
+
+        #without a size to compare (eg. chunked responses) a truncated archive is only detected on extraction
+        self.manifest.record(scene['archive'], md5.hexdigest(), verified=checked)
+        self.journal.set(scene['tile_id'], 'downloaded')
+        return scene
+
+    def unpack(self, scene):
+        """
+        Stage of the pipeline: extract the tarball (or read the bands straight from it)
+        """
+
+        if self.journal.state(scene['tile_id']) == 'extracted' and os.path.isdir(scene['save_dir']):
+            scene['tile_path'] = scene['save_dir']
+        elif self.extract == 'none':
+            scene['tile_path'] = '/vsitar/{}'.format(os.path.abspath(scene['archive']))
+        else:
+            # the tarball is extracted to a staging folder, renamed once it is complete
+            members = landsat_utils.ARCHIVE_MEMBERS if self.extract == 'bands' else None
+            staging = '{}.tmp'.format(scene['save_dir'])
+            shutil.rmtree(staging, ignore_errors=True)
+            shutil.rmtree(scene['save_dir'], ignore_errors=True)
+            os.mkdir(staging)
+            try:
+                utils.open_compressed(byte_stream=scene['archive'],
+                                      file_format='gz',
+                                      output_folder=staging,
+                                      members=members)
+            except (tarfile.TarError, EOFError, zlib.error):
+                # corrupted archive, the next run downloads it again
+                shutil.rmtree(staging, ignore_errors=True)
+                self.manifest.remove(scene['archive'])
+                self.journal.set(scene['tile_id'], 'searched')
+                os.remove(scene['archive'])
+                raise
+            os.rename(staging, scene['save_dir'])
+            self.journal.set(scene['tile_id'], 'extracted')
+            os.remove(scene['archive'])
+            scene['tile_path'] = scene['save_dir']
+
+        if self.store is not None:
+            self.store.add(scene['tile_id'], os.path.dirname(scene['archive']))
+        return scene
+
+    def process(self, scene):
+        """
+        Stage of the pipeline: load the bands, apply DOS1 and write them with the writer
+        """
+
+        # the output of the whole scene is processed once and shared by the regions through the store
+        output_path = scene['output_path']
+        shared = self.store is not None and not self.crop and self.writer != 'datacube'
+        if shared:
+            output_path = self.store.output_path(scene['tile_id'], writer=self.writer, encoding=self.encoding,
+                                                 latlon=self.latlon)
+
+        # the bands are written to a staging folder renamed once the scene is complete
+        staging = '{}.tmp'.format(output_path)
+        l8 = landsat_utils.landsat(scene['tile_path'], staging, blockwise=self.blockwise,
+                                   aoi=self.coord if self.crop else None,
+                                   encoding=self.encoding, band_workers=self.band_workers,
+                                   latlon=self.latlon, grid_cache=os.path.join(self.path, 'grid_cache'),
+                                   writer=self.writer, datacube=os.path.join(self.path, self.region, 'datacube'),
+                                   region=self.coord)
+
+        if shared and self.store.get(output_path) is not None:
+            metrics.log('Output of {} already in the store'.format(scene['tile_id']))
+        else:
+            shutil.rmtree(staging, ignore_errors=True)
+            os.mkdir(staging)
+            try:
+                l8.load_bands()
+            except Exception:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+
+            # the datacube files are outside of the staging folder and are not counted
+            if metrics.enabled():
+                metrics.add(bytes_written=utils.folder_size(staging))
+
+            # an output left by a previous version without journal is replaced
+            scene_store.remove(output_path)
+            os.rename(staging, output_path)
+            if shared:
+                self.store.add(scene['tile_id'], output_path)
+
+        if shared:
+            self.store.link(output_path, scene['output_path'])
+        self.journal.set(scene['tile_id'], 'processed')
+
+        try:
+            self.catalogue.record(dict(l8.scene_metadata(), region=self.region, output_path=scene['output_path']))
+        except Exception as e:
+            metrics.error('Error recording {} in the catalogue: {}'.format(scene['tile_id'], e))
+        return scene
+
+    def clean(self, scene):
+        """
+        Stage of the pipeline: remove the temporary files of a processed scene
+        """
+
+        # the product stays in the store for the other regions
+        if self.store is not None:
+            self.release(scene)
+            return
+
+        shutil.rmtree(scene['save_dir'], ignore_errors=True)
+        if os.path.isfile(scene['archive']):
+            os.remove(scene['archive'])
+
+    def release(self, scene):
+        """
+        Release the lease of the product of a scene, once it is clean or
+        when a stage fails
+        """
+
+        if 'lease' in scene:
+            scene['lease'].release()
+
+    def scene(self, r):
+        """
+        Paths of a scene found by the search
+        """
+
+        folder = self.path if self.store is None else self.store.product_path(r['entityId'])
+        return {'tile_id': r['entityId'],
+                'output_path': os.path.join(self.path, self.region, r['entityId']),
+                'save_dir': os.path.join(folder, r['entityId']),
+                'archive': os.path.join(folder, '{}.tar.gz'.format(r['entityId']))}
+
+    def footprint(self, r):
+        """
+        Footprint of a scene found by the search (GeoJSON polygon) as a list
+        of rings [(lon, lat), ...], None if it is not given
+        """
+
+        footprint = r.get('spatialFootprint')
+        if not footprint:
+            return None
+        polygons = footprint['coordinates']
+        if footprint.get('type') != 'MultiPolygon':
+            polygons = [polygons]
+        return [[(float(p[0]), float(p[1])) for p in ring] for polygon in polygons for ring in polygon]
+
+    def acquisition_date(self, r):
+        """
+        Date of a scene found by the search (YYYY-MM-DD), None if it is not given
+        """
+        return r.get('acquisitionDate')
+
+    def download(self, results=None):
+        """
+        Download and process the scenes found by the search, or the given
+        search results (eg. of a search shared by several regions)
+        """
+
+        #results of the search, the first scenes start downloading while the next pages arrive
+        if results is None:
+            results = self.search()
+
+        # Make the login (or reuse the cookies of a previous run)
+        self.ers_login()
 
-            print('Downloading {} ...'.format(tile_id))
+        def scenes():
+            for r in results:
+                self.journal.searched(r['entityId'])
+                yield self.scene(r)
 
-            url = 'https://earthexplorer.usgs.gov/download/12864/{}/STANDARD/EE'.format(tile_id)
-            response = self.session.get(url, stream=True, allow_redirects=True)
-            utils.open_compressed(byte_stream=response.raw.read(),
-                                  file_format='gz',
-                                  output_folder=save_dir)
+        # the download of the next scenes overlaps with the processing of the previous ones
+        stages = [('fetch', self.fetch, self.workers),
+                  ('extract', self.unpack, 1),
+                  ('process', self.process, 1),
+                  ('clean', self.clean, 1)]
 
-            l8 = landsat_utils.landsat(save_dir, output_path)
-            l8.load_bands()
-            shutil.rmtree(save_dir)
+        # the work on a product of the store is done by one region at a time
+        if self.store is not None:
+            stages = [(name, self.store.locked(func) if name != 'clean' else func, workers)
+                      for name, func, workers in stages]
+        if self.supervisor is None:
+            pipeline(stages, provider='Landsat8', on_error=self.release).run(scenes())
+        else:
+            pipeline(stages, limits=self.supervisor.limits(threads=self.band_workers), provider='Landsat8',
+                     on_error=self.release,
+                     on_done=lambda stage: self.supervisor.update('Landsat8', stage)).run(scenes())
@@ -33,6 +33,16 @@ platform : str. Satellite to use from the Sentinel family
 producttype : str. Dataset type.
 cloud: int
 path : path
+workers : int. Number of scenes downloaded in parallel
+use_cache : bool. Reuse the results of previous searches
+cache_ttl : int. Seconds a cached search is valid
+extract : str. Members of the archive extracted to disk: 'all', 'bands' or 'none'
+supervisor : supervisor. Shares the CPU and bandwidth budget with other providers
+crop : bool. Only process and save the window of the tile covering the coordinates
+encoding : str or dict. Encoding profile of the netCDF bands: 'legacy', 'deflate', 'int16' or a custom dict
+latlon : bool. Add the 2D longitudes and latitudes of the pixels to the outputs
+writer : str. Output backend of the bands: 'netcdf', 'zarr', 'cog' or 'datacube' (time series of the region)
+store : scene_store. Products and outputs shared by the regions, None to keep them in path
 
 Author: Daniel Garcia Diaz
 Date: Sep 2018
@@ -41,17 +51,31 @@ Date: Sep 2018
 #imports subfunctions
 from sat_modules import utils
 from sat_modules import sentinel_utils
+from sat_modules.search_cache import search_cache
+from sat_modules.pipeline import pipeline
+from sat_modules.session_cache import session_cache, dump_cookies, load_cookies
+from sat_modules.manifest import manifest
+from sat_modules.catalogue import catalogue
+from sat_modules.journal import journal
+from sat_modules import metrics
+from sat_modules import scene_store
 
 #imports apis
 import requests
-import os, shutil
+import os, re, shutil
+import hashlib
+import logging
+import zipfile, zlib
 
 class download_sentinel:
 
     def __init__(self, inidate, enddate, region, coordinates=None, platform='Sentinel-2', producttype="S2MSI1C", cloud=100,
-                 username=None, password=None, path=None):
+                 username=None, password=None, path=None, workers=2,
+                 use_cache=True, cache_ttl=24*3600, extract='all',
+                 supervisor=None, crop=False, encoding='legacy', latlon=False,
+                 writer='netcdf', store=None):
 
-        self.session = requests.Session()
+        self.session = utils.new_session(pool_size=workers + 2)
 
         #Search parameters
         self.inidate = inidate.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -65,29 +89,63 @@ class download_sentinel:
         #work path
         self.path = path
 
+        #number of scenes downloaded at the same time (SciHub allows 2 concurrent downloads per user)
+        self.workers = workers
+
         #ESA APIs
         self.api_url = 'https://scihub.copernicus.eu/apihub/'
+        self.page_size = 100  # maximum number of rows allowed by the API
         self.credentials = {'username':username, 'password':password}
 
-    def search(self, omit_corners=True):
+        #size and checksum of the downloaded archives
+        self.manifest = manifest(os.path.join(path, 'manifest.json'))
 
-        # Post the query to Copernicus
-        query = {'footprint': '"Intersects(POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1})))"'.format(self.coord['W'],
-                                                                                                        self.coord['S'],
-                                                                                                        self.coord['E'],
-                                                                                                        self.coord['N']),
-                 'producttype': self.producttype,
-                 'platformname': self.platform,
-                 'beginposition': '[{} TO {}]'.format(self.inidate, self.enddate),
-                 'cloudcoverpercentage': '[0 TO {}]'.format(self.cloud)
-                 }
+        #metadata of the processed scenes
+        self.catalogue = catalogue(os.path.join(path, 'catalogue.db'))
+
+        #state of the scenes of the region, a re-run only redoes the unfinished work
+        self.journal = journal(os.path.join(path, region, 'journal.db'))
+
+        #budget shared with the other providers
+        self.supervisor = supervisor
+
+        #processing options
+        self.crop = crop
+        self.encoding = encoding
+        self.latlon = latlon
+        self.writer = writer
+
+        #products and outputs shared with the other regions
+        self.store = store
+
+        #members of the archive written to disk: 'all', 'bands' (only the files read) or 'none' (read through /vsizip/)
+        self.extract = extract
+
+        #cache of the search results
+        self.cache = search_cache(os.path.join(path, 'search_cache.db'), ttl=cache_ttl) if use_cache else None
+
+        #the session cookies of a previous run are reused
+        self.sessions = session_cache(os.path.join(path, '.sessions.json'))
+        cookies = self.sessions.load('scihub', username)
+        if cookies is not None:
+            load_cookies(self.session.cookies, cookies)
+
+    def search_page(self, q, start, omit_corners=True):
+        """
+        Request one page of results to Copernicus
+
+        Returns
+        -------
+        results : list of products in the page
+        next_start : offset of the next page, None if this is the last one
+        """
 
         data = {'format': 'json',
-                'start': 0,  # offset
-                'rows': 100,
-                'limit': 100,
+                'start': start,  # offset
+                'rows': self.page_size,
+                'limit': self.page_size,
                 'orderby': '',
-                'q': ' '.join(['{}:{}'.format(k, v) for k, v in query.items()])
+                'q': q
                 }
 
         response = self.session.post(self.api_url + 'search?',
@@ -97,8 +155,12 @@ class download_sentinel:
 
         response.raise_for_status()
 
+        if start == 0:
+            self.sessions.save('scihub', self.credentials['username'], dump_cookies(self.session.cookies), ttl=3600)
+
         # Parse the response
         json_feed = response.json()['feed']
+        total = int(json_feed['opensearch:totalResults'])
 
         if 'entry' in json_feed.keys():
             results = json_feed['entry']
@@ -119,43 +181,296 @@ class download_sentinel:
                 return True
             else:
                 return False
-        results[:] = [r for r in results if keep(r)]
 
-        print('Found {} results'.format(json_feed['opensearch:totalResults']))
-        print('Retrieving {} results'.format(len(results)))
+        if start == 0:
+            metrics.log('Found {} results'.format(total))
 
-        return results
+        next_start = start + self.page_size
+        if not results or next_start >= total:
+            next_start = None
 
+        if omit_corners:
+            results[:] = [r for r in results if keep(r)]
+        metrics.log('Retrieving {} results'.format(len(results)))
 
-    def download(self):
+        return results, next_start
 
-        #results of the search
-        results = self.search()
-        if not isinstance(results, list):
-            results = [results]
-
-        for r in results:
-
-            url, tile_id = r['link'][0]['href'], r['title']
-            print('Downloading {} ...'.format(tile_id))
-
-            output_path = os.path.join(self.path, self.region, tile_id)
-            save_dir = os.path.join(self.path, '{}.SAFE'.format(tile_id))
-
-            if not os.path.isdir(output_path):
-                os.mkdir(output_path)
-            else:
-                print('File already downloaded')
-                continue
-
-            response = self.session.get(url, stream=True, allow_redirects=True, auth=(self.credentials['username'],
-                                                                                      self.credentials['password']))
-
-            utils.open_compressed(byte_stream=response.raw.read(),
-                                  file_format='zip',
-                                  output_folder=self.path)
+    def search(self, omit_corners=True):
+        """
+        Iterate over the products found in Copernicus. The results are
+        requested page by page, the next page is fetched in background
+        while the products of the current one are consumed.
+        """
 
-            #unzip
-            s = sentinel_utils.sentinel(save_dir, output_path)
-            s.load_bands()
-            shutil.rmtree(save_dir)
+        # Post the query to Copernicus
+        query = {'footprint': '"Intersects(POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1})))"'.format(self.coord['W'],
+                                                                                                        self.coord['S'],
+                                                                                                        self.coord['E'],
+                                                                                                        self.coord['N']),
+                 'producttype': self.producttype,
+                 'platformname': self.platform,
+                 'beginposition': '[{} TO {}]'.format(self.inidate, self.enddate),
+                 'cloudcoverpercentage': '[0 TO {}]'.format(self.cloud)
+                 }
+        q = ' '.join(['{}:{}'.format(k, v) for k, v in query.items()])
+
+        results = utils.paginate(lambda start: self.search_page(q, start, omit_corners), 0, provider='Sentinel2')
+
+        if self.cache is None:
+            return results
+        params = {'provider': 'Sentinel', 'platform': self.platform, 'producttype': self.producttype,
+                  'coordinates': self.coord, 'inidate': self.inidate, 'enddate': self.enddate,
+                  'cloud': self.cloud, 'omit_corners': omit_corners}
+        return self.cache.iterate(params, results, footprint=self.footprint, date=self.acquisition_date)
+
+
+    @property
+    def throttle(self):
+        return None if self.supervisor is None else self.supervisor.throttle
+
+    def fetch(self, scene):
+        """
+        Stage of the pipeline: download the archive of a scene
+        """
+
+        state = self.journal.state(scene['tile_id'])
+        if state == 'processed' and os.path.isdir(scene['output_path']):
+            metrics.log('File {} already processed'.format(scene['tile_id']))
+            return None
+
+        #the product is kept in the store while the scene goes through the pipeline
+        if self.store is not None:
+            scene['lease'] = self.store.lease(scene['tile_id'])
+
+        if state == 'extracted' and os.path.isdir(scene['save_dir']):
+            metrics.log('File {} already extracted'.format(scene['tile_id']))
+            return scene
+
+        if self.store is not None:
+            folder = os.path.dirname(scene['archive'])
+            if self.store.get(folder) is not None and os.path.isdir(scene['save_dir']):
+                metrics.log('File {} already in the store'.format(scene['tile_id']))
+                self.journal.set(scene['tile_id'], 'extracted')
+                return scene
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+        metrics.log('Downloading {} ...'.format(scene['tile_id']))
+
+        if self.manifest.is_verified(scene['archive']):
+            metrics.log('Archive {} already verified'.format(scene['tile_id']))
+            self.journal.set(scene['tile_id'], 'downloaded')
+            return scene
+
+        #an interrupted download is resumed from the partial file, the MD5 is computed while downloading
+        expected = self.checksum(scene)
+        for attempt in range(2):
+            md5 = hashlib.md5()
+            _, checked = utils.download_file(self.session, scene['url'], scene['archive'], throttle=self.throttle,
+                                             hasher=md5, auth=(self.credentials['username'], self.credentials['password']))
+            if expected is None or md5.hexdigest() == expected:
+                break
+            metrics.log('Checksum mismatch of {}, downloading it again'.format(scene['tile_id']), level=logging.WARNING)
+            os.remove(scene['archive'])
+        else:
+            raise IOError('Checksum mismatch of {}'.format(scene['archive']))
+
+        self.manifest.record(scene['archive'], md5.hexdigest(), verified=expected is not None or checked)
+        self.journal.set(scene['tile_id'], 'downloaded')
+        return scene
+
+    def checksum(self, scene):
+        """
+        MD5 of a product published by SciHub, None if it is not available
+        """
+
+        url = self.api_url + "odata/v1/Products('{}')/Checksum/Value/$value".format(scene['uuid'])
+        try:
+            response = self.session.get(url, auth=(self.credentials['username'], self.credentials['password']))
+            response.raise_for_status()
+        except requests.RequestException as e:
+            metrics.log('Checksum of {} not available: {}'.format(scene['tile_id'], e), level=logging.WARNING)
+            return None
+        return response.text.strip().lower()
+
+    def unpack(self, scene):
+        """
+        Stage of the pipeline: unzip the archive (or read the bands straight from it)
+        """
+
+        if self.journal.state(scene['tile_id']) == 'extracted' and os.path.isdir(scene['save_dir']):
+            scene['tile_path'] = scene['save_dir']
+        elif self.extract == 'none':
+            scene['tile_path'] = '/vsizip/{}/{}.SAFE'.format(os.path.abspath(scene['archive']), scene['tile_id'])
+        else:
+            #the archive is extracted to a staging folder, the SAFE folder only exists once it is complete
+            members = sentinel_utils.ARCHIVE_MEMBERS if self.extract == 'bands' else None
+            staging = '{}.tmp'.format(scene['save_dir'])
+            shutil.rmtree(staging, ignore_errors=True)
+            shutil.rmtree(scene['save_dir'], ignore_errors=True)
+            try:
+                utils.open_compressed(byte_stream=scene['archive'],
+                                      file_format='zip',
+                                      output_folder=staging,
+                                      members=members)
+            except (zipfile.BadZipFile, EOFError, zlib.error):
+                #corrupted archive, the next run downloads it again
+                shutil.rmtree(staging, ignore_errors=True)
+                self.manifest.remove(scene['archive'])
+                self.journal.set(scene['tile_id'], 'searched')
+                os.remove(scene['archive'])
+                raise
+            os.rename(os.path.join(staging, os.path.basename(scene['save_dir'])), scene['save_dir'])
+            shutil.rmtree(staging)
+            self.journal.set(scene['tile_id'], 'extracted')
+            os.remove(scene['archive'])
+            scene['tile_path'] = scene['save_dir']
+
+        if self.store is not None:
+            self.store.add(scene['tile_id'], os.path.dirname(scene['archive']))
+        return scene
+
+    def process(self, scene):
+        """
+        Stage of the pipeline: load the bands and write them with the writer
+        """
+
+        #the output of the whole tile is processed once and shared by the regions through the store
+        output_path = scene['output_path']
+        shared = self.store is not None and not self.crop and self.writer != 'datacube'
+        if shared:
+            output_path = self.store.output_path(scene['tile_id'], writer=self.writer, encoding=self.encoding,
+                                                 latlon=self.latlon)
+
+        #the bands are written to a staging folder renamed once the scene is complete
+        staging = '{}.tmp'.format(output_path)
+        s = sentinel_utils.sentinel(scene['tile_path'], staging,
+                                    aoi=self.coord if self.crop else None,
+                                    encoding=self.encoding, latlon=self.latlon,
+                                    grid_cache=os.path.join(self.path, 'grid_cache'),
+                                    writer=self.writer, datacube=os.path.join(self.path, self.region, 'datacube'),
+                                    region=self.coord)
+
+        if shared and self.store.get(output_path) is not None:
+            metrics.log('Output of {} already in the store'.format(scene['tile_id']))
+        else:
+            shutil.rmtree(staging, ignore_errors=True)
+            os.mkdir(staging)
+            try:
+                s.load_bands()
+            except Exception:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+
+            #the datacube files are outside of the staging folder and are not counted
+            if metrics.enabled():
+                metrics.add(bytes_written=utils.folder_size(staging))
+
+            #an output left by a previous version without journal is replaced
+            scene_store.remove(output_path)
+            os.rename(staging, output_path)
+            if shared:
+                self.store.add(scene['tile_id'], output_path)
+
+        if shared:
+            self.store.link(output_path, scene['output_path'])
+        self.journal.set(scene['tile_id'], 'processed')
+
+        try:
+            self.catalogue.record(dict(s.scene_metadata(), region=self.region, output_path=scene['output_path']))
+        except Exception as e:
+            metrics.error('Error recording {} in the catalogue: {}'.format(scene['tile_id'], e))
+        return scene
+
+    def clean(self, scene):
+        """
+        Stage of the pipeline: remove the temporary files of a processed scene
+        """
+
+        #the product stays in the store for the other regions
+        if self.store is not None:
+            self.release(scene)
+            return
+
+        shutil.rmtree(scene['save_dir'], ignore_errors=True)
+        if os.path.isfile(scene['archive']):
+            os.remove(scene['archive'])
+
+    def release(self, scene):
+        """
+        Release the lease of the product of a scene, once it is clean or
+        when a stage fails
+        """
+
+        if 'lease' in scene:
+            scene['lease'].release()
+
+    def scene(self, r):
+        """
+        Paths and urls of a product found by the search
+        """
+
+        folder = self.path if self.store is None else self.store.product_path(r['title'])
+        return {'tile_id': r['title'],
+                'url': r['link'][0]['href'],
+                'uuid': r['id'],
+                'output_path': os.path.join(self.path, self.region, r['title']),
+                'save_dir': os.path.join(folder, '{}.SAFE'.format(r['title'])),
+                'archive': os.path.join(folder, '{}.zip'.format(r['title']))}
+
+    def footprint(self, r):
+        """
+        Footprint of a product found by the search (WKT polygon) as a list
+        of rings [(lon, lat), ...], None if it is not given
+        """
+
+        for item in r.get('str', []):
+            if item['name'] == 'footprint':
+                rings = []
+                for ring in re.findall(r'\(([^()]+)\)', item['content']):
+                    values = [float(v) for v in re.findall(r'-?\d+(?:\.\d+)?(?:[eE]-?\d+)?', ring)]
+                    rings.append(list(zip(values[0::2], values[1::2])))
+                return rings
+        return None
+
+    def acquisition_date(self, r):
+        """
+        Sensing start of a product found by the search (eg. 2019-01-01T10:30:00.024Z),
+        None if it is not given
+        """
+
+        for item in r.get('date', []):
+            if item['name'] == 'beginposition':
+                return item['content']
+        return None
+
+    def download(self, results=None):
+        """
+        Download and process the products found by the search, or the given
+        search results (eg. of a search shared by several regions)
+        """
+
+        #results of the search, the first scenes start downloading while the next pages arrive
+        if results is None:
+            results = self.search()
+
+        def scenes():
+            for r in results:
+                self.journal.searched(r['title'])
+                yield self.scene(r)
+
+        #the download of the next scenes overlaps with the processing of the previous ones
+        stages = [('fetch', self.fetch, self.workers),
+                  ('extract', self.unpack, 1),
+                  ('process', self.process, 1),
+                  ('clean', self.clean, 1)]
+
+        #the work on a product of the store is done by one region at a time
+        if self.store is not None:
+            stages = [(name, self.store.locked(func) if name != 'clean' else func, workers)
+                      for name, func, workers in stages]
+        if self.supervisor is None:
+            pipeline(stages, provider='Sentinel2', on_error=self.release).run(scenes())
+        else:
+            pipeline(stages, limits=self.supervisor.limits(), provider='Sentinel2', on_error=self.release,
+                     on_done=lambda stage: self.supervisor.update('Sentinel2', stage)).run(scenes())
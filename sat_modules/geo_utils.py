@@ -0,0 +1,356 @@
+"""
+Georeferencing helpers shared by the Sentinel and Landsat modules
+"""
+
+#APIs
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+
+from osgeo import gdal, osr
+
+
+def lonlat_srs():
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    if hasattr(srs, 'SetAxisMappingStrategy'):  # GDAL >= 3 uses lat/lon order by default
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def raster_srs(projection):
+
+    srs = osr.SpatialReference(wkt=projection)
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def aoi_points(projection, coordinates, density=10):
+    """
+    Projected points of the sides of a lat/lon bounding box, the sides are
+    curved in the raster projection
+    """
+
+    W, S, E, N = coordinates['W'], coordinates['S'], coordinates['E'], coordinates['N']
+    t = np.linspace(0, 1, density)
+    lons = np.concatenate([W + (E - W) * t, W + (E - W) * t, np.full(density, W), np.full(density, E)])
+    lats = np.concatenate([np.full(density, S), np.full(density, N), S + (N - S) * t, S + (N - S) * t])
+
+    ct = osr.CoordinateTransformation(lonlat_srs(), raster_srs(projection))
+    return np.array(ct.TransformPoints(list(zip(lons, lats))))
+
+
+def aoi_bounds(projection, coordinates, density=10):
+    """
+    Projected bounding box (xmin, ymin, xmax, ymax) of a lat/lon bounding box
+    """
+
+    points = aoi_points(projection, coordinates, density)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def aoi_window(geotransform, projection, cols, rows, coordinates, density=10):
+    """
+    Pixel window of a raster covering a lat/lon bounding box
+
+    Parameters
+    ----------
+    geotransform : tuple
+        GDAL geotransform of the raster
+    projection : str
+        WKT of the raster projection
+    cols, rows : int
+        Size of the raster
+    coordinates : dict
+        Bounding box. Example: {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}
+    density : int
+        Points per side of the box, the sides are curved in the raster projection
+
+    Returns
+    -------
+    (xoff, yoff, xsize, ysize) or None if the box is outside the raster
+    """
+
+    points = aoi_points(projection, coordinates, density)
+
+    inv = gdal.InvGeoTransform(geotransform)
+    px = inv[0] + points[:, 0] * inv[1] + points[:, 1] * inv[2]
+    py = inv[3] + points[:, 0] * inv[4] + points[:, 1] * inv[5]
+
+    xoff, xend = max(int(np.floor(px.min())), 0), min(int(np.ceil(px.max())), cols)
+    yoff, yend = max(int(np.floor(py.min())), 0), min(int(np.ceil(py.max())), rows)
+    if xend <= xoff or yend <= yoff:
+        return None
+
+    return xoff, yoff, xend - xoff, yend - yoff
+
+
+def window_geotransform(geotransform, window):
+    """
+    Geotransform of a window (xoff, yoff, xsize, ysize) of a raster
+    """
+
+    xoff, yoff = window[0], window[1]
+    gt = geotransform
+    return (gt[0] + xoff * gt[1] + yoff * gt[2], gt[1], gt[2],
+            gt[3] + xoff * gt[4] + yoff * gt[5], gt[4], gt[5])
+
+
+def projected_axes(geotransform, cols, rows):
+    """
+    Projected x and y of the pixel centres of a north up raster
+    """
+
+    gt = geotransform
+    x = gt[0] + (np.arange(cols) + 0.5) * gt[1]
+    y = gt[3] + (np.arange(rows) + 0.5) * gt[5]
+    return x, y
+
+
+#Nodes per side of the blocks of the lat/lon lattice cache (64 KB each)
+GRID_BLOCK = 64
+
+#Blocks kept in memory by the process
+GRID_MEMORY_BLOCKS = 256
+
+#Maximum size in bytes of the blocks kept in a cache folder
+GRID_CACHE_SIZE = 256 * 1024 ** 2
+
+_blocks = collections.OrderedDict()
+_blocks_lock = threading.Lock()
+
+
+def crs_key(projection):
+    """
+    Identifier of a projection, its EPSG code if it has one (the same CRS can
+    be written with different WKT by the Sentinel and Landsat products)
+    """
+
+    srs = raster_srs(projection)
+    if srs.GetAuthorityCode(None):
+        return '{}:{}'.format(srs.GetAuthorityName(None), srs.GetAuthorityCode(None))
+    return srs.ExportToWkt()
+
+
+def trim_grid_cache(cache_dir, max_size=GRID_CACHE_SIZE):
+    """
+    Remove the least recently used files of a grid cache folder until it fits in max_size
+    """
+
+    files = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            files.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except OSError:
+            pass  # removed by another process
+    total = sum(f[1] for f in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def lattice_block(projection, spacing, bx, by, cache_dir=None):
+    """
+    Longitudes and latitudes of a block of nodes of the lattice of a projection
+
+    The nodes are at x = i * spacing[0], y = j * spacing[1] in the units of
+    the projection, for i in bx * GRID_BLOCK ... (bx + 1) * GRID_BLOCK - 1 and
+    the same for j. The lattice does not depend on the framing of a scene,
+    so all the scenes of a projection and resolution share its blocks.
+
+    Returns
+    -------
+    float64 array (2, GRID_BLOCK, GRID_BLOCK) of longitudes and latitudes, read only
+    """
+
+    key = hashlib.sha1(repr((crs_key(projection), spacing, bx, by)).encode('utf-8')).hexdigest()
+    with _blocks_lock:
+        if key in _blocks:
+            _blocks.move_to_end(key)
+            return _blocks[key]
+
+    block = None
+    if cache_dir is not None:
+        block_path = os.path.join(cache_dir, '{}.npy'.format(key))
+        try:
+            block = np.load(block_path)
+            os.utime(block_path)
+        except (IOError, OSError, ValueError):
+            block = None
+
+    if block is None:
+        nodes = np.arange(GRID_BLOCK)
+        x, y = np.meshgrid((bx * GRID_BLOCK + nodes) * spacing[0], (by * GRID_BLOCK + nodes) * spacing[1])
+        ct = osr.CoordinateTransformation(raster_srs(projection), lonlat_srs())
+        points = np.array(ct.TransformPoints(list(zip(x.ravel(), y.ravel()))))
+        block = np.ascontiguousarray(points[:, :2].T.reshape(2, GRID_BLOCK, GRID_BLOCK))
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(block_path, threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, block)
+            os.replace(tmp_path, block_path)
+            trim_grid_cache(cache_dir)
+
+    block.setflags(write=False)
+    with _blocks_lock:
+        _blocks[key] = block
+        while len(_blocks) > GRID_MEMORY_BLOCKS:
+            _blocks.popitem(last=False)
+    return block
+
+
+def lattice(projection, spacing, x0, x1, y0, y1, cache_dir=None):
+    """
+    Longitudes and latitudes (2, y1 - y0 + 1, x1 - x0 + 1) of the nodes
+    x0 ... x1, y0 ... y1 of the lattice of a projection (see lattice_block)
+    """
+
+    out = np.empty((2, y1 - y0 + 1, x1 - x0 + 1))
+    for by in range(y0 // GRID_BLOCK, y1 // GRID_BLOCK + 1):
+        for bx in range(x0 // GRID_BLOCK, x1 // GRID_BLOCK + 1):
+            block = lattice_block(projection, spacing, bx, by, cache_dir)
+            xa, xb = max(x0, bx * GRID_BLOCK), min(x1, (bx + 1) * GRID_BLOCK - 1)
+            ya, yb = max(y0, by * GRID_BLOCK), min(y1, (by + 1) * GRID_BLOCK - 1)
+            out[:, ya - y0:yb - y0 + 1, xa - x0:xb - x0 + 1] = \
+                block[:, ya - by * GRID_BLOCK:yb - by * GRID_BLOCK + 1, xa - bx * GRID_BLOCK:xb - bx * GRID_BLOCK + 1]
+    return out
+
+
+def lonlat_rows(geotransform, projection, cols, rows, cache_dir=None, step=32, block_rows=256):
+    """
+    Longitudes and latitudes of the pixel centres of a north up raster, by blocks of rows
+
+    The coordinates are transformed exactly on a lattice of the projection
+    every `step` pixels and bilinearly interpolated in between, the error
+    is far below the pixel size for the UTM grids of Sentinel and Landsat.
+    Only the nodes of the lattice are cached, in memory and in cache_dir if
+    given (see lattice_block), so the scenes of the same projection reuse
+    them whatever their framing.
+
+    Yields
+    ------
+    row offset, lons, lats : float32 arrays of shape (block_rows, cols)
+    """
+
+    gt = geotransform
+    if gt[2] or gt[4]:
+        raise ValueError('The lat/lon grids are only available for north up rasters')
+
+    spacing = (step * abs(gt[1]), step * abs(gt[5]))
+    x, y = projected_axes(gt, cols, rows)
+
+    #lattice cell of every column and row and weight of its next node
+    fx, fy = x / spacing[0], y / spacing[1]
+    kx, ky = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+    wx, wy = fx - kx, fy - ky
+    x0, y0 = int(kx.min()), int(ky.min())
+    nodes = lattice(projection, spacing, x0, int(kx.max()) + 1, y0, int(ky.max()) + 1, cache_dir)
+    kx, ky = kx - x0, ky - y0
+
+    for r in range(0, rows, block_rows):
+        j, w = ky[r:r + block_rows], wy[r:r + block_rows, None]
+        grids = []
+        for values in nodes:
+            tmp = values[j] * (1 - w) + values[j + 1] * w
+            grids.append((tmp[:, kx] * (1 - wx) + tmp[:, kx + 1] * wx).astype(np.float32))
+        yield r, grids[0], grids[1]
+
+
+def linear_units(projection):
+
+    srs = raster_srs(projection)
+    return 'm' if srs.GetLinearUnits() == 1. else srs.GetLinearUnitsName()
+
+
+def crs_attributes(geotransform, projection):
+    """
+    CF grid mapping attributes of a raster, plus the WKT and geotransform
+    read by GDAL
+    """
+
+    srs = raster_srs(projection)
+    attrs = {'spatial_ref': projection,
+             'crs_wkt': projection,
+             'GeoTransform': ' '.join(repr(float(v)) for v in geotransform)}
+    if srs.GetAttrValue('PROJECTION') == 'Transverse_Mercator':
+        attrs.update({'grid_mapping_name': 'transverse_mercator',
+                      'longitude_of_central_meridian': srs.GetProjParm(osr.SRS_PP_CENTRAL_MERIDIAN),
+                      'latitude_of_projection_origin': srs.GetProjParm(osr.SRS_PP_LATITUDE_OF_ORIGIN),
+                      'scale_factor_at_central_meridian': srs.GetProjParm(osr.SRS_PP_SCALE_FACTOR),
+                      'false_easting': srs.GetProjParm(osr.SRS_PP_FALSE_EASTING),
+                      'false_northing': srs.GetProjParm(osr.SRS_PP_FALSE_NORTHING)})
+    return attrs
+
+
+def write_coordinates(dsout, coordinates, latlon=False, grid_cache=None):
+    """
+    Write the CF coordinates of a netCDF file: the projected x/y axes of the
+    pixel centres, the grid mapping and optionally the 2D lat/lon grids.
+
+    Parameters
+    ----------
+    dsout : netCDF4.Dataset
+    coordinates : dict
+        geotransform, geoprojection, Xsize and Ysize of the output
+    latlon : bool
+        Add the longitudes and latitudes of the pixel centres
+    grid_cache : str
+        Folder where the lat/lon grids are cached (see lonlat_rows)
+
+    Returns
+    -------
+    dimensions of the band variables
+    """
+
+    gt, projection = coordinates['geotransform'], coordinates['geoprojection']
+    cols, rows = coordinates['Xsize'], coordinates['Ysize']
+    units = linear_units(projection)
+
+    x, y = projected_axes(gt, cols, rows)
+
+    dsout.createDimension('y', rows)
+    dsout.createDimension('x', cols)
+
+    xs = dsout.createVariable('x', 'f8', ('x',))
+    xs.standard_name = 'projection_x_coordinate'
+    xs.long_name = 'x coordinate of projection'
+    xs.units = units
+    xs.axis = 'X'
+    xs[:] = x
+
+    ys = dsout.createVariable('y', 'f8', ('y',))
+    ys.standard_name = 'projection_y_coordinate'
+    ys.long_name = 'y coordinate of projection'
+    ys.units = units
+    ys.axis = 'Y'
+    ys[:] = y
+
+    crs = dsout.createVariable('spatial_ref', 'i4')
+    crs.setncatts(crs_attributes(gt, projection))
+
+    if latlon:
+        longitudes = dsout.createVariable('lon', 'f4', ('y', 'x'), zlib=True)
+        longitudes.standard_name = 'longitude'
+        longitudes.units = 'degrees_east'
+
+        latitudes = dsout.createVariable('lat', 'f4', ('y', 'x'), zlib=True)
+        latitudes.standard_name = 'latitude'
+        latitudes.units = 'degrees_north'
+
+        for r, lons, lats in lonlat_rows(gt, projection, cols, rows, cache_dir=grid_cache):
+            longitudes[r:r + lons.shape[0]] = lons
+            latitudes[r:r + lats.shape[0]] = lats
+
+    return ('y', 'x')
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Journal of the scenes of a region.
+
+Every scene goes through the states of STATES and each state is recorded
+once its work is complete on disk (the archive is verified, the extracted
+folder and the outputs are renamed from their staging folders). A re-run
+only redoes the work after the last recorded state of every scene.
+"""
+
+#APIs
+import os
+import time
+import sqlite3
+import contextlib
+
+
+STATES = ('searched', 'downloaded', 'extracted', 'processed')
+
+
+class journal:
+
+    def __init__(self, db_path):
+        """
+        Parameters
+        ----------
+        db_path : str
+            Path of the SQLite database, one per region
+        """
+
+        self.db_path = db_path
+
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS scenes ('
+                       'scene_id TEXT PRIMARY KEY, state TEXT, updated REAL)')
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        A new connection is used in every call, so the journal can be
+        shared by the pipeline threads. The transaction is committed and
+        the connection closed on exit.
+        """
+        folder = os.path.dirname(self.db_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def state(self, scene_id):
+        """
+        Last state recorded for a scene, None if it is not in the journal
+        """
+
+        with self.connect() as db:
+            row = db.execute('SELECT state FROM scenes WHERE scene_id = ?', (scene_id,)).fetchone()
+        return row[0] if row else None
+
+    def searched(self, scene_id):
+        """
+        Add a scene found by a search, the state of known scenes is kept
+        """
+
+        with self.connect() as db:
+            db.execute('INSERT OR IGNORE INTO scenes VALUES (?, ?, ?)', (scene_id, STATES[0], time.time()))
+
+    def set(self, scene_id, state):
+
+        if state not in STATES:
+            raise ValueError('Unknown state {}. The states are: {}'.format(state, STATES))
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO scenes VALUES (?, ?, ?)', (scene_id, state, time.time()))
+
+    def summary(self):
+        """
+        Number of scenes in every state
+        """
+
+        with self.connect() as db:
+            counts = dict(db.execute('SELECT state, COUNT(*) FROM scenes GROUP BY state').fetchall())
+        return {s: counts.get(s, 0) for s in STATES}
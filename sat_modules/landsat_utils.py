@@ -11,33 +11,69 @@ Email: garciad@ifca.unican.es
 Github: garciadd
 """
 
-from functools import reduce
-import operator
 import os, re
-import shutil
 import numpy as np
-import json
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 from osgeo import gdal, osr
-from netCDF4 import Dataset
 
+from sat_modules import geo_utils
+from sat_modules import writers
+from sat_modules import metrics
 
-#Sub-functions of read_config_file
-def get_by_path(root, items):
+#Members of the tarball needed to load the bands
+ARCHIVE_MEMBERS = r'MTL\.txt$|_B\d+\.TIF$'
+
+
+#Numbers of the MTL files (the same literals accepted by JSON)
+MTL_NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?$')
+
+
+def parse_mtl(lines):
     """
-    Access a nested object in root by item sequence.
-    ref: https://stackoverflow.com/questions/14692690/access-nested-dictionary-items-via-a-list-of-keys
+    Parse the lines of a LandSat MTL file to a nested dict in a single pass.
+    Quoted values are returned as strings without quotes, numbers as int or
+    float and the rest (dates, times) as strings.
     """
-    return reduce(operator.getitem, items, root)
 
+    config = {}
+    stack = [config]
+
+    for line in lines:
+        key, sep, value = line.strip().partition(' = ')
+        if not sep:
+            continue  # END and blank lines
+
+        if key == 'GROUP':
+            group = {}
+            stack[-1][value] = group
+            stack.append(group)
+        elif key == 'END_GROUP':
+            stack.pop()
+        elif value[:1] == '"' and value[-1:] == '"':
+            stack[-1][key] = value[1:-1]
+        elif MTL_NUMBER.match(value):
+            stack[-1][key] = int(value) if value.lstrip('-').isdigit() else float(value)
+        else:
+            stack[-1][key] = value
 
-def set_by_path(root, items, value):
+    return config
+
+
+def read_lines(path):
     """
-    Set a value in a nested object in root by item sequence.
-    ref: https://stackoverflow.com/questions/14692690/access-nested-dictionary-items-via-a-list-of-keys
+    Read the lines of a text file, either a local file or a GDAL virtual
+    path (eg. /vsitar/)
     """
-    get_by_path(root, items[:-1])[items[-1]] = value
+
+    if path.startswith('/vsi'):
+        f = gdal.VSIFOpenL(path, 'rb')
+        data = gdal.VSIFReadL(1, gdal.VSIStatL(path).size, f)
+        gdal.VSIFCloseL(f)
+        return data.decode('utf-8').splitlines()
+
+    with open(path) as f:
+        return f.read().splitlines()
 
 
 def GetExtent(gt,cols,rows):
@@ -65,79 +101,124 @@ def GetExtent(gt,cols,rows):
     return ext
 
 
-class DOS(object):
+class DOS_stack(object):
 
-    def __init__(self, metadata, band, arr_band):
+    def __init__(self, metadata, bands):
         """
-        initialize the variables used to preprocess landsat images
-        and apply DOS1 atmospheric correction
-        """
-
-        self.band = band
-        self.arr_band = arr_band
-        self.name_bands = {'B1': 'BAND_1', 'B2': 'BAND_2', 'B3': 'BAND_3', 'B4': 'BAND_4', 'B5': 'BAND_5', 'B6': 'BAND_6', 'B7': 'BAND_7', 'B8': 'BAND_8', 'B9': 'BAND_9', 'B10': 'BAND_10', 'B11': 'BAND_11'}
-
-        self.metadata = metadata
-
-        self.Tz = 1
-        self.Ed = 0
-        self.Tv = 1
-
-    def sr_radiance(self, arr, min_value):
-
-        Lmin = self.Ml * min_value + self.Al
-        L1 = 0.01 * ((self.Esun * np.cos(self.z * np.pi / 180.) * self.Tz) + self.Ed) * self.Tv / (np.pi * self.d**2)
-        Lp = Lmin - L1
-
-        L = self.Ml * arr + self.Al
-        Lsr = L - Lp
-
-        return Lsr
-
-    def sr_thermal(self, arr):
+        DOS1 atmospheric correction of a (bands, rows, cols) float32 stack.
+        The constants of every band are computed once from the MTL metadata
+        and the stack is corrected in place, with NaN as the only mask.
 
-        L = self.Ml * arr + self.Al
-        Tb = self.k2 / np.log((self.k1 / L) + 1)
-
-        return Tb
-
-    def sr_reflectance(self):
+        For the reflective bands DOS1 reduces to a linear function of the
+        digital number: sr = gain * (DN - DN_min) + 0.01, clipped to [0, 1].
+        """
 
-        name = self.name_bands[self.band]
+        self.bands = bands
+        self.thermal = np.array([b in ('B10', 'B11') for b in bands])
+
+        name = ['BAND_{}'.format(b[1:]) for b in bands]
+        rescaling = metadata['RADIOMETRIC_RESCALING']
+        self.Ml = np.array([float(rescaling['RADIANCE_MULT_{}'.format(n)]) for n in name], dtype=np.float32)
+        self.Al = np.array([float(rescaling['RADIANCE_ADD_{}'.format(n)]) for n in name], dtype=np.float32)
+
+        Tz, Ed, Tv = 1, 0, 1
+        d = float(metadata['IMAGE_ATTRIBUTES']['EARTH_SUN_DISTANCE'])
+        z = 90 - float(metadata['IMAGE_ATTRIBUTES']['SUN_ELEVATION'])
+
+        self.gain = np.zeros(len(bands), dtype=np.float32)
+        self.k1 = np.zeros(len(bands), dtype=np.float32)
+        self.k2 = np.zeros(len(bands), dtype=np.float32)
+        for i, n in enumerate(name):
+            if self.thermal[i]:
+                self.k1[i] = float(metadata['TIRS_THERMAL_CONSTANTS']['K1_CONSTANT_{}'.format(n)])
+                self.k2[i] = float(metadata['TIRS_THERMAL_CONSTANTS']['K2_CONSTANT_{}'.format(n)])
+            else:
+                rad_max = float(metadata['MIN_MAX_RADIANCE']['RADIANCE_MAXIMUM_{}'.format(n)])
+                ref_max = float(metadata['MIN_MAX_REFLECTANCE']['REFLECTANCE_MAXIMUM_{}'.format(n)])
+                Esun = (np.pi * d**2) * rad_max / ref_max
+                self.gain[i] = (np.pi * d**2 * self.Ml[i]) / (((Esun * np.cos(z * np.pi / 180.) * Tz) + Ed) * Tv)
 
-        if self.band=='B10' or self.band=='B11':
+    def correct(self, arr, i, min_value=None):
+        """
+        Correct in place the band i of the stack (or a window of it)
+
+        Parameters
+        ----------
+        arr : float32 array with NaN in the no data pixels
+        i : int
+            Index of the band
+        min_value : float
+            Minimum digital number of the whole band, computed from arr by default
+        """
 
-            self.Ml = float(self.metadata['RADIOMETRIC_RESCALING']['RADIANCE_MULT_{}'.format(name)])
-            self.Al = float(self.metadata['RADIOMETRIC_RESCALING']['RADIANCE_ADD_{}'.format(name)])
-            self.k1 = float(self.metadata['TIRS_THERMAL_CONSTANTS']['K1_CONSTANT_{}'.format(name)])
-            self.k2 = float(self.metadata['TIRS_THERMAL_CONSTANTS']['K2_CONSTANT_{}'.format(name)])
+        if self.thermal[i]:
+            np.multiply(arr, self.Ml[i], out=arr)
+            np.add(arr, self.Al[i], out=arr)
+            np.divide(self.k1[i], arr, out=arr)
+            np.log1p(arr, out=arr)
+            np.divide(self.k2[i], arr, out=arr)
+        else:
+            if min_value is None:
+                min_value = np.nanmin(arr)
+            np.subtract(arr, min_value, out=arr)
+            np.multiply(arr, self.gain[i], out=arr)
+            np.add(arr, 0.01, out=arr)
+            np.clip(arr, 0, 1, out=arr)
 
-            T = self.sr_thermal(self.arr_band)
+        return arr
 
-            return T
+    def correct_stack(self, stack, min_values=None):
+        """
+        Correct in place a (bands, rows, cols) stack
+        """
 
+        if not self.thermal.any():
+            # all the bands at once, the constants are broadcast along the bands
+            if min_values is None:
+                min_values = np.nanmin(stack, axis=(1, 2))
+            np.subtract(stack, np.asarray(min_values, dtype=np.float32)[:, None, None], out=stack)
+            np.multiply(stack, self.gain[:, None, None], out=stack)
+            np.add(stack, 0.01, out=stack)
+            np.clip(stack, 0, 1, out=stack)
         else:
+            for i in range(len(self.bands)):
+                self.correct(stack[i], i, None if min_values is None else min_values[i])
 
-            self.Ml = float(self.metadata['RADIOMETRIC_RESCALING']['RADIANCE_MULT_{}'.format(name)])
-            self.Al = float(self.metadata['RADIOMETRIC_RESCALING']['RADIANCE_ADD_{}'.format(name)])
-            self.rad_max = float(self.metadata['MIN_MAX_RADIANCE']['RADIANCE_MAXIMUM_{}'.format(name)])
-            self.ref_max = float(self.metadata['MIN_MAX_REFLECTANCE']['REFLECTANCE_MAXIMUM_{}'.format(name)])
-            self.d = float(self.metadata['IMAGE_ATTRIBUTES']['EARTH_SUN_DISTANCE'])
-            self.z = 90 - float(self.metadata['IMAGE_ATTRIBUTES']['SUN_ELEVATION'])
-            self.Esun = (np.pi * self.d**2) * self.rad_max / self.ref_max
-
-            min_value = np.amin(self.arr_band)
-            Lsr = self.sr_radiance(self.arr_band, min_value)
-            sr = (np.pi * self.d**2 * Lsr) / (((self.Esun * np.cos(self.z * np.pi / 180.) * self.Tz) + self.Ed) * self.Tv)
-            sr[sr>=1] = 1
-            sr[sr<0] = 0
-
-            return sr
+        return stack
 
 
 class landsat():
 
-    def __init__(self, tile_path, output_path):
+    def __init__(self, tile_path, output_path, blockwise=False, aoi=None, encoding='legacy', band_workers=1,
+                 latlon=False, grid_cache=None, writer='netcdf', datacube=None, region=None):
+        """
+        Parameters
+        ----------
+        tile_path : str
+            Folder of the extracted scene, or the downloaded tarball through
+            GDAL (eg. /vsitar/<archive>.tar.gz)
+        output_path : str
+            Folder where the outputs are saved
+        blockwise : bool
+            Process the bands window by window with bounded memory
+        aoi : dict
+            Bounding box of the region, only its window is read, corrected and saved.
+            Example: {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}
+        encoding : str or dict
+            Encoding profile of the bands (see nc_encoding.ENCODINGS)
+        band_workers : int
+            Number of threads processing the bands of a group in parallel
+        latlon : bool
+            Add the 2D longitudes and latitudes of the pixels to the output
+        grid_cache : str
+            Folder where the lat/lon grids are cached between scenes
+        writer : str
+            Output backend: 'netcdf', 'zarr', 'cog' or 'datacube' (see writers.WRITERS)
+        datacube : str
+            Folder of the datacube files of the region, used by the datacube writer
+        region : dict
+            Bounding box of the region covered by the datacube, used by the datacube writer
+        """
 
         # Bands per resolution (bands should be load always in the same order)
         self.bands = {'Panchromatic_Band': ['B8'],
@@ -159,6 +240,15 @@ class landsat():
 
         self.tile_path = tile_path
         self.output_path = output_path
+        self.blockwise = blockwise
+        self.aoi = aoi
+        self.encoding = encoding
+        self.band_workers = band_workers
+        self.latlon = latlon
+        self.grid_cache = grid_cache
+        self.writer = writer
+        self.datacube = datacube
+        self.region = region
 
     #Read the metadata file of Landsat
     def read_config_file(self):
@@ -167,41 +257,20 @@ class landsat():
         """
 
         # Read config
+        if self.tile_path.startswith('/vsi'):
+            files = gdal.ReadDir(self.tile_path) or []
+        else:
+            files = os.listdir(self.tile_path)
         r = re.compile("^(.*?)MTL.txt$")
-        matches = list(filter(r.match, os.listdir(self.tile_path)))
+        matches = list(filter(r.match, files))
         if matches:
             mtl_path = os.path.join(self.tile_path, matches[0])
         else:
             raise ValueError('No MTL config file found.')
 
-        print('xml_path: {}'.format(mtl_path))
-
-        f = open(mtl_path)
-
-        group_path = []
-        config = {}
-
-        for line in f:
-            line = line.lstrip(' ').rstrip() #remove leading whitespaces and trainling newlines
+        metrics.log('xml_path: {}'.format(mtl_path))
 
-            if line.startswith('GROUP'):
-                group_name = line.split(' = ')[1]
-                group_path.append(group_name)
-                set_by_path(root=config, items=group_path, value={})
-
-            elif line.startswith('END_GROUP'):
-                del group_path[-1]
-
-            elif line.startswith('END'):
-                continue
-
-            else:
-                key, value  = line.split(' = ')
-                try:
-                    set_by_path(root=config, items=group_path + [key], value=json.loads(value))
-                except Exception:
-                    set_by_path(root=config, items=group_path + [key], value=value)
-        f.close()
+        config = parse_mtl(read_lines(mtl_path))
 
         if 'L1_METADATA_FILE' in list(config.keys()):
             config = config['L1_METADATA_FILE']
@@ -211,114 +280,246 @@ class landsat():
             config = None
         return config
 
-    def read_bands(self, tmp_ds):
+    def read_bands(self, tmp_ds, window=None, buf=None):
+        """
+        Read a band (or a window (xoff, yoff, xsize, ysize) of it) as float32
+        replacing the 0's with NaN
 
-        tmp_arr = tmp_ds.GetRasterBand(1).ReadAsArray()
-        tmp_arr = tmp_arr.astype(np.float32)
-        tmp_arr[tmp_arr==0] = np.nan #replace 0's with Nan's
-        tmp_arr = np.ma.masked_where(condition=np.isnan(tmp_arr), a=tmp_arr)
+        Parameters
+        ----------
+        buf : float32 C contiguous array
+            Buffer where the band is read, a new one is allocated by default
+        """
 
-        return tmp_arr
+        xoff, yoff, xsize, ysize = window or (0, 0, tmp_ds.RasterXSize, tmp_ds.RasterYSize)
+        if buf is None:
+            buf = np.empty((ysize, xsize), dtype=np.float32)
+        tmp_ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=buf)
+        buf[buf==0] = np.nan #replace 0's with Nan's
 
-    def get_latslons(self):
+        return buf
 
-        xlow, ylow = (self.coordinates['Corner Coordinates'])[0][1], (self.coordinates['Corner Coordinates'])[0][0]
-        xup, yup = (self.coordinates['Corner Coordinates'])[2][1], (self.coordinates['Corner Coordinates'])[2][0]
+    def read_stack(self, datasets, window=None):
+        """
+        Read the bands of a group (or a window of them) into a (bands, rows, cols) float32 stack
+        """
 
-        lats = np.linspace(ylow, yup, num=self.coordinates['Ysize'])
-        lons = np.linspace(xlow, xup, num=self.coordinates['Xsize'])
+        xsize, ysize = window[2:] if window else (datasets[0].RasterXSize, datasets[0].RasterYSize)
+        stack = np.empty((len(datasets), ysize, xsize), dtype=np.float32)
+        for i, tmp_ds in enumerate(datasets):
+            self.read_bands(tmp_ds, window, buf=stack[i])
 
-        return lats, lons
+        return stack
 
-    def save_netCDF(self, dataset, arr_bands):
+    def create_writer(self, dataset, bands):
+        """
+        Open the output of a dataset (<dataset>.nc, .zarr or .tif, or the
+        datacube of the region) with a variable per band. The caller writes
+        the bands and closes it.
+        """
+
+        path, kwargs = os.path.join(self.output_path, dataset), {}
+        if self.writer == 'datacube':
+            path, kwargs = os.path.join(self.datacube, 'Landsat8_{}'.format(dataset)), \
+                            {'scene': self.scene_metadata(), 'region': self.region}
+        return writers.open_writer(self.writer, path, dataset, self.coordinates,
+                                   [(self.band_desc[dataset][b], b in self.bands['Thermal_bands']) for b in bands],
+                                   encoding=self.encoding, latlon=self.latlon, grid_cache=self.grid_cache, **kwargs)
+
+    def save_bands(self, dataset, arr_bands):
+
+        out = self.create_writer(dataset, list(arr_bands))
+        try:
+            for b in arr_bands:
+                print ('Saving {} ...'.format(self.band_desc[dataset][b]))
+                out.write(self.band_desc[dataset][b], arr_bands[b])
+        finally:
+            out.close()
+
+    def scene_metadata(self):
+        """
+        Metadata of the scene for the catalogue, read from the MTL file
+        """
 
-        #path
-        nc_path = os.path.join(self.output_path, '{}.nc'.format(dataset))
+        if getattr(self, 'metadata', None) is None:
+            self.metadata = self.read_config_file()
+        product = self.metadata['PRODUCT_METADATA']
+        attributes = self.metadata['IMAGE_ATTRIBUTES']
 
-        #latitudes & longitudes arrays
-        lats, lons = self.get_latslons()
+        corners = ('UL', 'UR', 'LR', 'LL', 'UL')
+        footprint = [[product['CORNER_{}_LON_PRODUCT'.format(c)], product['CORNER_{}_LAT_PRODUCT'.format(c)]]
+                     for c in corners]
 
-        # create a file (Dataset object, also the root group).
-        dsout = Dataset(nc_path, 'w', format='NETCDF4')
-        dsout.description = dataset
-        dsout.history = 'Created {}'.format(time.ctime(time.time()))
-        dsout.source = 'netCDF4 python module'
+        return {'scene_id': self.metadata['METADATA_FILE_INFO']['LANDSAT_PRODUCT_ID'],
+                'sensor': 'Landsat8',
+                'tile': '{:03d}{:03d}'.format(int(product['WRS_PATH']), int(product['WRS_ROW'])),
+                'date': '{}T{}'.format(product['DATE_ACQUIRED'], product['SCENE_CENTER_TIME']),
+                'cloud_cover': attributes['CLOUD_COVER'],
+                'sun_elevation': attributes['SUN_ELEVATION'],
+                'sun_azimuth': attributes['SUN_AZIMUTH'],
+                'footprint': footprint}
 
-        # dimensions.
-        lat = dsout.createDimension('lat', len(lats))
-        lon = dsout.createDimension('lon', len(lons))
+    def load_bands(self):
 
-        # variables.
-        latitudes = dsout.createVariable('lat','f4',('lat',))
-        longitudes = dsout.createVariable('lon','f4',('lon',))
+        #the output folder belongs to the caller (eg. the staging folder of process), it is not removed here
+        self.metadata = self.read_config_file()
+        if self.metadata is None:
+            raise ValueError('MTL config file of {} not supported'.format(self.tile_path))
 
-        latitudes.standard_name = 'latitude'
-        latitudes.units = 'm north'
-        latitudes.axis = "Y"
-        latitudes[:] = lats
+        for dataset in self.bands.keys():
 
-        longitudes.standard_name = 'longitude'
-        longitudes.units = 'm east'
-        longitudes.axis = "X"
-        longitudes[:] = lons
+            metrics.log("Loading {} ...".format(dataset))
 
-        for b in arr_bands:
+            if self.blockwise:
+                self.load_bands_blockwise(dataset)
+                continue
 
-            print ('Saving {} ...'.format(self.band_desc[dataset][b]))
+            # Get coordinates (and the window of the region)
+            bands = self.bands[dataset]
+            datasets = [gdal.Open(self.band_path(band)) for band in bands]
+            if not self.get_coordinates(datasets[0]):
+                raise ValueError('The region is outside of the scene {}'.format(self.tile_path))
+
+            # Read dataset bands in GDAL and apply DOS1 to all of them at once
+            with metrics.stage('load_bands', dataset=dataset) as m:
+                dos = DOS_stack(self.metadata, bands)
+                if self.band_workers > 1:
+                    with m.timed('read_dos_seconds'):
+                        stack = self.read_stack_parallel(datasets, dos)
+                else:
+                    with m.timed('read_seconds'):
+                        stack = self.read_stack(datasets, self.window)
+                    with m.timed('dos_seconds'):
+                        stack = dos.correct_stack(stack)
+                self.arr_bands = {band: stack[i] for i, band in enumerate(bands)}
+                m.add(pixels=stack.size)
+
+                with m.timed('write_seconds'):
+                    self.save_bands(dataset, self.arr_bands)
+
+    def read_stack_parallel(self, datasets, dos):
+        """
+        Read and correct the bands of a group in a pool of threads. Every
+        thread fills its own slice of a shared stack; GDAL and NumPy release
+        the GIL while reading and computing, so nothing is copied between workers.
+        """
 
-            band = dsout.createVariable(self.band_desc[dataset][b],
-                                        'f4',
-                                        ('lat', 'lon'),
-                                        least_significant_digit=4,
-                                        fill_value=np.nan
-                                        )
+        xsize, ysize = self.window[2:] if self.window else (datasets[0].RasterXSize, datasets[0].RasterYSize)
+        stack = np.empty((len(datasets), ysize, xsize), dtype=np.float32)
 
-            band[:] = arr_bands[b]
-            band.standard_name = self.band_desc[dataset][b]
-            band.units = 'rad'
-            band.setncattr('grid_mapping', 'spatial_ref')
+        def work(i):
+            self.read_bands(datasets[i], self.window, buf=stack[i])
+            dos.correct(stack[i], i)
 
-        crs = dsout.createVariable('spatial_ref', 'i4')
-        crs.spatial_ref = self.coordinates['geoprojection']
+        with ThreadPoolExecutor(max_workers=self.band_workers) as pool:
+            list(pool.map(work, range(len(datasets))))
 
-        dsout.close()
+        return stack
 
+    def band_path(self, band):
 
-    def load_bands(self):
+        file = self.metadata['METADATA_FILE_INFO']['LANDSAT_PRODUCT_ID']
+        return os.path.join(self.tile_path, '{}_{}.TIF'.format(file, band))
 
-        self.metadata = self.read_config_file()
-        if self.metadata is None:
-            shutil.rmtree(self.output_path)
-            return
-        else:
-            pass
+    def get_coordinates(self, tmp_ds):
+        """
+        Georeferencing of the output. When an area of interest is given only
+        its pixel window is read, self.window is None for the whole scene.
+        Returns False if the area of interest is outside of the scene.
+        """
 
-        for dataset in self.bands.keys():
+        gt = tmp_ds.GetGeoTransform()
+        self.window = None
+        if self.aoi is not None:
+            self.window = geo_utils.aoi_window(gt, tmp_ds.GetProjection(), tmp_ds.RasterXSize, tmp_ds.RasterYSize, self.aoi)
+            if self.window is None:
+                return False
+            gt = geo_utils.window_geotransform(gt, self.window)
+        xsize, ysize = self.window[2:] if self.window else (tmp_ds.RasterXSize, tmp_ds.RasterYSize)
 
-            print("Loading {} ...".format(dataset))
+        self.coordinates = {}
+        self.coordinates['geotransform'] = gt
+        self.coordinates['geoprojection'] = tmp_ds.GetProjection()
 
-            # Read dataset bands in GDAL
-            self.arr_bands = {}
+        self.coordinates['Xsize'] = xsize
+        self.coordinates['Ysize'] = ysize
+        self.coordinates['Corner Coordinates'] = GetExtent(gt, xsize, ysize)
 
-            # Get coordinates
-            self.coordinates = {}
+        return True
 
-            for band in self.bands[dataset]:
+    def block_windows(self, tmp_ds, min_size=512):
+        """
+        Windows (xoff, yoff, xsize, ysize) covering a band (or the window of
+        the region), aligned with the GDAL blocks and grouping them up to at
+        least min_size pixels per side
+        """
 
-                file = self.metadata['METADATA_FILE_INFO']['LANDSAT_PRODUCT_ID']
-                file_path = os.path.join(self.tile_path, '{}_{}.TIF'.format(file, band))
+        x0, y0, cols, rows = self.window or (0, 0, tmp_ds.RasterXSize, tmp_ds.RasterYSize)
+        bx, by = tmp_ds.GetRasterBand(1).GetBlockSize()
+        wx = bx * int(np.ceil(min_size / float(bx)))
+        wy = by * int(np.ceil(min_size / float(by)))
 
-                tmp_ds = gdal.Open(file_path)
-                arr_band = self.read_bands(tmp_ds)
+        for yoff in range(y0 - y0 % wy, y0 + rows, wy):
+            for xoff in range(x0 - x0 % wx, x0 + cols, wx):
+                xstart, ystart = max(xoff, x0), max(yoff, y0)
+                yield xstart, ystart, min(xoff + wx, x0 + cols) - xstart, min(yoff + wy, y0 + rows) - ystart
 
-                dos = DOS(self.metadata, band, arr_band)
-                self.arr_bands[band] = dos.sr_reflectance()
+    def band_minimum(self, tmp_ds, windows):
+        """
+        Minimum non zero value of a band, read window by window
+        """
 
-            self.coordinates['geotransform'] = tmp_ds.GetGeoTransform()
-            self.coordinates['geoprojection'] = tmp_ds.GetProjection()
+        min_value = None
+        for window in windows:
+            arr = tmp_ds.GetRasterBand(1).ReadAsArray(*window)
+            arr = arr[arr != 0]
+            if arr.size:
+                min_value = arr.min() if min_value is None else min(min_value, arr.min())
+        return min_value
 
-            self.coordinates['Xsize'] = tmp_ds.RasterXSize
-            self.coordinates['Ysize'] = tmp_ds.RasterYSize
-            self.coordinates['Corner Coordinates'] = GetExtent(tmp_ds.GetGeoTransform(), tmp_ds.RasterXSize, tmp_ds.RasterYSize)
+    def load_bands_blockwise(self, dataset):
+        """
+        Apply DOS1 window by window and write each window to the output as
+        it goes, so only a few blocks are held in memory
+        """
 
-            self.save_netCDF(dataset, self.arr_bands)
+        bands = self.bands[dataset]
+        if not self.get_coordinates(gdal.Open(self.band_path(bands[0]))):
+            raise ValueError('The region is outside of the scene {}'.format(self.tile_path))
+        x0, y0 = self.window[:2] if self.window else (0, 0)
+        out = self.create_writer(dataset, bands)
+        dos = DOS_stack(self.metadata, bands)
+
+        # the workers add their times to the stage of the dataset (the threads do not inherit it)
+        m = metrics.stage('load_bands', dataset=dataset, blockwise=True)
+
+        def work(i):
+
+            band = bands[i]
+            print ('Saving {} ...'.format(self.band_desc[dataset][band]))
+
+            tmp_ds = gdal.Open(self.band_path(band))
+            windows = list(self.block_windows(tmp_ds))
+
+            # the path radiance of DOS1 needs the minimum of the whole band (or region)
+            with m.timed('read_seconds'):
+                min_value = None if dos.thermal[i] else self.band_minimum(tmp_ds, windows)
+
+            # a single buffer is reused for all the windows
+            buf = np.empty(max(w[2] * w[3] for w in windows), dtype=np.float32)
+            for xoff, yoff, xsize, ysize in windows:
+                with m.timed('read_seconds'):
+                    arr_band = self.read_bands(tmp_ds, (xoff, yoff, xsize, ysize), buf[:xsize * ysize].reshape(ysize, xsize))
+                with m.timed('dos_seconds'):
+                    arr_band = dos.correct(arr_band, i, min_value)
+                with m.timed('write_seconds'):
+                    out.write(self.band_desc[dataset][band], arr_band, (xoff - x0, yoff - y0, xsize, ysize))
+                m.add(pixels=arr_band.size)
+
+        with m:
+            try:
+                with ThreadPoolExecutor(max_workers=self.band_workers) as pool:
+                    list(pool.map(work, range(len(bands))))
+            finally:
+                with m.timed('write_seconds'):
+                    out.close()
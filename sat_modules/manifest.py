@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Manifest of the downloaded archives with their size and checksum.
+
+An archive listed as verified whose size on disk still matches is never
+downloaded again, an archive whose size or checksum does not match is
+downloaded again.
+"""
+
+#APIs
+import os
+import json
+import time
+import threading
+
+
+class manifest:
+
+    # shared by all the instances, the providers may write the same file at the same time
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the JSON manifest
+        """
+
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write(self, entries):
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump(entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, archive):
+        with self.lock:
+            return self.read().get(os.path.basename(archive))
+
+    def record(self, archive, md5, verified):
+        """
+        Save the size and checksum of a downloaded archive
+
+        Parameters
+        ----------
+        archive : str
+            Path of the archive
+        md5 : str
+            Checksum computed while downloading
+        verified : bool
+            The checksum or size has been checked against the provider
+        """
+
+        with self.lock:
+            entries = self.read()
+            entries[os.path.basename(archive)] = {'size': os.path.getsize(archive),
+                                                  'md5': md5,
+                                                  'verified': verified,
+                                                  'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+            self.write(entries)
+
+    def remove(self, archive):
+        with self.lock:
+            entries = self.read()
+            if entries.pop(os.path.basename(archive), None) is not None:
+                self.write(entries)
+
+    def is_verified(self, archive):
+        """
+        Check if an archive on disk is complete and verified
+        """
+
+        entry = self.get(archive)
+        return (entry is not None and entry['verified'] and os.path.isfile(archive)
+                and os.path.getsize(archive) == entry['size'])
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Timings and counters of the stages of the service.
+
+Every stage (search, fetch, extract, process, ...) is measured with
+
+    with metrics.stage('fetch', provider='Sentinel2', scene=tile_id) as m:
+        ...
+        m.add(bytes_transferred=n)
+        with m.timed('write_seconds'):
+            ...
+
+A stage opened inside another one in the same thread is named after its
+parent (eg. process.load_bands) and inherits its provider and scene, and
+metrics.add() adds counters to the innermost stage of the thread. When a
+stage ends its duration, counters, status and the memory of the process
+(current and peak RSS) are emitted as:
+
+jsonl : one JSON line per stage and scene
+prometheus : totals per stage and provider in a textfile for the node
+    exporter textfile collector, rewritten at most every `interval` seconds
+
+The metrics are disabled until configure() is called, then stage() returns
+a shared object doing nothing.
+
+The progress and error messages of the service go through log() and
+error(): they are printed by the 'sat_modules' logger and, in the JSON lines,
+recorded as events with the labels of the stage in progress in the thread
+(the Prometheus textfile counts them by level).
+"""
+
+#APIs
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import resource
+import threading
+
+FORMATS = ('jsonl', 'prometheus')
+
+_local = threading.local()
+
+#Messages of the service, printed to stdout unless the application configures the logger
+logger = logging.getLogger('sat_modules')
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def rss_mb():
+    """
+    Current resident memory of the process, None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024. ** 2
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class _noop:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+    def timed(self, key):
+        return self
+
+
+NOOP = _noop()
+
+
+class _timer:
+
+    def __init__(self, stage, key):
+        self.stage = stage
+        self.key = key
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stage.add(**{self.key: time.time() - self.t0})
+        return False
+
+
+class _stage:
+
+    def __init__(self, recorder, name, labels):
+
+        self.recorder = recorder
+        self.name = name
+        self.labels = labels
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+
+        stack = _local.__dict__.setdefault('stack', [])
+        if stack:
+            parent = stack[-1]
+            self.name = '{}.{}'.format(parent.name, self.name)
+            self.labels = dict(parent.labels, **self.labels)
+        stack.append(self)
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+
+        seconds = time.time() - self.t0
+        _local.stack.remove(self)
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                  'stage': self.name,
+                  'status': 'error' if exc_type else 'ok',
+                  'seconds': seconds,
+                  'rss_mb': rss_mb(),
+                  'peak_rss_mb': peak_rss_mb()}
+        record.update(self.labels)
+        record.update(self.counters)
+        self.recorder.emit(record, counters=['seconds'] + list(self.counters))
+        return False
+
+    def add(self, **counters):
+        """
+        Add to the counters of the stage, can be called from other threads
+        """
+        with self.lock:
+            for k, v in counters.items():
+                self.counters[k] = self.counters.get(k, 0) + v
+
+    def timed(self, key):
+        """
+        Context adding its duration to the counter `key` (eg. 'write_seconds')
+        """
+        return _timer(self, key)
+
+
+class recorder:
+
+    def __init__(self, path, format='jsonl', interval=10):
+        """
+        Parameters
+        ----------
+        path : str
+            File of the metrics. The JSON lines are appended, the Prometheus
+            textfile is replaced.
+        format : str
+            'jsonl' or 'prometheus'
+        interval : int
+            Minimum seconds between two writes of the Prometheus textfile
+        """
+
+        if format not in FORMATS:
+            raise ValueError('Unknown metrics format {}. The formats are: {}'.format(format, FORMATS))
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.messages = {}
+        self.last_write = 0
+
+    def emit(self, record, counters=()):
+        """
+        Write the record of a stage, `counters` are the keys summed in the
+        Prometheus totals (the rest are labels)
+        """
+
+        with self.lock:
+            if self.format == 'jsonl':
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                return
+
+            # totals per stage and provider, the scenes would make too many series
+            key = (record['stage'], record.get('provider') or '')
+            totals = self.totals.setdefault(key, {'runs': 0, 'errors': 0})
+            totals['runs'] += 1
+            totals['errors'] += record['status'] == 'error'
+            for k in counters:
+                totals[k] = totals.get(k, 0) + record[k]
+            if time.time() - self.last_write >= self.interval:
+                self.write_textfile()
+
+    def event(self, record):
+        """
+        Write a message of log(), only counted by level in the Prometheus textfile
+        """
+
+        with self.lock:
+            if self.format == 'jsonl':
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            else:
+                self.messages[record['level']] = self.messages.get(record['level'], 0) + 1
+
+    def write_textfile(self):
+
+        lines = []
+        names = sorted({k for totals in self.totals.values() for k in totals})
+        for name in names:
+            metric = 'sat_stage_{}_total'.format(name)
+            lines.append('# TYPE {} counter'.format(metric))
+            for (stage, provider), totals in sorted(self.totals.items()):
+                if name in totals:
+                    lines.append('{}{{stage="{}",provider="{}"}} {}'.format(metric, stage, provider, totals[name]))
+        if self.messages:
+            lines.append('# TYPE sat_log_messages_total counter')
+            for level, n in sorted(self.messages.items()):
+                lines.append('sat_log_messages_total{{level="{}"}} {}'.format(level, n))
+        lines.append('# TYPE sat_peak_rss_bytes gauge')
+        lines.append('sat_peak_rss_bytes {}'.format(int(peak_rss_mb() * 1024 ** 2)))
+
+        # the collector must never read a half written file
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.path)
+        self.last_write = time.time()
+
+    def flush(self):
+
+        if self.format == 'prometheus':
+            with self.lock:
+                self.write_textfile()
+
+
+_recorder = None
+
+
+def configure(path=None, format=None, interval=10):
+    """
+    Enable the metrics, or disable them if `path` is None
+
+    Parameters
+    ----------
+    path : str
+        File of the metrics
+    format : str
+        'jsonl' or 'prometheus', by default 'prometheus' for the .prom files
+        and 'jsonl' otherwise
+    interval : int
+        Minimum seconds between two writes of the Prometheus textfile
+    """
+
+    global _recorder
+    if _recorder is not None:
+        _recorder.flush()
+    if path is None:
+        _recorder = None
+        return None
+    if format is None:
+        format = 'prometheus' if path.endswith('.prom') else 'jsonl'
+    _recorder = recorder(path, format=format, interval=interval)
+    return _recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name, **labels):
+    """
+    Context measuring a stage, labels are eg. provider, scene or dataset
+    """
+
+    if _recorder is None:
+        return NOOP
+    return _stage(_recorder, name, labels)
+
+
+def add(**counters):
+    """
+    Add to the counters of the innermost stage of the current thread
+    """
+
+    if _recorder is None:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].add(**counters)
+
+
+def log(message, level=logging.INFO, **labels):
+    """
+    Log a progress message of the service
+
+    Parameters
+    ----------
+    message : str
+    level : int
+        logging level of the message
+    labels : dict
+        Added to the labels of the innermost stage of the thread in the event record
+    """
+
+    logger.log(level, message)
+    if _recorder is None:
+        return
+
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'level': logging.getLevelName(level).lower(),
+              'message': message}
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        record['stage'] = stack[-1].name
+        record.update(stack[-1].labels)
+    record.update(labels)
+    _recorder.event(record)
+
+
+def error(message, **labels):
+    """
+    Log an error of the service, eg. a scene that failed (see log)
+    """
+    log(message, level=logging.ERROR, **labels)
+
+
+def flush():
+    if _recorder is not None:
+        _recorder.flush()
+
+
+atexit.register(flush)
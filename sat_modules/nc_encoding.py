@@ -0,0 +1,139 @@
+"""
+Encoding profiles of the band variables of the output files
+
+Profiles
+--------
+legacy : float32 quantized to 4 decimals, no compression (previous output)
+deflate : float32 with zlib and shuffle, chunked in spatial tiles
+int16 : reflectance packed in int16 with scale_factor/add_offset, zlib and
+    shuffle, chunked in spatial tiles
+
+A custom profile can be given as a dict with the same keys.
+"""
+
+#APIs
+import threading
+import numpy as np
+
+#netCDF-C and HDF5 are not thread safe. Every open, write and close of a
+#netCDF file (writers.netcdf_writer, datacube) holds this lock, whatever the
+#provider or band thread doing it
+NETCDF_LOCK = threading.RLock()
+
+
+ENCODINGS = {'legacy': {'datatype': 'f4',
+                        'least_significant_digit': 4},
+             'deflate': {'datatype': 'f4',
+                         'zlib': True,
+                         'complevel': 4,
+                         'shuffle': True,
+                         'chunksizes': (256, 256)},
+             'int16': {'datatype': 'i2',
+                       'zlib': True,
+                       'complevel': 4,
+                       'shuffle': True,
+                       'chunksizes': (256, 256),
+                       'scale_factor': 1e-4,
+                       'add_offset': 0.,
+                       # brightness temperature in Kelvin
+                       'thermal': {'scale_factor': 1e-2, 'add_offset': 273.15}}
+             }
+
+FILL_VALUES = {'f4': np.nan, 'f8': np.nan, 'i2': -32768, 'i4': -2147483648}
+
+
+def variable_encoding(encoding, shape, thermal=False):
+    """
+    Arguments of netCDF4 createVariable and packing attributes of a band
+
+    Parameters
+    ----------
+    encoding : str or dict
+        Name of a profile of ENCODINGS or a custom profile
+    shape : tuple
+        Shape of the variable, the chunks are clipped to it
+    thermal : bool
+        The band is a brightness temperature instead of a reflectance
+
+    Returns
+    -------
+    datatype : str
+    kwargs : dict
+        Keyword arguments of createVariable
+    attrs : dict
+        scale_factor and add_offset of the packed profiles
+    """
+
+    if isinstance(encoding, dict):
+        profile = dict(encoding)
+    elif encoding in ENCODINGS:
+        profile = dict(ENCODINGS[encoding])
+    else:
+        raise ValueError('Unknown encoding {}. The available encodings are: {}'.format(encoding, list(ENCODINGS)))
+
+    thermal_packing = profile.pop('thermal', {})
+    datatype = profile.pop('datatype', 'f4')
+
+    attrs = {}
+    for k in ('scale_factor', 'add_offset'):
+        if k in profile:
+            attrs[k] = profile.pop(k)
+    if thermal and attrs:
+        attrs.update(thermal_packing)
+
+    if profile.get('chunksizes') is not None:
+        profile['chunksizes'] = tuple(min(c, s) for c, s in zip(profile['chunksizes'], shape))
+
+    profile.setdefault('fill_value', FILL_VALUES.get(datatype))
+
+    return datatype, profile, attrs
+
+
+def prepare(var, arr):
+    """
+    Prepare the data written to a band variable. NaN's are masked for the
+    integer variables, so they are stored as the fill value, and the values
+    are clipped to the packable range like pack() does, netCDF4 would wrap
+    them around (eg. saturated pixels).
+    """
+
+    if np.issubdtype(var.dtype, np.integer):
+        mask = np.isnan(arr)
+        scale_factor = getattr(var, 'scale_factor', 1.)
+        add_offset = getattr(var, 'add_offset', 0.)
+        info = np.iinfo(var.dtype)
+        data = np.clip(np.where(mask, 0, arr), (info.min + 1) * scale_factor + add_offset,
+                       info.max * scale_factor + add_offset)
+        return np.ma.array(data, mask=mask)
+    return arr
+
+
+def pack(arr, datatype, attrs, fill_value=None, least_significant_digit=None):
+    """
+    Values of a band as stored by the writers without automatic packing
+    (zarr, GeoTIFF), the same transformation netCDF4 applies on write.
+
+    Parameters
+    ----------
+    arr : float array
+    datatype : str
+    attrs : dict
+        scale_factor and add_offset of the packed profiles
+    fill_value : number
+        Value of the NaN's in integer datatypes
+    least_significant_digit : int
+        Decimal digits kept by the quantization of the float profiles
+    """
+
+    if np.issubdtype(np.dtype(datatype), np.integer):
+        mask = np.isnan(arr)
+        packed = (np.where(mask, 0, arr) - attrs.get('add_offset', 0.)) / attrs.get('scale_factor', 1.)
+        info = np.iinfo(datatype)
+        np.clip(np.round(packed), info.min + 1, info.max, out=packed)
+        packed[mask] = fill_value
+        return packed.astype(datatype)
+
+    if least_significant_digit is not None:
+        scale = 2. ** np.ceil(np.log2(10. ** least_significant_digit))
+        return (np.around(arr * scale) / scale).astype(datatype)
+    return arr.astype(datatype, copy=False)
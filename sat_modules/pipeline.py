@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Producer-consumer pipeline used to overlap the download of a scene with
+the processing of the previous ones.
+
+Each stage runs in its own pool of threads and the stages are connected by
+bounded queues, so a fast stage waits for the slower ones instead of piling
+up gigabytes of archives on disk.
+"""
+
+#APIs
+import threading
+import queue
+
+from sat_modules import metrics
+
+#Marks the end of the input of a stage
+STOP = object()
+
+
+class pipeline:
+
+    def __init__(self, stages, maxsize=2, limits=None, on_done=None, provider=None, on_error=None):
+        """
+        Parameters
+        ----------
+        stages : list of (name, function, workers)
+            function(item) returns the item passed to the next stage, or
+            None to drop it (eg. a scene already processed)
+        maxsize : int
+            Number of items waiting between two stages
+        limits : dict
+            Semaphore shared with other pipelines for some stages, eg. to
+            limit the scenes processed at the same time by all the providers
+        on_done : callable
+            on_done(stage) is called every time an item goes through a stage
+        provider : str
+            Label of the stage metrics (see metrics)
+        on_error : callable
+            on_error(item) is called when a stage fails on an item, which
+            leaves the pipeline, eg. to release what it holds
+        """
+
+        self.stages = stages
+        self.maxsize = maxsize
+        self.limits = limits or {}
+        self.on_done = on_done
+        self.provider = provider
+        self.on_error = on_error
+
+    def worker(self, name, func, q_in, q_out):
+
+        while True:
+            item = q_in.get()
+            if item is STOP:
+                return
+            try:
+                with metrics.stage(name, provider=self.provider, scene=item.get('tile_id')):
+                    if name in self.limits:
+                        with self.limits[name]:
+                            item = func(item)
+                    else:
+                        item = func(item)
+            except Exception as e:
+                # a failed scene does not abort the others
+                metrics.error('Error in stage {} of {}: {}'.format(name, item.get('tile_id', item), e))
+                if self.on_error is not None:
+                    try:
+                        self.on_error(item)
+                    except Exception as e:
+                        metrics.error('Error releasing {}: {}'.format(item.get('tile_id', item), e))
+                continue
+            if self.on_done is not None:
+                self.on_done(name)
+            if item is not None and q_out is not None:
+                q_out.put(item)
+
+    def run(self, items):
+        """
+        Feed the items to the first stage and wait until all of them have
+        gone through the pipeline
+        """
+
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages]
+        threads = []
+        for i, (name, func, workers) in enumerate(self.stages):
+            q_out = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append([threading.Thread(target=self.worker, args=(name, func, queues[i], q_out), daemon=True)
+                            for _ in range(workers)])
+            for t in threads[-1]:
+                t.start()
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            # close the stages in order once the previous one is empty
+            for q, stage_threads in zip(queues, threads):
+                for _ in stage_threads:
+                    q.put(STOP)
+                for t in stage_threads:
+                    t.join()
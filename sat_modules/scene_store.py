@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Store of products and outputs shared by all the regions.
+
+Neighbouring regions are covered by the same Sentinel-2 tiles and Landsat
+path/rows. The store keeps every product once, keyed by its identifier, so
+a region reuses the product downloaded for another one:
+
+products/<product_id>/ : archive of the product, or the product extracted from it
+outputs/<product_id>_<options>/ : outputs of the whole tile, keyed by the
+    product and the processing options (writer, encoding, ...)
+
+The output of a region is a symbolic link to the output of the whole tile,
+or the window of the region processed from the stored product (crop). The
+links are recorded, and an output is kept while a region links to it.
+
+The entries are indexed in a SQLite database with their size and last use,
+and the least recently used ones are removed when the store is larger than
+`max_size`. The processes working on a product hold a lease (shared lock)
+and the entries of leased products are never removed. The work on a
+product (download, extraction, processing) is serialized between threads
+and processes with an exclusive lock per product.
+"""
+
+#APIs
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import contextlib
+import hashlib
+
+from sat_modules import metrics
+
+
+def remove(path):
+    """
+    Remove a file, folder or symbolic link
+    """
+
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def entry_size(path):
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+
+class _flock:
+
+    def __init__(self, path, mode):
+        self.f = open(path, 'a')
+        try:
+            fcntl.flock(self.f, mode)
+        except (IOError, OSError):
+            self.f.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    def release(self):
+        if not self.f.closed:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+
+
+class scene_store:
+
+    def __init__(self, root, max_size=None):
+        """
+        Parameters
+        ----------
+        root : str
+            Folder of the store
+        max_size : float
+            Maximum size in bytes of the entries, None for no limit
+        """
+
+        self.root = root
+        self.max_size = max_size
+        self.db_path = os.path.join(root, 'store.db')
+
+        for folder in ('products', 'outputs', 'locks'):
+            if not os.path.isdir(os.path.join(root, folder)):
+                os.makedirs(os.path.join(root, folder))
+
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'key TEXT PRIMARY KEY, product_id TEXT, size INTEGER, last_used REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            db.execute('CREATE TABLE IF NOT EXISTS links (path TEXT PRIMARY KEY, key TEXT)')
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        A new connection is used in every call, so the store can be
+        shared by the pipeline threads. The transaction is committed and
+        the connection closed on exit.
+        """
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def product_path(self, product_id):
+        return os.path.join(self.root, 'products', product_id)
+
+    def output_path(self, product_id, **options):
+        """
+        Folder of the outputs of the whole tile of a product processed with
+        some options (eg. writer, encoding, latlon)
+        """
+
+        key = hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.root, 'outputs', '{}_{}'.format(product_id, key))
+
+    def lock(self, product_id):
+        """
+        Exclusive lock of the work on a product
+        """
+        return _flock(os.path.join(self.root, 'locks', '{}.lock'.format(product_id)), fcntl.LOCK_EX)
+
+    def lease(self, product_id):
+        """
+        Shared lock keeping the entries of a product in the store until it is released
+        """
+        return _flock(os.path.join(self.root, 'locks', '{}.lease'.format(product_id)), fcntl.LOCK_SH)
+
+    def locked(self, func):
+        """
+        Stage of a pipeline running under the lock of the product of the scene
+        """
+
+        def stage(scene):
+            with self.lock(scene['tile_id']):
+                return func(scene)
+        return stage
+
+    def get(self, path):
+        """
+        Path of an entry if it is in the store, its last use is updated
+        """
+
+        with self.connect() as db:
+            found = db.execute('UPDATE entries SET last_used = ? WHERE key = ?',
+                               (time.time(), os.path.relpath(path, self.root))).rowcount
+        if found and os.path.exists(path):
+            return path
+        return None
+
+    def add(self, product_id, path):
+        """
+        Add (or update) a complete entry of a product and remove the least
+        recently used entries if the store is too large
+        """
+
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                       (os.path.relpath(path, self.root), product_id, entry_size(path), time.time()))
+        self.evict()
+
+    def link(self, path, link_path):
+        """
+        Point `link_path` (eg. the output of a region) to an entry
+        """
+
+        remove(link_path)
+        os.symlink(os.path.abspath(path), link_path)
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO links VALUES (?, ?)',
+                       (os.path.abspath(link_path), os.path.relpath(path, self.root)))
+
+    def linked(self, key):
+        """
+        Check if a region links to an entry, the links removed or replaced
+        since they were made are forgotten
+        """
+
+        target = os.path.abspath(os.path.join(self.root, key))
+        with self.connect() as db:
+            links = [row[0] for row in db.execute('SELECT path FROM links WHERE key = ?', (key,))]
+        live = [p for p in links if os.path.islink(p) and os.readlink(p) == target]
+        if len(live) < len(links):
+            with self.connect() as db:
+                db.executemany('DELETE FROM links WHERE path = ?', [(p,) for p in links if p not in live])
+        return bool(live)
+
+    def size(self):
+
+        with self.connect() as db:
+            return db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the store fits in
+        max_size, the entries of leased products and the outputs linked by
+        the regions are kept
+        """
+
+        if self.max_size is None:
+            return
+
+        with self.connect() as db:
+            entries = db.execute('SELECT key, product_id, size FROM entries ORDER BY last_used').fetchall()
+        total = sum(e[2] for e in entries)
+
+        for key, product_id, size in entries:
+            if total <= self.max_size:
+                break
+            try:
+                lease = _flock(os.path.join(self.root, 'locks', '{}.lease'.format(product_id)),
+                               fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                continue  # in use
+            try:
+                if self.linked(key):
+                    continue
+                metrics.log('Removing {} from the store'.format(key))
+                with self.connect() as db:
+                    db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                remove(os.path.join(self.root, key))
+                total -= size
+            finally:
+                lease.release()
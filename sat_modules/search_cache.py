@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Local cache of the catalogue searches, so repeated jobs over the same
+query do not need to wait for Copernicus or EarthExplorer.
+
+The results are stored in a SQLite database keyed by the query parameters
+(provider, product type, bounding box, date window and cloud threshold).
+A query is also answered from a cached search with the same parameters
+whose bounding box and date window contain the ones of the query (eg. a
+region inside a larger one, or a month of a cached year), keeping the
+products whose footprint polygon intersects the bounding box of the query
+and whose date falls in its window.
+Entries older than `ttl` seconds are discarded and the least recently used
+entries are evicted when the stored results exceed `max_size` bytes.
+"""
+
+#APIs
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import contextlib
+
+from sat_modules import metrics
+
+
+def segment_crosses_box(x0, y0, x1, y1, box):
+    """
+    Whether the segment (x0, y0) - (x1, y1) has a point inside a bounding box (Liang-Barsky clipping)
+    """
+
+    t0, t1 = 0., 1.
+    dx, dy = x1 - x0, y1 - y0
+    for p, q in ((-dx, x0 - box['W']), (dx, box['E'] - x0), (-dy, y0 - box['S']), (dy, box['N'] - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            t0 = max(t0, q / p)
+        else:
+            t1 = min(t1, q / p)
+        if t0 > t1:
+            return False
+    return True
+
+
+def point_in_ring(x, y, ring):
+    """
+    Whether a point is inside a polygon ring (ray casting)
+    """
+
+    inside = False
+    for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]):
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+    return inside
+
+
+def footprint_intersects(footprint, box):
+    """
+    Whether a footprint intersects a bounding box
+
+    Parameters
+    ----------
+    footprint : list
+        Rings [(lon, lat), ...] of the footprint polygons, the holes are ignored
+    box : dict
+        Bounding box. Example: {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}
+    """
+
+    for ring in footprint:
+        ring = list(ring)
+        # an edge of the ring in the box, or the box inside the ring
+        if any(segment_crosses_box(x0, y0, x1, y1, box)
+               for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1])):
+            return True
+        if point_in_ring(box['W'], box['S'], ring):
+            return True
+    return False
+
+
+class search_cache:
+
+    def __init__(self, db_path, ttl=24*3600, max_size=50*1024*1024):
+        """
+        Parameters
+        ----------
+        db_path : str
+            Path of the SQLite database
+        ttl : int
+            Seconds a search result is considered valid
+        max_size : int
+            Maximum size in bytes of the stored results
+        """
+
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # query key (see query_key), bounding box and date window of every search, to find those containing a query
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS searches ('
+                       'key TEXT PRIMARY KEY, params TEXT, results TEXT, '
+                       'size INTEGER, created REAL, accessed REAL, '
+                       'query TEXT, W REAL, S REAL, E REAL, N REAL, inidate TEXT, enddate TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS searches_accessed ON searches (accessed)')
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        A new connection is used in every call, so the cache can be shared
+        by the download threads. The transaction is committed and the
+        connection closed on exit.
+        """
+        folder = os.path.dirname(self.db_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def key(params):
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def query_key(cls, params):
+        """
+        Key of the parameters other than the bounding box and date window
+        """
+        return cls.key({k: v for k, v in params.items() if k not in ('coordinates', 'inidate', 'enddate')})
+
+    def get(self, params):
+        """
+        Return the cached results of a query or None if they are not cached
+        or expired
+        """
+
+        key, now = self.key(params), time.time()
+        with self.connect() as db:
+            row = db.execute('SELECT results, created FROM searches WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                db.execute('DELETE FROM searches WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE searches SET accessed = ? WHERE key = ?', (now, key))
+
+        return json.loads(row[0])
+
+    def get_containing(self, params, footprint, date):
+        """
+        Return the results of a cached search containing the query, filtered
+        to its bounding box and date window, or None if there is none
+
+        Parameters
+        ----------
+        params : dict
+            Query parameters with 'coordinates', 'inidate' and 'enddate'
+        footprint : callable
+            footprint(r) returns the footprint of a result, a list of rings
+            [(lon, lat), ...] (see footprint_intersects)
+        date : callable
+            date(r) returns the acquisition date of a result in the format of
+            inidate and enddate (eg. 2019-01-01 or 2019-01-01T10:30:00)
+        """
+
+        box = params.get('coordinates')
+        if not box:
+            return None
+
+        now = time.time()
+        with self.connect() as db:
+            rows = db.execute('SELECT key, results FROM searches WHERE query = ? AND created >= ? '
+                              'AND W <= ? AND S <= ? AND E >= ? AND N >= ? AND inidate <= ? AND enddate >= ? '
+                              'ORDER BY size',
+                              (self.query_key(params), now - self.ttl, box['W'], box['S'], box['E'], box['N'],
+                               params['inidate'], params['enddate'])).fetchall()
+
+        for key, data in rows:
+            selected = []
+            for r in json.loads(data):
+                polygons, day = footprint(r), date(r)
+                if polygons is None or day is None:
+                    # the result can not be placed, the search is not reused
+                    break
+                n = min(len(day), 19)
+                if params['inidate'][:n] <= day[:n] <= params['enddate'][:n] and footprint_intersects(polygons, box):
+                    selected.append(r)
+            else:
+                with self.connect() as db:
+                    db.execute('UPDATE searches SET accessed = ? WHERE key = ?', (now, key))
+                return selected
+        return None
+
+    def put(self, params, results):
+
+        data, now = json.dumps(results), time.time()
+        box = params.get('coordinates') or {}
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO searches (key, params, results, size, created, accessed, '
+                       'query, W, S, E, N, inidate, enddate) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (self.key(params), json.dumps(params, sort_keys=True), data, len(data), now, now,
+                        self.query_key(params), box.get('W'), box.get('S'), box.get('E'), box.get('N'),
+                        params.get('inidate'), params.get('enddate')))
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the expired entries and the least recently used ones until
+        the cache fits in max_size
+        """
+
+        with self.connect() as db:
+            db.execute('DELETE FROM searches WHERE created < ?', (time.time() - self.ttl,))
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM searches').fetchone()[0]
+            for key, size in db.execute('SELECT key, size FROM searches ORDER BY accessed').fetchall():
+                if total <= self.max_size:
+                    break
+                db.execute('DELETE FROM searches WHERE key = ?', (key,))
+                total -= size
+
+    def iterate(self, params, results, footprint=None, date=None):
+        """
+        Iterate over the cached results of a query. On a cache miss the
+        results are consumed lazily from `results` and stored once the
+        search is complete.
+
+        The results of a cached search containing the query are only used
+        if `footprint` and `date` (see get_containing) are given.
+        """
+
+        cached = self.get(params)
+        if cached is None and footprint is not None and date is not None:
+            cached = self.get_containing(params, footprint, date)
+        if cached is not None:
+            metrics.log('Using {} cached results'.format(len(cached)))
+            for r in cached:
+                yield r
+            return
+
+        collected = []
+        for r in results:
+            collected.append(r)
+            yield r
+        self.put(params, collected)
@@ -13,12 +13,18 @@ Github: garciadd
 
 #APIs
 import os, re
-import shutil
+import io
 import numpy as np
-import time
+import xml.etree.ElementTree as ET
 
 from osgeo import gdal, osr
-from netCDF4 import Dataset
+
+from sat_modules import geo_utils
+from sat_modules import writers
+from sat_modules import metrics
+
+#Members of the SAFE archive needed to load the bands
+ARCHIVE_MEMBERS = r'MTD_\w+\.xml$|IMG_DATA/.*_B\w+\.jp2$'
 
 
 def GetExtent(gt,cols,rows):
@@ -46,9 +52,82 @@ def GetExtent(gt,cols,rows):
     return ext
 
 
+def list_dir(path):
+    """
+    Files of a folder, either a local folder or a GDAL virtual path (eg. /vsizip/)
+    """
+
+    if path.startswith('/vsi'):
+        return gdal.ReadDir(path) or []
+    return os.listdir(path)
+
+
+def read_xml_values(path, keys):
+    """
+    Text of some elements of an XML file, parsed in a single pass
+
+    Parameters
+    ----------
+    path : str
+        Local file or GDAL virtual path
+    keys : list
+        Tag names of the elements, preceded by their parents if they are
+        ambiguous (eg. 'Mean_Sun_Angle/ZENITH_ANGLE'). The first match is kept.
+    """
+
+    if path.startswith('/vsi'):
+        f = gdal.VSIFOpenL(path, 'rb')
+        data = gdal.VSIFReadL(1, gdal.VSIStatL(path).size, f)
+        gdal.VSIFCloseL(f)
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+    wanted = {key: key.split('/') for key in keys}
+    values, tags = {}, []
+    for event, elem in ET.iterparse(io.BytesIO(data), events=('start', 'end')):
+        if event == 'start':
+            tags.append(elem.tag.split('}')[-1])
+            continue
+        for key, parts in list(wanted.items()):
+            if tags[-len(parts):] == parts:
+                values[key] = elem.text
+                del wanted[key]
+        tags.pop()
+        if not wanted:
+            break
+
+    return values
+
+
 class sentinel():
 
-    def __init__(self, tile_path, output_path):
+    def __init__(self, tile_path, output_path, aoi=None, encoding='legacy', latlon=False, grid_cache=None,
+                 writer='netcdf', datacube=None, region=None):
+        """
+        Parameters
+        ----------
+        tile_path : str
+            Folder of the SAFE product, or its path inside the downloaded
+            archive through GDAL (eg. /vsizip/<archive>.zip/<product>.SAFE)
+        output_path : str
+            Folder where the outputs are saved
+        aoi : dict
+            Bounding box of the region, only its window is read and saved.
+            Example: {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}
+        encoding : str or dict
+            Encoding profile of the bands (see nc_encoding.ENCODINGS)
+        latlon : bool
+            Add the 2D longitudes and latitudes of the pixels to the output
+        grid_cache : str
+            Folder where the lat/lon grids are cached between scenes
+        writer : str
+            Output backend: 'netcdf', 'zarr', 'cog' or 'datacube' (see writers.WRITERS)
+        datacube : str
+            Folder of the datacube files of the region, used by the datacube writer
+        region : dict
+            Bounding box of the region covered by the datacube, used by the datacube writer
+        """
 
         # Bands per resolution (bands should be load always in the same order)
         self.bands = {10: ['B4', 'B3', 'B2', 'B8'],
@@ -73,20 +152,28 @@ class sentinel():
         #paths
         self.tile_path = tile_path
         self.output_path = output_path
+        self.aoi = aoi
+        self.encoding = encoding
+        self.latlon = latlon
+        self.grid_cache = grid_cache
+        self.writer = writer
+        self.datacube = datacube
+        self.region = region
 
 
     def read_config_file(self):
 
-        # Process input tile name
+        # Process input tile name (the tile can be a folder or a GDAL virtual path, eg. /vsizip/)
+        files = list_dir(self.tile_path)
         r = re.compile("^MTD_(.*?)xml$")
-        matches = list(filter(r.match, os.listdir(self.tile_path)))
+        matches = list(filter(r.match, files))
         if matches:
             xml_path = os.path.join(self.tile_path, matches[0])
         else:
             raise ValueError('No .xml file found.')
 
         # Open XML file and read band descriptions
-        if not os.path.isfile(xml_path):
+        if gdal.VSIStatL(xml_path) is None:
             raise ValueError('XML path not found.')
 
         raster = gdal.Open(xml_path)
@@ -94,105 +181,108 @@ class sentinel():
         return raster
 
 
-    def get_latslons(self):
-
-        xlow, ylow = (self.coord['Corner Coordinates'])[0][1], (self.coord['Corner Coordinates'])[0][0]
-        xup, yup = (self.coord['Corner Coordinates'])[2][1], (self.coord['Corner Coordinates'])[2][0]
-
-        lats = np.linspace(ylow, yup, num=self.coord['Ysize'])
-        lons = np.linspace(xlow, xup, num=self.coord['Xsize'])
-
-        return lats, lons
-
-
-    def save_netCDF(self, dataset, arr_bands):
-
-        #path
-        nc_path = os.path.join(self.output_path, 'Bands_{}.nc'.format(dataset))
-
-        #latitudes & longitudes arrays
-        lats, lons = self.get_latslons()
-
-        # create a file (Dataset object, also the root group).
-        dsout = Dataset(nc_path, 'w', format='NETCDF4')
-        dsout.description = 'Bands_{}.nc'.format(dataset)
-        dsout.history = 'Created {}'.format(time.ctime(time.time()))
-        dsout.source = 'netCDF4 python module'
-
-        # dimensions.
-        lat = dsout.createDimension('lat', len(lats))
-        lon = dsout.createDimension('lon', len(lons))
+    def scene_metadata(self):
+        """
+        Metadata of the scene for the catalogue, read from the product and
+        tile XML files
+        """
 
-        # variables.
-        latitudes = dsout.createVariable('lat','f4',('lat',))
-        longitudes = dsout.createVariable('lon','f4',('lon',))
-
-        latitudes.standard_name = 'latitude'
-        latitudes.units = 'm north'
-        latitudes.axis = "Y"
-        latitudes[:] = lats
-
-        longitudes.standard_name = 'longitude'
-        longitudes.units = 'm east'
-        longitudes.axis = "X"
-        longitudes[:] = lons
-
-        for b in arr_bands:
-
-            print ('Saving {} ...'.format(self.band_desc[dataset][b]))
-
-            band = dsout.createVariable(self.band_desc[dataset][b],
-                                        'f4',
-                                        ('lat', 'lon'),
-                                        least_significant_digit=4,
-                                        fill_value=np.nan
-                                        )
-
-            band[:] = arr_bands[b]
-            band.standard_name = self.band_desc[dataset][b]
-            band.units = 'rad'
-            band.setncattr('grid_mapping', 'spatial_ref')
-
-        crs = dsout.createVariable('spatial_ref', 'i4')
-        crs.spatial_ref = self.coord['geoprojection']
-
-        dsout.close()
+        mtd = [f for f in list_dir(self.tile_path) if re.match(r'^MTD_MSIL\w+\.xml$', f)]
+        if not mtd:
+            raise ValueError('No .xml file found.')
+        product = read_xml_values(os.path.join(self.tile_path, mtd[0]),
+                                  ['PRODUCT_URI', 'PRODUCT_START_TIME', 'Cloud_Coverage_Assessment',
+                                   'Global_Footprint/EXT_POS_LIST'])
+
+        granule_path = os.path.join(self.tile_path, 'GRANULE')
+        granule = os.path.join(granule_path, list_dir(granule_path)[0], 'MTD_TL.xml')
+        sun = read_xml_values(granule, ['Mean_Sun_Angle/ZENITH_ANGLE', 'Mean_Sun_Angle/AZIMUTH_ANGLE'])
+
+        # the footprint is given as lat lon pairs
+        positions = [float(v) for v in product['Global_Footprint/EXT_POS_LIST'].split()]
+        footprint = [[lon, lat] for lat, lon in zip(positions[0::2], positions[1::2])]
+
+        tile = re.search(r'_T(\d{2}[A-Z]{3})_', product['PRODUCT_URI'])
+
+        return {'scene_id': product['PRODUCT_URI'].replace('.SAFE', ''),
+                'sensor': 'Sentinel2',
+                'tile': tile.group(1) if tile else None,
+                'date': product['PRODUCT_START_TIME'],
+                'cloud_cover': float(product['Cloud_Coverage_Assessment']),
+                'sun_elevation': 90 - float(sun['Mean_Sun_Angle/ZENITH_ANGLE']),
+                'sun_azimuth': float(sun['Mean_Sun_Angle/AZIMUTH_ANGLE']),
+                'footprint': footprint}
+
+    def create_writer(self, dataset, bands):
+        """
+        Open the output of a resolution (Bands_<res>.nc, .zarr or .tif, or
+        the datacube of the region) with a variable per band. The caller
+        writes the bands and closes it.
+        """
+
+        name = 'Bands_{}'.format(dataset)
+        path, kwargs = os.path.join(self.output_path, name), {}
+        if self.writer == 'datacube':
+            path, kwargs = os.path.join(self.datacube, 'Sentinel2_{}'.format(name)), \
+                            {'scene': self.scene_metadata(), 'region': self.region}
+        return writers.open_writer(self.writer, path, name, self.coord,
+                                   [(self.band_desc[dataset][b], False) for b in bands],
+                                   encoding=self.encoding, latlon=self.latlon, grid_cache=self.grid_cache, **kwargs)
 
     def load_bands(self):
 
+        #the output folder belongs to the caller (eg. the staging folder of process), it is not removed here
         raster = self.read_config_file()
         if raster is None:
-            print ('not recognized as a supported file format.')
-            print ('deleting the file: {}'.format(self.tile_path))
-            shutil.rmtree(self.output_path)
-            return
-        else:
-            pass
+            raise ValueError('{} not recognized as a supported file format'.format(self.tile_path))
         datasets = raster.GetSubDatasets()
 
     	# Getting the bands shortnames and descriptions
         for dsname, dsdesc in datasets:
 
             self.coord = {}
-            data_bands = {}
-            self.arr_bands = {}
 
             for res in self.bands.keys():
                 if '{}m resolution'.format(res) in dsdesc:
 
-                    print('Loading bands of Resolution {}'.format(res))
+                    metrics.log('Loading bands of Resolution {}'.format(res))
 
                     ds_bands = gdal.Open(dsname)
-                    data_bands = ds_bands.ReadAsArray()
-                    self.coord['geotransform'] = ds_bands.GetGeoTransform()
+                    gt = ds_bands.GetGeoTransform()
+                    window = (0, 0, ds_bands.RasterXSize, ds_bands.RasterYSize)
+
+                    #only the window of the region is read
+                    if self.aoi is not None:
+                        window = geo_utils.aoi_window(gt, ds_bands.GetProjection(), ds_bands.RasterXSize,
+                                                      ds_bands.RasterYSize, self.aoi)
+                        if window is None:
+                            raise ValueError('The region is outside of the tile {}'.format(self.tile_path))
+                        gt = geo_utils.window_geotransform(gt, window)
+
+                    self.coord['geotransform'] = gt
                     self.coord['geoprojection'] = ds_bands.GetProjection()
-                    self.coord['Xsize'] = ds_bands.RasterXSize
-                    self.coord['Ysize'] = ds_bands.RasterYSize
-                    self.coord['Corner Coordinates'] = GetExtent(ds_bands.GetGeoTransform(), ds_bands.RasterXSize, ds_bands.RasterYSize)
-
-                    for i, band in enumerate(self.bands[res]):
-                        self.arr_bands[band] = data_bands[i] / 10000
-
-                    self.save_netCDF(res, self.arr_bands)
+                    self.coord['Xsize'] = window[2]
+                    self.coord['Ysize'] = window[3]
+                    self.coord['Corner Coordinates'] = GetExtent(gt, window[2], window[3])
+
+                    #one band at a time is read into a reusable float32 buffer, scaled in place and saved
+                    with metrics.stage('load_bands', dataset='Bands_{}'.format(res)) as m:
+                        out = self.create_writer(res, self.bands[res])
+                        buf = np.empty((window[3], window[2]), dtype=np.float32)
+                        try:
+                            for i, band in enumerate(self.bands[res]):
+
+                                print ('Saving {} ...'.format(self.band_desc[res][band]))
+
+                                with m.timed('read_seconds'):
+                                    ds_bands.GetRasterBand(i + 1).ReadAsArray(*window, buf_obj=buf)
+                                    np.divide(buf, 10000, out=buf)
+
+                                with m.timed('write_seconds'):
+                                    out.write(self.band_desc[res][band], buf)
+                                m.add(pixels=buf.size)
+                        finally:
+                            with m.timed('write_seconds'):
+                                out.close()
 
                     break
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+On disk cache of API keys and authenticated cookies, so consecutive runs
+reuse the sessions of the previous ones instead of logging in again.
+
+The file is only readable by its owner. Every entry has an expiry date and
+is keyed by the service and the username. The cookies keep their domain,
+path, secure flag and expiry (see dump_cookies), so a restored cookie is
+only sent to the hosts that set it and the entry expires with them.
+"""
+
+#APIs
+import os
+import json
+import time
+import threading
+
+
+def dump_cookies(jar):
+    """
+    Cookies of a requests cookie jar as a list of JSON serializable dicts
+    """
+
+    return [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+             'secure': c.secure, 'expires': c.expires} for c in jar]
+
+
+def load_cookies(jar, cookies):
+    """
+    Add the cookies of dump_cookies to a requests cookie jar
+    """
+
+    for c in cookies:
+        jar.set(c['name'], c['value'], domain=c['domain'], path=c['path'], secure=c['secure'],
+                expires=c['expires'])
+
+
+class session_cache:
+
+    # shared by all the instances, the providers may write the same file at the same time
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the JSON file with the cached sessions
+        """
+
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def load(self, service, username):
+        """
+        Return the cached session of a user or None if it is missing or expired
+        """
+
+        with self.lock:
+            entry = self.read().get('{}:{}'.format(service, username))
+        if entry is None or entry['expires'] < time.time():
+            return None
+        return entry['data']
+
+    def save(self, service, username, data, ttl):
+        """
+        Parameters
+        ----------
+        data : JSON serializable
+            Session of the user, eg. an API key or the cookies of dump_cookies
+        ttl : float
+            Seconds the session is kept. The cookies with an expiry date are
+            only kept until the first of them expires.
+        """
+
+        now = time.time()
+        expires = now + ttl
+        if isinstance(data, list):
+            dates = [c['expires'] for c in data if c.get('expires')]
+            if dates:
+                expires = min(dates)
+
+        with self.lock:
+            sessions = self.read()
+            sessions = {k: v for k, v in sessions.items() if v['expires'] > now}
+            sessions['{}:{}'.format(service, username)] = {'data': data, 'expires': expires}
+
+            tmp = '{}.tmp'.format(self.path)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(sessions, f)
+            os.replace(tmp, self.path)
+
+    def clear(self, service, username):
+
+        self.save(service, username, None, ttl=-1)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Run the downloads of several providers at the same time, sharing one CPU
+and bandwidth budget and reporting their combined progress.
+
+The CPU budget is counted in threads: a scene processed with several band
+threads (see landsat_utils band_workers) takes as many slots as threads, so
+the processing of all the providers never runs more threads than `cpu`.
+"""
+
+#APIs
+import os
+import time
+import threading
+
+from sat_modules import metrics
+
+
+class cpu_budget:
+
+    def __init__(self, slots):
+        """
+        Semaphore whose holders take several slots at once
+
+        Parameters
+        ----------
+        slots : int
+            Number of threads running at the same time
+        """
+
+        self.slots = slots
+        self.free = slots
+        self.cond = threading.Condition()
+
+    def acquire(self, n=1):
+        """
+        Wait until `n` slots are free and take them. A holder never takes
+        more than all the slots, so it can not wait forever.
+
+        Returns
+        -------
+        Number of slots taken
+        """
+
+        n = min(n, self.slots)
+        with self.cond:
+            while self.free < n:
+                self.cond.wait()
+            self.free -= n
+        return n
+
+    def release(self, n=1):
+
+        with self.cond:
+            self.free += n
+            self.cond.notify_all()
+
+    def take(self, n):
+        """
+        Context holding `n` slots, eg. the limit of a pipeline stage
+        """
+        return _slots(self, n)
+
+
+class _slots:
+
+    def __init__(self, budget, n):
+        # the same context is entered by all the workers of a stage
+        self.budget = budget
+        self.n = min(n, budget.slots)
+
+    def __enter__(self):
+        self.budget.acquire(self.n)
+        return self
+
+    def __exit__(self, *exc):
+        self.budget.release(self.n)
+        return False
+
+
+class supervisor:
+
+    def __init__(self, cpu=None, transfers=None, max_rate=None, interval=30):
+        """
+        Parameters
+        ----------
+        cpu : int
+            Number of processing threads running at the same time for all
+            the providers (by default the number of CPUs)
+        transfers : int
+            Number of downloads at the same time by all the providers
+            (by default only limited by the workers of each provider)
+        max_rate : float
+            Maximum bandwidth in bytes per second shared by all the downloads
+        interval : int
+            Seconds between progress reports
+        """
+
+        self.cpu = cpu_budget(cpu or os.cpu_count() or 1)
+        self.net = threading.BoundedSemaphore(transfers) if transfers else None
+
+        # token bucket of the shared bandwidth
+        self.max_rate = max_rate
+        self.allowance = max_rate or 0
+        self.last = time.time()
+        self.rate_lock = threading.Lock()
+
+        self.interval = interval
+        self.last_report = 0
+        self.progress = {}
+        self.progress_lock = threading.Lock()
+
+    def limits(self, threads=1):
+        """
+        Limits of the stages of a provider pipeline (see pipeline)
+
+        Parameters
+        ----------
+        threads : int
+            Number of threads processing a scene of the provider (eg. band_workers)
+        """
+
+        limits = {'process': self.cpu.take(threads)}
+        if self.net is not None:
+            limits['fetch'] = self.net
+        return limits
+
+    def throttle(self, nbytes):
+        """
+        Wait until `nbytes` fit in the bandwidth budget
+        """
+
+        if not self.max_rate:
+            return
+
+        with self.rate_lock:
+            now = time.time()
+            self.allowance = min(self.max_rate, self.allowance + (now - self.last) * self.max_rate)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.max_rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def update(self, provider, stage):
+        """
+        Count a scene that went through a stage and print the combined
+        progress every `interval` seconds
+        """
+
+        with self.progress_lock:
+            stages = self.progress.setdefault(provider, {})
+            stages[stage] = stages.get(stage, 0) + 1
+            if time.time() - self.last_report >= self.interval:
+                self.last_report = time.time()
+                self.report()
+
+    def report(self):
+
+        metrics.log('Progress: {}'.format(' | '.join(
+            '{}: {}'.format(provider, ', '.join('{} {}'.format(k, v) for k, v in stages.items()))
+            for provider, stages in sorted(self.progress.items()))))
+
+    def run(self, jobs):
+        """
+        Run the jobs of the providers at the same time and wait for all of
+        them. A failed provider does not stop the others.
+
+        Parameters
+        ----------
+        jobs : dict
+            Name of the provider and function running its download
+        """
+
+        errors = {}
+
+        def target(name, job):
+            try:
+                job()
+            except Exception as e:
+                errors[name] = e
+                metrics.error('Error in {}: {}'.format(name, e))
+
+        threads = [threading.Thread(target=target, args=(name, job)) for name, job in jobs.items()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        with self.progress_lock:
+            self.report()
+
+        return errors
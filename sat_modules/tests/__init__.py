@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Unit tests of the parts of the service that do not need GDAL, the network
+or the credentials of the providers (parsers, caches, pipeline, DOS1).
+
+    python -m pytest sat_modules/tests
+
+sat_modules.config is loaded from config.py.example when there is no
+config.py. When GDAL is not installed `osgeo` is replaced by a placeholder,
+so the modules importing it can be imported, and any call to GDAL raises
+ImportError.
+"""
+
+import os
+import sys
+import types
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+SAT_MODULES = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if not os.path.isfile(os.path.join(SAT_MODULES, 'config.py')) and 'sat_modules.config' not in sys.modules:
+    loader = SourceFileLoader('sat_modules.config', os.path.join(SAT_MODULES, 'config.py.example'))
+    config = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(config)
+    sys.modules['sat_modules.config'] = config
+
+
+def _missing(name):
+
+    def call(*args, **kwargs):
+        raise ImportError('GDAL is not installed, {} is not available'.format(name))
+    return call
+
+
+if importlib.util.find_spec('osgeo') is None:
+    osgeo = types.ModuleType('osgeo')
+    for name in ('gdal', 'osr', 'ogr'):
+        module = types.ModuleType('osgeo.{}'.format(name))
+        module.__getattr__ = lambda attr, name=name: _missing('{}.{}'.format(name, attr))
+        setattr(osgeo, name, module)
+        sys.modules[module.__name__] = module
+    sys.modules['osgeo'] = osgeo
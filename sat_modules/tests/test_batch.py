@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import json
+import runpy
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from sat_modules import batch
+from sat_modules import download_sentinel
+from sat_modules import download_landsat
+from sat_modules.scene_store import scene_store
+
+#products of the fake catalogue, with their bounding boxes
+RESULTS = [{'id': 'T1', 'box': {'W': 0., 'S': 0., 'E': 1., 'N': 1.}},
+           {'id': 'T2', 'box': {'W': 0.8, 'S': 0., 'E': 1.8, 'N': 1.}},
+           {'id': 'T3', 'box': {'W': 10., 'S': 10., 'E': 11., 'N': 11.}}]
+
+REGIONS = {'A': {'W': 0.5, 'S': 0.5, 'E': 0.6, 'N': 0.6},
+           'B': {'W': 0.85, 'S': 0.5, 'E': 0.95, 'N': 0.6},
+           'C': {'W': 10.5, 'S': 10.5, 'E': 10.6, 'N': 10.6}}
+
+
+class fake_journal:
+
+    def __init__(self):
+        self.states = {}
+
+    def state(self, scene_id):
+        return self.states.get(scene_id)
+
+    def searched(self, scene_id):
+        self.states.setdefault(scene_id, 'searched')
+
+    def set(self, scene_id, state):
+        self.states[scene_id] = state
+
+
+class fake_downloader:
+    """
+    Downloader of a region working on the fake catalogue, every call is recorded
+    """
+
+    def __init__(self, test, region, coordinates):
+        self.test = test
+        self.region = region
+        self.coord = coordinates
+        self.journal = test.journals.setdefault(region, fake_journal())
+        self.workers = 1
+
+    def search(self):
+        self.test.calls.append(('search', self.region))
+        return [r for r in RESULTS if batch.intersects(r['box'], self.coord)]
+
+    def scene(self, r):
+        return {'tile_id': r['id'], 'output_path': os.path.join(self.test.folder, self.region, r['id'])}
+
+    def footprint(self, r):
+        box = r['box']
+        return [[(box['W'], box['S']), (box['E'], box['S']), (box['E'], box['N']), (box['W'], box['N'])]]
+
+    def fetch(self, scene):
+        if batch.processed(self, {'id': scene['tile_id']}):
+            return None
+        self.test.calls.append(('fetch', self.region, scene['tile_id']))
+        return scene
+
+    def unpack(self, scene):
+        self.test.calls.append(('unpack', self.region, scene['tile_id']))
+        return scene
+
+    def process(self, scene):
+        if self.region == 'B' and scene['tile_id'] == 'T2' and self.test.fail:
+            raise IOError('corrupted product')
+        os.makedirs(scene['output_path'])
+        self.journal.set(scene['tile_id'], 'processed')
+        self.test.calls.append(('process', self.region, scene['tile_id']))
+        return scene
+
+    def clean(self, scene):
+        return None
+
+    def release(self, scene):
+        pass
+
+
+class TestMergeBoxes(unittest.TestCase):
+
+    def test_overlapping_regions_are_merged(self):
+
+        regions = {'A': {'W': 0., 'S': 0., 'E': 1., 'N': 1.}, 'B': {'W': 0.5, 'S': 0.5, 'E': 1.5, 'N': 1.5}}
+        self.assertEqual(batch.merge_boxes(regions), [({'W': 0., 'S': 0., 'E': 1.5, 'N': 1.5}, ['A', 'B'])])
+
+    def test_neighbours_are_merged_within_the_waste(self):
+
+        regions = {'A': {'W': 0., 'S': 0., 'E': 1., 'N': 1.}, 'B': {'W': 1.2, 'S': 0., 'E': 2.2, 'N': 1.}}
+        self.assertEqual(len(batch.merge_boxes(regions, max_waste=0.5)), 1)
+        self.assertEqual(len(batch.merge_boxes(regions, max_waste=0.)), 2)
+
+    def test_distant_regions_are_not_merged(self):
+
+        groups = batch.merge_boxes(REGIONS)
+        self.assertEqual(sorted(names for box, names in groups), [['A'], ['B'], ['C']])
+
+    def test_groups_cover_their_regions(self):
+
+        for box, names in batch.merge_boxes(REGIONS, max_waste=100):
+            for name in names:
+                self.assertEqual(batch.union(box, REGIONS[name]), box)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = scene_store(os.path.join(self.folder, 'store'))
+        self.journals = {}
+        self.calls = []
+        self.fail = False
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def batch(self, max_waste=0.5):
+        factory = lambda region, coordinates: fake_downloader(self, region, coordinates)
+        return batch.batch(REGIONS, {'Fake': factory}, self.store, max_waste=max_waste)
+
+    def calls_of(self, kind, region=None):
+        return sorted(c[2] for c in self.calls if c[0] == kind and c[1] == (region or batch.BATCH_REGION))
+
+    def test_search_maps_the_products_to_their_regions(self):
+
+        b = self.batch(max_waste=100)
+        products = b.search(fake_downloader(self, batch.BATCH_REGION, None))
+        # A and B share a search, C is too far
+        self.assertEqual(len([c for c in self.calls if c[0] == 'search']), 2)
+        self.assertEqual(sorted((r['id'], sorted(regions)) for r, regions in products),
+                         [('T1', ['A', 'B']), ('T2', ['B']), ('T3', ['C'])])
+
+    def test_products_found_by_several_searches_appear_once(self):
+
+        b = self.batch()
+        products = b.search(fake_downloader(self, batch.BATCH_REGION, None))
+        self.assertEqual(len([c for c in self.calls if c[0] == 'search']), 3)
+        self.assertEqual(sorted(r['id'] for r, regions in products), ['T1', 'T2', 'T3'])
+
+    def test_every_product_is_fetched_once(self):
+
+        self.assertEqual(self.batch().run(), {})
+        self.assertEqual(self.calls_of('fetch'), ['T1', 'T2', 'T3'])
+        self.assertEqual(self.calls_of('unpack'), ['T1', 'T2', 'T3'])
+        self.assertEqual(self.calls_of('process', 'A'), ['T1'])
+        self.assertEqual(self.calls_of('process', 'B'), ['T1', 'T2'])
+        self.assertEqual(self.calls_of('process', 'C'), ['T3'])
+
+    def test_processed_products_are_not_fetched_again(self):
+
+        self.batch().run()
+        self.calls = []
+        self.batch().run()
+        self.assertEqual(self.calls_of('fetch'), [])
+
+    def test_only_the_pending_regions_are_processed(self):
+
+        self.fail = True
+        self.batch().run()
+        self.assertEqual(self.calls_of('process', 'B'), ['T1'])
+
+        self.fail, self.calls = False, []
+        self.batch().run()
+        self.assertEqual(self.calls_of('fetch'), ['T2'])
+        self.assertEqual([c for c in self.calls if c[0] == 'process'], [('process', 'B', 'T2')])
+
+
+class TestBatchServer(unittest.TestCase):
+
+    SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                          'sat_server', 'xdc_lfw_sat_batch.py')
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.runs = []
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def run_server(self, sat_args):
+
+        runs = self.runs
+
+        class fake_batch:
+
+            def __init__(self, regions, providers, store, supervisor=None, max_waste=0.5):
+                self.call = {'regions': regions, 'providers': providers, 'store': store,
+                             'supervisor': supervisor, 'max_waste': max_waste}
+
+            def run(self):
+                runs.append(self.call)
+
+        argv = ['xdc_lfw_sat_batch.py', '-sat_args', json.dumps(sat_args), '-path', self.folder]
+        with mock.patch.object(sys, 'argv', argv), mock.patch.object(batch, 'batch', fake_batch), \
+                mock.patch.object(download_sentinel, 'download_sentinel') as s2, \
+                mock.patch.object(download_landsat, 'download_landsat') as l8:
+            runpy.run_path(self.SCRIPT, run_name='__main__')
+            call, = self.runs
+            for provider in call['providers'].values():
+                provider('A', REGIONS['A'])
+        return call, s2, l8
+
+    def test_regions_share_the_store_and_the_budget(self):
+
+        sat_args = {'regions': REGIONS, 'start_date': '2019-01-01', 'end_date': '2019-02-01',
+                    'sat_type': 'All', 'cloud': 20, 'max_rate': 1e6, 'max_waste': 0.2, 'band_workers': 2}
+        call, s2, l8 = self.run_server(sat_args)
+
+        self.assertEqual(call['regions'], REGIONS)
+        self.assertEqual(sorted(call['providers']), ['Landsat8', 'Sentinel2'])
+        self.assertEqual(call['max_waste'], 0.2)
+        self.assertEqual(call['supervisor'].max_rate, 1e6)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['A', 'B', 'C', 'store'])
+
+        # the downloaders of a region get the shared store and supervisor
+        for downloader in (s2, l8):
+            kwargs = downloader.call_args[1]
+            self.assertEqual((kwargs['region'], kwargs['coordinates']), ('A', REGIONS['A']))
+            self.assertIs(kwargs['store'], call['store'])
+            self.assertIs(kwargs['supervisor'], call['supervisor'])
+            self.assertEqual(kwargs['cloud'], 20)
+        self.assertEqual(l8.call_args[1]['band_workers'], 2)
+
+    def test_single_provider(self):
+
+        sat_args = {'regions': REGIONS, 'start_date': '2019-01-01', 'end_date': '2019-02-01',
+                    'sat_type': 'Sentinel2', 'cloud': 100}
+        call, s2, l8 = self.run_server(sat_args)
+        self.assertEqual(list(call['providers']), ['Sentinel2'])
+        self.assertFalse(l8.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sat_modules.catalogue import catalogue
+
+
+def square(w, s, e, n):
+    return [[w, s], [e, s], [e, n], [w, n], [w, s]]
+
+
+class TestCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.catalogue = catalogue(os.path.join(self.folder, 'db', 'catalogue.sqlite'))
+        self.output = os.path.join(self.folder, 'output')
+        os.makedirs(self.output)
+        for name in ('B02.nc', 'B01.nc'):
+            open(os.path.join(self.output, name), 'w').close()
+
+        scenes = [('S2A_1', 'Sentinel2', '2019-01-05T10:58:11Z', 12.0, 25.0, square(-3.0, 41.5, -2.5, 42.0)),
+                  ('S2A_2', 'Sentinel2', '2019-02-01T10:58:11Z', 40.0, 35.0, square(-3.0, 41.5, -2.5, 42.0)),
+                  ('LC08_1', 'Landsat8', '2019-01-31T10:45:02Z', 5.0, 30.5, square(-1.0, 40.0, -0.5, 40.5))]
+        for scene_id, sensor, date, cloud_cover, sun_elevation, footprint in scenes:
+            self.catalogue.record({'scene_id': scene_id, 'region': 'CdP', 'sensor': sensor, 'date': date,
+                                   'cloud_cover': cloud_cover, 'sun_elevation': sun_elevation,
+                                   'footprint': footprint, 'output_path': self.output})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def ids(self, **conditions):
+        return [s['scene_id'] for s in self.catalogue.query(**conditions)]
+
+    def test_record(self):
+
+        scene = self.catalogue.query(sensor='Landsat8')[0]
+        self.assertEqual((scene['west'], scene['south'], scene['east'], scene['north']), (-1.0, 40.0, -0.5, 40.5))
+        self.assertEqual(scene['footprint'], square(-1.0, 40.0, -0.5, 40.5))
+        self.assertEqual(scene['outputs'], ['B01.nc', 'B02.nc'])
+
+    def test_record_replaces_the_scene(self):
+
+        self.catalogue.record({'scene_id': 'S2A_1', 'region': 'CdP', 'sensor': 'Sentinel2',
+                               'date': '2019-01-05T10:58:11Z', 'cloud_cover': 3.0})
+        scene, = self.catalogue.query(end='2019-01-05')
+        self.assertEqual((scene['cloud_cover'], scene['footprint'], scene['west']), (3.0, [], None))
+        self.assertEqual(len(self.catalogue.query()), 3)
+
+    def test_scenes_are_sorted_by_date(self):
+
+        self.assertEqual(self.ids(), ['S2A_1', 'LC08_1', 'S2A_2'])
+        self.assertEqual(self.ids(region='Other'), [])
+
+    def test_date_window_includes_the_end_day(self):
+
+        self.assertEqual(self.ids(start='2019-01-31', end='2019-01-31'), ['LC08_1'])
+        self.assertEqual(self.ids(start='2019-01-06'), ['LC08_1', 'S2A_2'])
+        self.assertEqual(self.ids(end='2019-01-30'), ['S2A_1'])
+
+    def test_sun_and_cloud_filters(self):
+
+        self.assertEqual(self.ids(min_sun_elevation=30), ['LC08_1', 'S2A_2'])
+        self.assertEqual(self.ids(min_sun_elevation=30, max_cloud_cover=20), ['LC08_1'])
+
+    def test_footprint_filter(self):
+
+        # boxes inside the Sentinel-2 footprints, between the footprints and around all of them
+        self.assertEqual(self.ids(bbox={'W': -2.830, 'S': 41.820, 'E': -2.690, 'N': 41.910}), ['S2A_1', 'S2A_2'])
+        self.assertEqual(self.ids(bbox={'W': -2.6, 'S': 40.6, 'E': -2.0, 'N': 41.4}), [])
+        self.assertEqual(self.ids(bbox={'W': -5.0, 'S': 39.0, 'E': 5.0, 'N': 45.0}), ['S2A_1', 'LC08_1', 'S2A_2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from sat_modules import datacube
+from sat_modules import geo_utils
+
+
+def write_coordinates(dsout, coordinates, latlon=False, grid_cache=None):
+
+    dsout.createDimension('y', coordinates['Ysize'])
+    dsout.createDimension('x', coordinates['Xsize'])
+    return ('y', 'x')
+
+
+def aoi_bounds(projection, coordinates, density=10):
+
+    # the region in projected units, 1000 * degrees
+    return coordinates['W'] * 1000, coordinates['S'] * 1000, coordinates['E'] * 1000, coordinates['N'] * 1000
+
+
+@mock.patch.object(geo_utils, 'crs_key', lambda projection: projection)
+@mock.patch.object(geo_utils, 'aoi_bounds', aoi_bounds)
+@mock.patch.object(geo_utils, 'write_coordinates', write_coordinates)
+class TestDatacube(unittest.TestCase):
+
+    region = {'W': 1.005, 'S': 0.995, 'E': 1.105, 'N': 1.095}
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.folder, 'Landsat8_Spectral_Bands')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def append(self, scene_id, date, x0, y0, cols=200, rows=200, value=1.):
+
+        coordinates = {'geotransform': (x0, 10., 0, y0, 0, -10.), 'geoprojection': 'UTM',
+                       'Xsize': cols, 'Ysize': rows}
+        out = datacube.datacube_writer(self.prefix, 'test', coordinates, [('B1', False)], encoding='deflate',
+                                       scene={'scene_id': scene_id, 'date': date}, region=self.region)
+        out.write('B1', np.full((rows, cols), value, dtype=np.float32))
+        out.close()
+        return out.path
+
+    def test_the_grid_is_snapped_to_the_region(self):
+
+        cube = datacube.cube_coordinates({'geotransform': (900., 10., 0, 1200., 0, -10.), 'geoprojection': 'UTM',
+                                          'Xsize': 200, 'Ysize': 200}, self.region)
+        self.assertEqual(cube['geotransform'], (1000., 10., 0., 1100., 0., -10.))
+        self.assertEqual((cube['Xsize'], cube['Ysize']), (11, 11))
+
+    def test_scenes_with_another_framing_share_the_datacube(self):
+
+        first = self.append('A', '2019-01-02T10:00:00Z', 900., 1200., value=1.)
+        second = self.append('B', '2019-01-01T10:00:00Z', 950., 1150., value=2.)
+        self.assertEqual(first, second)
+        self.assertEqual(os.listdir(self.folder), [os.path.basename(first)])
+
+        dates, values, scene_ids = datacube.read(first, 'B1')
+        self.assertEqual(scene_ids, ['B', 'A'])
+        self.assertEqual(values.shape, (2, 11, 11))
+        np.testing.assert_allclose(values[:, 5, 5], [2., 1.])
+
+    def test_the_pixels_outside_of_a_scene_are_masked(self):
+
+        # the scene covers the columns 0-4 of the datacube
+        path = self.append('A', '2019-01-01T10:00:00Z', 950., 1200., cols=10)
+        dates, values, scene_ids = datacube.read(path, 'B1')
+        self.assertEqual(scene_ids, ['A'])
+        self.assertFalse(values.mask[0, :, :5].any())
+        self.assertTrue(values.mask[0, :, 5:].all())
+
+    def test_scenes_outside_of_the_region_are_skipped(self):
+
+        path = self.append('A', '2019-01-01T10:00:00Z', 5000., 5000.)
+        dates, values, scene_ids = datacube.read(path, 'B1')
+        self.assertEqual(scene_ids, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from sat_modules import geo_utils
+
+
+class fake_srs:
+
+    def __init__(self, wkt=None):
+        self.wkt = wkt
+
+    def SetAxisMappingStrategy(self, strategy):
+        pass
+
+    def ImportFromEPSG(self, code):
+        self.wkt = 'EPSG:{}'.format(code)
+
+    def GetAuthorityCode(self, key):
+        return None
+
+    def ExportToWkt(self):
+        return self.wkt
+
+
+class fake_transform:
+    """
+    Bilinear projection, so the interpolated grids must be exact
+    """
+
+    calls = 0
+
+    def __init__(self, src, dst):
+        pass
+
+    def TransformPoints(self, points):
+        fake_transform.calls += 1
+        return [(x / 1000. + y * 1e-7, y / 2000. - 40 + x * y * 1e-12, 0) for x, y in points]
+
+
+fake_osr = mock.Mock(SpatialReference=fake_srs, CoordinateTransformation=fake_transform, OAMS_TRADITIONAL_GIS_ORDER=0)
+
+
+@mock.patch.object(geo_utils, 'osr', fake_osr)
+class TestLonLatRows(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        geo_utils._blocks.clear()
+        fake_transform.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        geo_utils._blocks.clear()
+
+    def grids(self, gt, cols=300, rows=200, **kwargs):
+
+        blocks = list(geo_utils.lonlat_rows(gt, 'UTM', cols, rows, cache_dir=self.folder, block_rows=64, **kwargs))
+        self.assertEqual([r for r, _, _ in blocks], [0, 64, 128, 192])
+        return np.vstack([b[1] for b in blocks]), np.vstack([b[2] for b in blocks])
+
+    def test_interpolated_grids_match_the_projection(self):
+
+        gt = (500015., 30., 0, 4600005., 0, -30.)
+        x, y = geo_utils.projected_axes(gt, 300, 200)
+        x, y = np.meshgrid(x, y)
+        for step in (32, 2):  # the small step crosses the edges of the blocks
+            lons, lats = self.grids(gt, step=step)
+            np.testing.assert_allclose(lons, x / 1000. + y * 1e-7, rtol=1e-6)
+            np.testing.assert_allclose(lats, y / 2000. - 40 + x * y * 1e-12, rtol=1e-6)
+
+    def test_shifted_scenes_reuse_the_cached_nodes(self):
+
+        self.grids((500015., 30., 0, 4600005., 0, -30.))
+        calls, files = fake_transform.calls, sorted(os.listdir(self.folder))
+
+        # another framing of the same grid, read from disk
+        geo_utils._blocks.clear()
+        self.grids((500015. + 7 * 30., 30., 0, 4600005. - 3 * 30., 0, -30.))
+        self.assertEqual(fake_transform.calls, calls)
+        self.assertEqual(sorted(os.listdir(self.folder)), files)
+
+    def test_cache_size_is_capped(self):
+
+        with mock.patch.object(geo_utils, 'GRID_MEMORY_BLOCKS', 2):
+            self.grids((500015., 30., 0, 4600005., 0, -30.), step=2)
+            self.assertEqual(len(geo_utils._blocks), 2)
+
+        block_size = os.path.getsize(os.path.join(self.folder, os.listdir(self.folder)[0]))
+        geo_utils.trim_grid_cache(self.folder, max_size=3 * block_size)
+        self.assertEqual(len(os.listdir(self.folder)), 3)
+
+    def test_rotated_rasters_are_rejected(self):
+
+        with self.assertRaises(ValueError):
+            next(geo_utils.lonlat_rows((0, 30., 1., 0, 1., -30.), 'UTM', 10, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sat_modules.journal import journal
+from sat_modules.manifest import manifest
+from sat_modules.download_sentinel import download_sentinel
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal = journal(os.path.join(self.folder, 'CdP', 'journal.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_states(self):
+
+        self.assertIsNone(self.journal.state('S2A_1'))
+        self.journal.searched('S2A_1')
+        self.assertEqual(self.journal.state('S2A_1'), 'searched')
+        self.journal.set('S2A_1', 'extracted')
+        self.assertEqual(self.journal.state('S2A_1'), 'extracted')
+
+    def test_a_new_search_keeps_the_state(self):
+
+        self.journal.set('S2A_1', 'processed')
+        self.journal.searched('S2A_1')
+        self.assertEqual(self.journal.state('S2A_1'), 'processed')
+
+    def test_unknown_state(self):
+
+        with self.assertRaises(ValueError):
+            self.journal.set('S2A_1', 'uploaded')
+
+    def test_summary(self):
+
+        self.journal.searched('S2A_1')
+        self.journal.searched('S2A_2')
+        self.journal.set('S2A_3', 'processed')
+        self.assertEqual(self.journal.summary(), {'searched': 2, 'downloaded': 0, 'extracted': 0, 'processed': 1})
+
+    def test_persists_between_runs(self):
+
+        self.journal.set('S2A_1', 'downloaded')
+        self.assertEqual(journal(self.journal.db_path).state('S2A_1'), 'downloaded')
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.s2 = download_sentinel.__new__(download_sentinel)
+        self.s2.journal = journal(os.path.join(self.folder, 'CdP', 'journal.db'))
+        self.s2.manifest = manifest(os.path.join(self.folder, 'manifest.json'))
+        self.s2.store = None
+        self.scene = {'tile_id': 'S2A_1',
+                      'archive': os.path.join(self.folder, 'S2A_1.zip'),
+                      'save_dir': os.path.join(self.folder, 'S2A_1.SAFE'),
+                      'output_path': os.path.join(self.folder, 'CdP', 'S2A_1')}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_processed_scene_is_skipped(self):
+
+        os.makedirs(self.scene['output_path'])
+        self.s2.journal.set('S2A_1', 'processed')
+        self.assertIsNone(self.s2.fetch(self.scene))
+
+    def test_extracted_scene_is_not_downloaded(self):
+
+        os.makedirs(self.scene['save_dir'])
+        self.s2.journal.set('S2A_1', 'extracted')
+        self.assertIs(self.s2.fetch(self.scene), self.scene)
+
+    def test_verified_archive_is_not_downloaded(self):
+
+        with open(self.scene['archive'], 'wb') as f:
+            f.write(b'product')
+        self.s2.manifest.record(self.scene['archive'], 'md5', True)
+        self.s2.journal.searched('S2A_1')
+        self.assertIs(self.s2.fetch(self.scene), self.scene)
+        self.assertEqual(self.s2.journal.state('S2A_1'), 'downloaded')
+
+    def test_state_without_its_folder_is_redone(self):
+
+        # the output folder was removed after the scene was processed
+        self.s2.journal.set('S2A_1', 'processed')
+        with open(self.scene['archive'], 'wb') as f:
+            f.write(b'product')
+        self.s2.manifest.record(self.scene['archive'], 'md5', True)
+        self.assertIs(self.s2.fetch(self.scene), self.scene)
+        self.assertEqual(self.s2.journal.state('S2A_1'), 'downloaded')
+
+
+if __name__ == '__main__':
+    unittest.main()
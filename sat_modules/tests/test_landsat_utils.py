@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from sat_modules import landsat_utils
+
+MTL = '''GROUP = L1_METADATA_FILE
+  GROUP = METADATA_FILE_INFO
+    LANDSAT_PRODUCT_ID = "LC08_L1TP_201032_20190101_20190130_01_T1"
+    PROCESSING_SOFTWARE_VERSION = "LPGS_13.1.0"
+  END_GROUP = METADATA_FILE_INFO
+  GROUP = PRODUCT_METADATA
+    DATE_ACQUIRED = 2019-01-01
+    SCENE_CENTER_TIME = "11:02:03.1234560Z"
+    WRS_PATH = 201
+    CORNER_UL_LAT_PRODUCT = 43.41372
+    CORNER_UL_LON_PRODUCT = -5.20150
+  END_GROUP = PRODUCT_METADATA
+  GROUP = IMAGE_ATTRIBUTES
+    CLOUD_COVER = 12.34
+    SUN_ELEVATION = 24.51
+    EARTH_SUN_DISTANCE = 0.9833
+  END_GROUP = IMAGE_ATTRIBUTES
+  GROUP = MIN_MAX_RADIANCE
+    RADIANCE_MAXIMUM_BAND_2 = 759.94
+    RADIANCE_MAXIMUM_BAND_4 = 638.45
+  END_GROUP = MIN_MAX_RADIANCE
+  GROUP = MIN_MAX_REFLECTANCE
+    REFLECTANCE_MAXIMUM_BAND_2 = 1.210700
+    REFLECTANCE_MAXIMUM_BAND_4 = 1.210700
+  END_GROUP = MIN_MAX_REFLECTANCE
+  GROUP = RADIOMETRIC_RESCALING
+    RADIANCE_MULT_BAND_2 = 1.2553E-02
+    RADIANCE_MULT_BAND_4 = 1.0546E-02
+    RADIANCE_MULT_BAND_10 = 3.3420E-04
+    RADIANCE_ADD_BAND_2 = -62.76593
+    RADIANCE_ADD_BAND_4 = -52.73072
+    RADIANCE_ADD_BAND_10 = 0.10000
+  END_GROUP = RADIOMETRIC_RESCALING
+  GROUP = TIRS_THERMAL_CONSTANTS
+    K1_CONSTANT_BAND_10 = 774.8853
+    K2_CONSTANT_BAND_10 = 1321.0789
+  END_GROUP = TIRS_THERMAL_CONSTANTS
+END_GROUP = L1_METADATA_FILE
+END
+'''
+
+
+
+def legacy_dos(metadata, band, arr, min_value=None):
+    """
+    Reference DOS1 correction of a single band, as done by the previous
+    per-band implementation in float64
+    """
+
+    name = 'BAND_{}'.format(band[1:])
+    rescaling = metadata['RADIOMETRIC_RESCALING']
+    Ml = float(rescaling['RADIANCE_MULT_{}'.format(name)])
+    Al = float(rescaling['RADIANCE_ADD_{}'.format(name)])
+    L = Ml * arr + Al
+
+    if band in ('B10', 'B11'):
+        k1 = float(metadata['TIRS_THERMAL_CONSTANTS']['K1_CONSTANT_{}'.format(name)])
+        k2 = float(metadata['TIRS_THERMAL_CONSTANTS']['K2_CONSTANT_{}'.format(name)])
+        return k2 / np.log((k1 / L) + 1)
+
+    rad_max = float(metadata['MIN_MAX_RADIANCE']['RADIANCE_MAXIMUM_{}'.format(name)])
+    ref_max = float(metadata['MIN_MAX_REFLECTANCE']['REFLECTANCE_MAXIMUM_{}'.format(name)])
+    d = float(metadata['IMAGE_ATTRIBUTES']['EARTH_SUN_DISTANCE'])
+    z = 90 - float(metadata['IMAGE_ATTRIBUTES']['SUN_ELEVATION'])
+    Esun = (np.pi * d**2) * rad_max / ref_max
+
+    # path radiance from the darkest pixel, 1% reflectance assumed (Tz = Tv = 1, Ed = 0)
+    if min_value is None:
+        min_value = np.nanmin(arr)
+    Lp = (Ml * min_value + Al) - 0.01 * Esun * np.cos(z * np.pi / 180.) / (np.pi * d**2)
+    sr = (np.pi * d**2 * (L - Lp)) / (Esun * np.cos(z * np.pi / 180.))
+    return np.clip(sr, 0, 1)
+
+
+class TestParseMTL(unittest.TestCase):
+
+    def setUp(self):
+        self.metadata = landsat_utils.parse_mtl(MTL.splitlines())['L1_METADATA_FILE']
+
+    def test_groups(self):
+        self.assertEqual(sorted(self.metadata), sorted(['METADATA_FILE_INFO', 'PRODUCT_METADATA', 'IMAGE_ATTRIBUTES',
+                                                        'MIN_MAX_RADIANCE', 'MIN_MAX_REFLECTANCE',
+                                                        'RADIOMETRIC_RESCALING', 'TIRS_THERMAL_CONSTANTS']))
+
+    def test_values(self):
+
+        info, product = self.metadata['METADATA_FILE_INFO'], self.metadata['PRODUCT_METADATA']
+        self.assertEqual(info['LANDSAT_PRODUCT_ID'], 'LC08_L1TP_201032_20190101_20190130_01_T1')
+        # quoted numbers are kept as strings, dates are not numbers
+        self.assertEqual(info['PROCESSING_SOFTWARE_VERSION'], 'LPGS_13.1.0')
+        self.assertEqual(product['DATE_ACQUIRED'], '2019-01-01')
+        self.assertEqual(product['SCENE_CENTER_TIME'], '11:02:03.1234560Z')
+        self.assertEqual(product['WRS_PATH'], 201)
+        self.assertIsInstance(product['WRS_PATH'], int)
+        self.assertEqual(product['CORNER_UL_LON_PRODUCT'], -5.2015)
+        self.assertEqual(self.metadata['RADIOMETRIC_RESCALING']['RADIANCE_MULT_BAND_2'], 1.2553e-02)
+
+
+class TestDOS(unittest.TestCase):
+
+    def setUp(self):
+        self.metadata = landsat_utils.parse_mtl(MTL.splitlines())['L1_METADATA_FILE']
+        rng = np.random.RandomState(0)
+        self.dn = rng.randint(5000, 30000, size=(3, 64, 48)).astype(np.float32)
+        self.dn[:, :4, :4] = np.nan
+
+    def legacy(self, band, arr, min_value=None):
+        return legacy_dos(self.metadata, band, arr.astype(np.float64), min_value)
+
+    def test_reflective_bands_match_the_legacy_correction(self):
+
+        bands = ['B2', 'B4']
+        stack = self.dn[:2].copy()
+        landsat_utils.DOS_stack(self.metadata, bands).correct_stack(stack)
+        for i, band in enumerate(bands):
+            np.testing.assert_allclose(stack[i], self.legacy(band, self.dn[i]), rtol=1e-4, atol=1e-5)
+        self.assertTrue(np.isnan(stack[:, :4, :4]).all())
+
+    def test_thermal_band_matches_the_legacy_correction(self):
+
+        bands = ['B2', 'B10']
+        stack = self.dn[1:].copy()
+        landsat_utils.DOS_stack(self.metadata, bands).correct_stack(stack)
+        np.testing.assert_allclose(stack[0], self.legacy('B2', self.dn[1]), rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(stack[1], self.legacy('B10', self.dn[2]), rtol=1e-5)
+
+    def test_windows_match_the_whole_band(self):
+        """
+        The block-wise mode corrects every window with the minimum of the whole band
+        """
+
+        dos = landsat_utils.DOS_stack(self.metadata, ['B4'])
+        whole = dos.correct(self.dn[0].copy(), 0)
+        min_value = np.nanmin(self.dn[0])
+        windows = [dos.correct(self.dn[0, y:y + 16].copy(), 0, min_value) for y in range(0, 64, 16)]
+        np.testing.assert_array_equal(np.concatenate(windows), whole)
+        np.testing.assert_allclose(whole, self.legacy('B4', self.dn[0], min_value), rtol=1e-4, atol=1e-5)
+
+
+
+class TestLoadBands(unittest.TestCase):
+
+    @mock.patch.object(landsat_utils, 'gdal')
+    def test_region_outside_of_the_scene_raises(self, gdal):
+        """
+        Nothing is written, so the caller does not record an empty output as processed
+        """
+
+        metadata = landsat_utils.parse_mtl(MTL.splitlines())['L1_METADATA_FILE']
+        for blockwise in (False, True):
+            l8 = landsat_utils.landsat('scene', 'output', blockwise=blockwise,
+                                       aoi={'W': 10., 'S': 10., 'E': 10.1, 'N': 10.1})
+            with mock.patch.object(l8, 'read_config_file', return_value=metadata), \
+                    mock.patch.object(l8, 'get_coordinates', return_value=False), \
+                    mock.patch.object(l8, 'create_writer') as create_writer:
+                with self.assertRaises(ValueError):
+                    l8.load_bands()
+                create_writer.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from sat_modules.manifest import manifest
+
+DATA = b'product' * 1000
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.archive = os.path.join(self.folder, 'product.zip')
+        with open(self.archive, 'wb') as f:
+            f.write(DATA)
+        self.manifest = manifest(os.path.join(self.folder, 'manifest.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_record(self):
+
+        md5 = hashlib.md5(DATA).hexdigest()
+        self.manifest.record(self.archive, md5, True)
+        entry = self.manifest.get(self.archive)
+        self.assertEqual((entry['size'], entry['md5'], entry['verified']), (len(DATA), md5, True))
+        # the entries are keyed by the name of the archive
+        with open(self.manifest.path) as f:
+            self.assertEqual(list(json.load(f)), ['product.zip'])
+        self.assertTrue(self.manifest.is_verified(self.archive))
+
+    def test_unchecked_archive_is_not_verified(self):
+
+        self.manifest.record(self.archive, hashlib.md5(DATA).hexdigest(), False)
+        self.assertFalse(self.manifest.is_verified(self.archive))
+
+    def test_changed_or_missing_archive_is_not_verified(self):
+
+        self.manifest.record(self.archive, hashlib.md5(DATA).hexdigest(), True)
+        with open(self.archive, 'ab') as f:
+            f.write(b'garbage')
+        self.assertFalse(self.manifest.is_verified(self.archive))
+        os.remove(self.archive)
+        self.assertFalse(self.manifest.is_verified(self.archive))
+
+    def test_remove(self):
+
+        self.manifest.record(self.archive, hashlib.md5(DATA).hexdigest(), True)
+        self.manifest.remove(self.archive)
+        self.assertIsNone(self.manifest.get(self.archive))
+        self.assertFalse(self.manifest.is_verified(self.archive))
+
+    def test_unreadable_manifest_is_empty(self):
+
+        with open(self.manifest.path, 'w') as f:
+            f.write('{not json')
+        self.assertIsNone(self.manifest.get(self.archive))
+
+
+if __name__ == '__main__':
+    unittest.main()
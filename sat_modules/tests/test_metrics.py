@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+from sat_modules import metrics
+
+
+class TestLog(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.level = metrics.logger.level
+        metrics.logger.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        metrics.configure(None)
+        metrics.logger.setLevel(self.level)
+        shutil.rmtree(self.folder)
+
+    def records(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_messages_are_recorded_with_the_stage(self):
+
+        path = os.path.join(self.folder, 'metrics.jsonl')
+        metrics.configure(path, format='jsonl')
+        with metrics.stage('fetch', provider='Sentinel2', scene='T30TUK'):
+            metrics.log('Downloading T30TUK ...')
+        metrics.error('Error in Sentinel2: timeout', job='Sentinel2')
+
+        events = [r for r in self.records(path) if 'message' in r]
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['level'], 'info')
+        self.assertEqual(events[0]['stage'], 'fetch')
+        self.assertEqual(events[0]['scene'], 'T30TUK')
+        self.assertEqual(events[1]['level'], 'error')
+        self.assertEqual(events[1]['job'], 'Sentinel2')
+        self.assertNotIn('stage', events[1])
+
+    def test_messages_are_counted_in_the_textfile(self):
+
+        path = os.path.join(self.folder, 'metrics.prom')
+        metrics.configure(path, format='prometheus')
+        metrics.log('Found 3 results')
+        metrics.error('Error in Landsat8: timeout')
+        metrics.error('Error in Sentinel2: timeout')
+        metrics.flush()
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('sat_log_messages_total{level="error"} 2', lines)
+        self.assertIn('sat_log_messages_total{level="info"} 1', lines)
+
+    def test_disabled_metrics_only_log(self):
+
+        with self.assertLogs('sat_modules', level='INFO') as logs:
+            metrics.log('Found 3 results')
+        self.assertEqual(logs.output, ['INFO:sat_modules:Found 3 results'])
+        self.assertFalse(os.listdir(self.folder))
+
+
+if __name__ == '__main__':
+    unittest.main()
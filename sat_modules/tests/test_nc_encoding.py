@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from netCDF4 import Dataset
+
+from sat_modules import nc_encoding
+
+
+class TestInt16Packing(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        # reflectances out of range, saturated L1C DN and NaN
+        self.arr = np.array([[0.1234, 3.5, 6.5535, -4.],
+                             [65535., np.nan, 3.2767, -3.2767]], dtype=np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def roundtrip(self, thermal=False):
+
+        datatype, kwargs, attrs = nc_encoding.variable_encoding('int16', self.arr.shape, thermal=thermal)
+        path = os.path.join(self.folder, 'band.nc')
+        with Dataset(path, 'w') as ds:
+            ds.createDimension('y', self.arr.shape[0])
+            ds.createDimension('x', self.arr.shape[1])
+            var = ds.createVariable('band', datatype, ('y', 'x'), **kwargs)
+            var.setncatts(attrs)
+            var[:] = nc_encoding.prepare(var, self.arr)
+        with Dataset(path) as ds:
+            var = ds.variables['band']
+            var.set_auto_scale(False)
+            raw = var[:].data
+            var.set_auto_scale(True)
+            return var[:], raw, datatype, kwargs, attrs
+
+    def test_out_of_range_values_are_clipped(self):
+
+        values, raw, datatype, kwargs, attrs = self.roundtrip()
+        np.testing.assert_array_equal(raw[0], [1234, 32767, 32767, -32767])
+        np.testing.assert_allclose(values[0], [0.1234, 3.2767, 3.2767, -3.2767], atol=1e-6)
+        self.assertEqual(raw[1, 0], 32767)
+        self.assertTrue(values.mask[1, 1])
+        self.assertEqual(raw[1, 1], -32768)
+
+    def test_thermal_values_are_clipped(self):
+
+        self.arr = np.array([[300., 700.], [0., np.nan]], dtype=np.float32)
+        values, raw, datatype, kwargs, attrs = self.roundtrip(thermal=True)
+        np.testing.assert_array_equal(raw[0], [2685, 32767])
+        np.testing.assert_allclose(values[:1].data, [[300., 32767 * 1e-2 + 273.15]], atol=1e-3)
+        self.assertEqual(raw[1, 0], -27315)
+
+    def test_netcdf_and_pack_store_the_same_values(self):
+
+        values, raw, datatype, kwargs, attrs = self.roundtrip()
+        packed = nc_encoding.pack(self.arr, datatype, attrs, fill_value=kwargs['fill_value'])
+        np.testing.assert_array_equal(raw, packed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+import unittest
+
+from sat_modules.pipeline import pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_items_go_through_the_stages_in_order(self):
+
+        done = []
+        stages = [('fetch', lambda item: dict(item, fetched=True), 1),
+                  ('process', lambda item: dict(item, processed=item['fetched']), 1),
+                  ('clean', lambda item: done.append(item), 1)]
+        pipeline(stages).run({'tile_id': i} for i in range(5))
+        self.assertEqual([item['tile_id'] for item in done], list(range(5)))
+        self.assertTrue(all(item['processed'] for item in done))
+
+    def test_a_failed_item_does_not_stop_the_others(self):
+
+        done, failed = [], []
+
+        def fetch(item):
+            if item['tile_id'] == 2:
+                raise IOError('broken archive')
+            return item
+
+        stages = [('fetch', fetch, 2), ('clean', lambda item: done.append(item['tile_id']), 1)]
+        pipeline(stages, on_error=failed.append).run({'tile_id': i} for i in range(5))
+        self.assertEqual(sorted(done), [0, 1, 3, 4])
+        self.assertEqual(failed, [{'tile_id': 2}])
+
+    def test_dropped_items_skip_the_next_stages(self):
+
+        done = []
+        stages = [('fetch', lambda item: None if item['tile_id'] % 2 else item, 1),
+                  ('clean', lambda item: done.append(item['tile_id']), 1)]
+        pipeline(stages).run({'tile_id': i} for i in range(4))
+        self.assertEqual(done, [0, 2])
+
+    def test_on_done_counts_every_stage(self):
+
+        counts = {}
+        lock = threading.Lock()
+
+        def on_done(stage):
+            with lock:
+                counts[stage] = counts.get(stage, 0) + 1
+
+        stages = [('fetch', lambda item: item, 3), ('process', lambda item: item, 1)]
+        pipeline(stages, on_done=on_done).run({'tile_id': i} for i in range(6))
+        self.assertEqual(counts, {'fetch': 6, 'process': 6})
+
+    def test_limits_are_shared(self):
+
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def process(item):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return item
+
+        limits = {'process': threading.Semaphore(1)}
+        threads = [threading.Thread(target=pipeline([('process', process, 2)], limits=limits).run,
+                                    args=(({'tile_id': i} for i in range(4)),)) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(peak[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sat_modules.scene_store import scene_store
+
+
+class TestSceneStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = scene_store(os.path.join(self.folder, 'store'), max_size=2500)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def add_product(self, product_id, size=1000):
+
+        path = self.store.product_path(product_id)
+        os.makedirs(path)
+        with open(os.path.join(path, 'band.tif'), 'wb') as f:
+            f.write(b'0' * size)
+        self.store.add(product_id, path)
+        return path
+
+    def test_least_recently_used_entries_are_evicted(self):
+
+        a, b = self.add_product('A'), self.add_product('B')
+        self.store.get(a)
+        c = self.add_product('C')
+        self.assertEqual([os.path.isdir(p) for p in (a, b, c)], [True, False, True])
+        self.assertEqual(self.store.size(), 2000)
+
+    def test_leased_products_are_kept(self):
+
+        a = self.add_product('A')
+        with self.store.lease('A'):
+            self.add_product('B')
+            self.add_product('C')
+            self.assertTrue(os.path.isdir(a))
+            self.assertIsNone(self.store.get(self.store.product_path('B')))
+        self.add_product('D')
+        self.assertFalse(os.path.isdir(a))
+
+    def test_linked_outputs_are_kept(self):
+
+        output = self.store.output_path('A', writer='netcdf')
+        os.makedirs(output)
+        with open(os.path.join(output, 'Bands_10.nc'), 'wb') as f:
+            f.write(b'0' * 1000)
+        self.store.add('A', output)
+        region_output = os.path.join(self.folder, 'region_A')
+        self.store.link(output, region_output)
+
+        self.add_product('B')
+        self.add_product('C')
+        self.assertTrue(os.path.isfile(os.path.join(region_output, 'Bands_10.nc')))
+        self.assertIsNone(self.store.get(self.store.product_path('B')))
+
+        # once the region output is removed the shared output can go
+        os.remove(region_output)
+        self.add_product('D')
+        self.assertFalse(os.path.isdir(output))
+
+    def test_output_path_depends_on_the_options(self):
+
+        self.assertEqual(self.store.output_path('A', writer='zarr', encoding='int16'),
+                         self.store.output_path('A', encoding='int16', writer='zarr'))
+        self.assertNotEqual(self.store.output_path('A', writer='zarr'), self.store.output_path('A', writer='cog'))
+
+    def test_locked_stage(self):
+
+        stage = self.store.locked(lambda scene: scene['tile_id'])
+        self.assertEqual(stage({'tile_id': 'A'}), 'A')
+        # the lock is released after the stage
+        with self.store.lock('A'):
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from sat_modules.search_cache import search_cache, footprint_intersects
+
+
+def ring(box):
+    return [(box['W'], box['S']), (box['E'], box['S']), (box['E'], box['N']), (box['W'], box['N'])]
+
+
+def footprint(r):
+    return r.get('polygons') or ([ring(r['box'])] if 'box' in r else None)
+
+
+def date(r):
+    return r.get('date')
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = search_cache(os.path.join(self.folder, 'search_cache.db'))
+        self.params = {'provider': 'Landsat', 'cloud': 20,
+                       'coordinates': {'W': 0., 'S': 0., 'E': 10., 'N': 10.},
+                       'inidate': '2019-01-01T00:00:00Z', 'enddate': '2019-12-31T00:00:00Z'}
+        self.results = [{'id': 'a', 'box': {'W': 1., 'S': 1., 'E': 2., 'N': 2.}, 'date': '2019-03-01'},
+                        {'id': 'b', 'box': {'W': 8., 'S': 8., 'E': 9., 'N': 9.}, 'date': '2019-03-05'},
+                        {'id': 'c', 'box': {'W': 1., 'S': 1., 'E': 2., 'N': 2.}, 'date': '2019-08-01'}]
+        self.cache.put(self.params, self.results)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def query(self, **params):
+        return dict(self.params, **params)
+
+    def ids(self, params, footprint=footprint, date=date):
+
+        def search():
+            raise AssertionError('the catalogue should not be searched')
+            yield
+        return [r['id'] for r in self.cache.iterate(params, search(), footprint=footprint, date=date)]
+
+    def test_exact_query(self):
+        self.assertEqual(self.cache.get(self.params), self.results)
+
+    def test_contained_query_is_filtered(self):
+
+        params = self.query(coordinates={'W': 0.5, 'S': 0.5, 'E': 3., 'N': 3.},
+                            inidate='2019-02-01T00:00:00Z', enddate='2019-04-01T00:00:00Z')
+        self.assertEqual([r['id'] for r in self.cache.get_containing(params, footprint, date)], ['a'])
+
+    def test_dates_are_inclusive(self):
+
+        params = self.query(inidate='2019-03-05T00:00:00Z', enddate='2019-08-01T00:00:00Z')
+        self.assertEqual([r['id'] for r in self.cache.get_containing(params, footprint, date)], ['b', 'c'])
+
+    def test_query_outside_of_the_cached_window(self):
+
+        self.assertIsNone(self.cache.get_containing(self.query(coordinates={'W': 5., 'S': 5., 'E': 11., 'N': 9.}),
+                                                    footprint, date))
+        self.assertIsNone(self.cache.get_containing(self.query(enddate='2020-01-31T00:00:00Z'), footprint, date))
+
+    def test_other_parameters_must_match(self):
+        self.assertIsNone(self.cache.get_containing(self.query(cloud=10, inidate='2019-02-01T00:00:00Z'),
+                                                    footprint, date))
+
+    def test_footprint_polygons_are_checked(self):
+
+        # a diagonal strip whose bounding box covers the query but not the strip itself
+        strip = {'id': 'd', 'date': '2019-03-01', 'polygons': [[(0., 1.), (1., 0.), (10., 9.), (9., 10.)]]}
+        self.cache.put(self.params, self.results + [strip])
+        inside = self.query(coordinates={'W': 4., 'S': 4.5, 'E': 5., 'N': 5.5}, inidate='2019-02-01T00:00:00Z')
+        outside = self.query(coordinates={'W': 7., 'S': 1., 'E': 9., 'N': 3.}, inidate='2019-02-01T00:00:00Z')
+        self.assertEqual([r['id'] for r in self.cache.get_containing(inside, footprint, date)], ['d'])
+        self.assertEqual([r['id'] for r in self.cache.get_containing(outside, footprint, date)], [])
+
+    def test_box_inside_of_a_footprint(self):
+
+        box = {'W': 4., 'S': 4., 'E': 5., 'N': 5.}
+        self.assertTrue(footprint_intersects([ring({'W': 0., 'S': 0., 'E': 10., 'N': 10.})], box))
+        self.assertFalse(footprint_intersects([ring({'W': 6., 'S': 0., 'E': 10., 'N': 10.})], box))
+
+    def test_connections_are_closed(self):
+
+        opened, connect = [], sqlite3.connect
+        with mock.patch.object(sqlite3, 'connect', lambda *args, **kwargs: opened.append(connect(*args, **kwargs))
+                               or opened[-1]):
+            self.cache.get(self.params)
+            self.cache.get_containing(self.query(inidate='2019-02-01T00:00:00Z'), footprint, date)
+            self.cache.put(self.query(cloud=10), self.results)
+        self.assertTrue(opened)
+        for db in opened:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                db.execute('SELECT 1')
+
+    def test_results_without_footprint_are_not_reused(self):
+
+        params = self.query(inidate='2019-02-01T00:00:00Z')
+        self.assertIsNone(self.cache.get_containing(params, lambda r: footprint(r) if r['id'] != 'b' else None, date))
+
+    def test_iterate_uses_the_containing_search(self):
+
+        params = self.query(coordinates={'W': 7., 'S': 7., 'E': 10., 'N': 10.}, inidate='2019-02-01T00:00:00Z')
+        self.assertEqual(self.ids(params), ['b'])
+
+    def test_iterate_stores_a_missed_search(self):
+
+        params = self.query(provider='Sentinel')
+        self.assertEqual([r['id'] for r in self.cache.iterate(params, iter(self.results[:1]))], ['a'])
+        self.assertEqual(self.cache.get(params), self.results[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
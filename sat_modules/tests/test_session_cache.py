@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from sat_modules.session_cache import session_cache, dump_cookies, load_cookies
+from sat_modules.download_landsat import download_landsat
+
+
+class fake_login:
+    """
+    ERS login form setting a session cookie for its domain
+    """
+
+    def __init__(self):
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.logins = 0
+
+    def get(self, url, **kwargs):
+        return requests.models.Response()
+
+    def post(self, url, data=None, **kwargs):
+        self.logins += 1
+        time.sleep(0.05)
+        self.cookies.set('EROS_SSO', 'token{}'.format(self.logins), domain='.usgs.gov', path='/')
+        response = requests.models.Response()
+        response.status_code = 302
+        return response
+
+
+class TestSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.sessions = session_cache(os.path.join(self.folder, '.sessions.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_cookies_keep_their_domain(self):
+
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set('EROS_SSO', 'token', domain='.usgs.gov', path='/', secure=True)
+        self.sessions.save('ers', 'user', dump_cookies(jar), ttl=3600)
+
+        restored = requests.cookies.RequestsCookieJar()
+        load_cookies(restored, self.sessions.load('ers', 'user'))
+        for url, sent in (('https://ers.cr.usgs.gov/login/', True), ('http://ers.cr.usgs.gov/login/', False),
+                          ('https://mirror.example.com/download', False)):
+            request = requests.Request('GET', url, cookies=restored).prepare()
+            self.assertEqual('EROS_SSO' in (request.headers.get('Cookie') or ''), sent, url)
+
+    def test_entries_expire_with_the_first_cookie(self):
+
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set('a', '1', domain='.usgs.gov', expires=int(time.time()) + 7200)
+        jar.set('b', '2', domain='.usgs.gov', expires=int(time.time()) - 10)
+        self.sessions.save('ers', 'user', dump_cookies(jar), ttl=8 * 3600)
+        self.assertIsNone(self.sessions.load('ers', 'user'))
+
+        # without an expiry date the ttl is used
+        jar.clear()
+        jar.set('a', '1', domain='.usgs.gov')
+        self.sessions.save('ers', 'user', dump_cookies(jar), ttl=3600)
+        self.assertIsNotNone(self.sessions.load('ers', 'user'))
+        self.sessions.save('ers', 'user', dump_cookies(jar), ttl=-1)
+        self.assertIsNone(self.sessions.load('ers', 'user'))
+
+    def test_rejected_workers_log_in_once(self):
+
+        l8 = download_landsat.__new__(download_landsat)
+        l8.credentials = {'username': 'user', 'password': 'password'}
+        l8.login_url = 'https://ers.cr.usgs.gov/login/'
+        l8.session = fake_login()
+        l8.sessions = self.sessions
+        l8.login_lock = threading.Lock()
+        l8.ers_cookies, l8.ers_generation = False, 0
+
+        l8.ers_login()
+        self.assertEqual(l8.session.logins, 1)
+
+        # the parallel downloads rejected by the same cookies
+        generation = l8.ers_generation
+        threads = [threading.Thread(target=l8.ers_login, kwargs={'force': True, 'generation': generation})
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(l8.session.logins, 2)
+        self.assertEqual(self.sessions.load('ers', 'user')[0]['value'], 'token2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import threading
+import unittest
+
+from sat_modules.pipeline import pipeline
+from sat_modules.download_sentinel import download_sentinel
+from sat_modules.download_landsat import download_landsat
+from sat_modules.supervisor import supervisor, cpu_budget
+
+
+class TestCPUBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = 0
+        self.overlap = False
+
+    def processor(self, provider, threads):
+
+        def process(item):
+            with self.lock:
+                self.running[provider] = threads
+                self.peak = max(self.peak, sum(self.running.values()))
+                self.overlap = self.overlap or len(self.running) > 1
+            time.sleep(0.02)
+            with self.lock:
+                del self.running[provider]
+            return item
+        return process
+
+    def run_providers(self, sup, providers):
+
+        def job(provider, threads):
+            stages = [('process', self.processor(provider, threads), 1)]
+            return lambda: pipeline(stages, limits=sup.limits(threads=threads)).run({'tile_id': i} for i in range(3))
+
+        return sup.run({provider: job(provider, threads) for provider, threads in providers.items()})
+
+    def test_band_threads_are_counted(self):
+
+        # 4 band threads and a single threaded provider do not fit in 4 CPUs
+        self.assertEqual(self.run_providers(supervisor(cpu=4), {'Landsat8': 4, 'Sentinel2': 1}), {})
+        self.assertLessEqual(self.peak, 4)
+        self.assertFalse(self.overlap)
+
+    def test_providers_run_together_within_the_budget(self):
+
+        self.run_providers(supervisor(cpu=4), {'Landsat8': 3, 'Sentinel2': 1})
+        self.assertTrue(self.overlap)
+        self.assertLessEqual(self.peak, 4)
+
+    def test_more_threads_than_cpus_do_not_block(self):
+
+        budget = cpu_budget(2)
+        with budget.take(8):
+            self.assertEqual(budget.free, 0)
+        self.assertEqual(budget.free, 2)
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_bandwidth_is_shared(self):
+
+        sup = supervisor(max_rate=100000)
+        t0 = time.time()
+        threads = [threading.Thread(target=lambda: [sup.throttle(10000) for _ in range(3)]) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 60000 bytes with a burst of 100000, then 10000 more wait 0.1 s
+        sup.throttle(50000)
+        self.assertGreaterEqual(time.time() - t0, 0.09)
+
+    def test_no_limit(self):
+
+        sup = supervisor()
+        t0 = time.time()
+        sup.throttle(10 ** 9)
+        self.assertLess(time.time() - t0, 0.05)
+
+    def test_providers_download_through_the_supervisor(self):
+
+        sup = supervisor(max_rate=100000)
+        for provider in (download_sentinel, download_landsat):
+            downloader = provider.__new__(provider)
+            downloader.supervisor = None
+            self.assertIsNone(downloader.throttle)
+            downloader.supervisor = sup
+            self.assertEqual(downloader.throttle, sup.throttle)
+
+
+if __name__ == '__main__':
+    unittest.main()
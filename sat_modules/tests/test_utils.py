@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import io
+import os
+import re
+import time
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+import requests
+
+from sat_modules import utils
+from sat_modules.supervisor import supervisor
+
+DATA = os.urandom(10000)
+
+
+class fake_response:
+
+    def __init__(self, status_code, body=b'', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+    def close(self):
+        pass
+
+
+class fake_session:
+    """
+    Server of DATA honouring the Range header
+    """
+
+    def __init__(self, honour_range=True, send_length=True, truncate=None, content_type='application/zip'):
+        self.honour_range = honour_range
+        self.send_length = send_length
+        self.truncate = truncate
+        self.content_type = content_type
+        self.requests = []
+
+    def get(self, url, stream=True, allow_redirects=True, headers=None, **kwargs):
+
+        headers = headers or {}
+        self.requests.append(headers)
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', headers.get('Range', ''))
+        if match and self.honour_range:
+            start = int(match.group(1))
+            if start >= len(DATA):
+                return fake_response(416)
+        body = DATA[start:self.truncate]
+        response_headers = {'Content-Type': self.content_type}
+        if self.send_length:
+            response_headers['Content-Length'] = str(len(DATA) - start)
+        if start:
+            response_headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(DATA) - 1, len(DATA))
+            return fake_response(206, body, response_headers)
+        return fake_response(200, body, response_headers)
+
+
+class TestDownloadFile(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'product.zip')
+        self.part = self.filename + '.part'
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def write_part(self, data):
+        with open(self.part, 'wb') as f:
+            f.write(data)
+
+    def test_download(self):
+
+        md5 = hashlib.md5()
+        filename, checked = utils.download_file(fake_session(), 'url', self.filename, chunk_size=1024, hasher=md5)
+        self.assertEqual((filename, checked), (self.filename, True))
+        self.assertEqual(self.read(), DATA)
+        self.assertEqual(md5.hexdigest(), hashlib.md5(DATA).hexdigest())
+        self.assertFalse(os.path.exists(self.part))
+
+    def test_resume_with_range(self):
+
+        self.write_part(DATA[:4000])
+        session, md5 = fake_session(), hashlib.md5()
+        filename, checked = utils.download_file(session, 'url', self.filename, chunk_size=1024, hasher=md5)
+        self.assertEqual(session.requests, [{'Range': 'bytes=4000-'}])
+        self.assertTrue(checked)
+        self.assertEqual(self.read(), DATA)
+        self.assertEqual(md5.hexdigest(), hashlib.md5(DATA).hexdigest())
+
+    def test_range_not_satisfiable_restarts(self):
+
+        self.write_part(DATA + b'garbage')
+        session = fake_session()
+        utils.download_file(session, 'url', self.filename, chunk_size=1024)
+        self.assertEqual(session.requests, [{'Range': 'bytes=10007-'}, {}])
+        self.assertEqual(self.read(), DATA)
+
+    def test_range_ignored_by_the_server(self):
+
+        self.write_part(b'x' * 4000)
+        utils.download_file(fake_session(honour_range=False), 'url', self.filename, chunk_size=1024)
+        self.assertEqual(self.read(), DATA)
+
+    def test_incomplete_download_is_kept_to_resume(self):
+
+        with self.assertRaises(IOError):
+            utils.download_file(fake_session(truncate=6000), 'url', self.filename, chunk_size=1024)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(os.path.getsize(self.part), 6000)
+
+        utils.download_file(fake_session(), 'url', self.filename, chunk_size=1024)
+        self.assertEqual(self.read(), DATA)
+
+    def test_size_not_announced(self):
+
+        filename, checked = utils.download_file(fake_session(send_length=False), 'url', self.filename)
+        self.assertFalse(checked)
+        self.assertEqual(self.read(), DATA)
+
+    def test_existing_file_is_not_downloaded(self):
+
+        with open(self.filename, 'wb') as f:
+            f.write(DATA)
+        session, md5 = fake_session(), hashlib.md5()
+        self.assertEqual(utils.download_file(session, 'url', self.filename, hasher=md5), (self.filename, False))
+        self.assertEqual(session.requests, [])
+        self.assertEqual(md5.hexdigest(), hashlib.md5(DATA).hexdigest())
+
+    def test_throttle_is_called_for_every_chunk(self):
+
+        sizes = []
+        utils.download_file(fake_session(), 'url', self.filename, chunk_size=4096, throttle=sizes.append)
+        self.assertEqual(sizes, [4096, 4096, 1808])
+
+    def test_download_waits_for_the_bandwidth_budget(self):
+
+        # the burst of the bucket is spent, the 10000 bytes wait 0.2 s at 50000 bytes per second
+        sup = supervisor(max_rate=50000)
+        sup.throttle(50000)
+        t0 = time.time()
+        utils.download_file(fake_session(), 'url', self.filename, chunk_size=1024, throttle=sup.throttle)
+        self.assertGreaterEqual(time.time() - t0, 0.18)
+        self.assertEqual(self.read(), DATA)
+
+    def test_login_page(self):
+
+        with self.assertRaises(utils.AuthenticationError):
+            utils.download_file(fake_session(content_type='text/html'), 'url', self.filename)
+
+
+class TestPaginate(unittest.TestCase):
+
+    def test_pages_are_chained(self):
+
+        pages = {1: ([1, 2], 3), 3: ([3, 4], 5), 5: ([5], None)}
+        self.assertEqual(list(utils.paginate(lambda start: pages[start], 1)), [1, 2, 3, 4, 5])
+
+
+
+class TestOpenCompressed(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def tarball(self, names):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = len(DATA)
+                tar.addfile(info, io.BytesIO(DATA))
+        return buf.getvalue()
+
+    def zipfile(self, names):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for name in names:
+                zf.writestr(name, DATA)
+        return buf.getvalue()
+
+    def test_members(self):
+
+        data = self.tarball(['scene/B1.TIF', 'scene/MTL.txt'])
+        self.assertEqual(utils.open_compressed(data, 'gz', self.folder, members=r'B1'),
+                         os.path.join(self.folder, 'scene/B1.TIF'))
+        self.assertEqual(os.listdir(os.path.join(self.folder, 'scene')), ['B1.TIF'])
+
+        data = self.zipfile(['product.SAFE/B1.jp2', 'product.SAFE/MTD.xml'])
+        self.assertEqual(utils.open_compressed(data, 'zip', self.folder), os.path.join(self.folder, 'product.SAFE'))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'product.SAFE'))), ['B1.jp2', 'MTD.xml'])
+
+    def test_nothing_to_extract(self):
+
+        path = os.path.join(self.folder, 'empty.tar.gz')
+        with open(path, 'wb') as f:
+            f.write(self.tarball([]))
+        for args in ((path, 'gz'), (self.tarball(['scene/MTL.txt']), 'gz'), (self.zipfile([]), 'zip'),
+                     (self.zipfile(['product.SAFE/MTD.xml']), 'zip')):
+            with self.assertRaises(ValueError) as e:
+                utils.open_compressed(*args, output_folder=self.folder, members=r'\.TIF$')
+            if args[0] == path:
+                self.assertIn(path, str(e.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
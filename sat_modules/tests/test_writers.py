@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from netCDF4 import Dataset
+
+from sat_modules import geo_utils
+from sat_modules import writers
+
+try:
+    from osgeo import gdal
+    gdal.VersionInfo()
+except ImportError:
+    gdal = None
+
+COORDINATES = {'geotransform': (500000., 30., 0, 4600000., 0, -30.), 'geoprojection': 'UTM',
+               'Xsize': 30, 'Ysize': 40}
+
+
+def read_netcdf(path, name):
+    with Dataset(path) as ds:
+        return ds.variables[name][:]
+
+
+def read_zarr(path, name):
+    # the packed values are decoded by the readers (eg. xarray) with the CF attributes
+    var = writers.zarr.open_group(path, mode='r')[name]
+    return var[:] * var.attrs.get('scale_factor', 1.) + var.attrs.get('add_offset', 0.)
+
+
+def read_cog(path, name):
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    arr = band.ReadAsArray().astype(np.float64)
+    return arr * (band.GetScale() or 1.) + (band.GetOffset() or 0.)
+
+
+@mock.patch.object(geo_utils, 'linear_units', lambda projection: 'm')
+@mock.patch.object(geo_utils, 'crs_attributes', lambda gt, projection: {'crs_wkt': projection})
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.values = np.random.RandomState(0).uniform(0, 1, (40, 30)).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def round_trip(self, writer, read):
+
+        for encoding in ('legacy', 'deflate', 'int16'):
+            path = os.path.join(self.folder, '{}_{}'.format(writer, encoding))
+            out = writers.open_writer(writer, path, 'test', COORDINATES, [('B4', False)], encoding=encoding)
+            try:
+                # two windows covering the raster, the second one written first
+                out.write('B4', self.values[25:], window=(0, 25, 30, 15))
+                out.write('B4', self.values[:25], window=(0, 0, 30, 25))
+            finally:
+                out.close()
+            np.testing.assert_allclose(read(path + out.extension, 'B4'), self.values, atol=1e-4,
+                                       err_msg='{} {}'.format(writer, encoding))
+
+    def test_netcdf(self):
+        self.round_trip('netcdf', read_netcdf)
+
+    def test_netcdf_writes_hold_the_shared_lock(self):
+
+        held = []
+
+        def try_lock():
+            if writers.nc_encoding.NETCDF_LOCK.acquire(blocking=False):
+                writers.nc_encoding.NETCDF_LOCK.release()
+                held.append(False)
+            else:
+                held.append(True)
+
+        def prepare(var, arr):
+            # another thread can not take the lock while a band is written
+            t = threading.Thread(target=try_lock)
+            t.start()
+            t.join()
+            return arr
+
+        path = os.path.join(self.folder, 'bands')
+        out = writers.open_writer('netcdf', path, 'test', COORDINATES, [('B{}'.format(i), False) for i in range(4)])
+        with mock.patch.object(writers.nc_encoding, 'prepare', prepare):
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(lambda i: out.write('B{}'.format(i), self.values), range(4)))
+        out.close()
+        self.assertEqual(held, [True] * 4)
+        np.testing.assert_allclose(read_netcdf(path + '.nc', 'B3'), self.values, atol=1e-4)
+
+    @unittest.skipIf(writers.zarr is None, 'zarr is not installed')
+    def test_zarr(self):
+        self.round_trip('zarr', read_zarr)
+
+    @unittest.skipIf(gdal is None, 'GDAL is not installed')
+    def test_cog(self):
+        self.round_trip('cog', read_cog)
+
+
+if __name__ == '__main__':
+    unittest.main()
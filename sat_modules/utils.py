@@ -23,17 +23,21 @@ Date: May 2018
 
 #Submodules
 from sat_modules import config
+from sat_modules import landsat_utils
+from sat_modules import metrics
 
 #APIs
 import zipfile, tarfile
 import argparse
 import os
-import json
 import datetime
 from six import string_types
-from functools import reduce
-import operator
 import io
+import requests
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 def valid_date(sd, ed):
     """
@@ -147,86 +151,283 @@ def unzip_zipfile(filename, tile_path):
     zip_ref.close()
     os.remove(filename)
 
-#Sub-functions of read_config_file
-def get_by_path(root, items):
+#Read the metadata file of Landsat
+def landsat_config_file(tile_path):
     """
-    Access a nested object in root by item sequence.
-    ref: https://stackoverflow.com/questions/14692690/access-nested-dictionary-items-via-a-list-of-keys
+    Read a LandSat MTL config file to a Python dict
     """
-    return reduce(operator.getitem, items, root)
 
-#Sub-functions of read_config_file
-def set_by_path(root, items, value):
+    with open(tile_path) as f:
+        config = landsat_utils.parse_mtl(f)
+    return config['L1_METADATA_FILE']
+
+
+class AuthenticationError(Exception):
     """
-    Set a value in a nested object in root by item sequence.
-    ref: https://stackoverflow.com/questions/14692690/access-nested-dictionary-items-via-a-list-of-keys
+    The server rejected the credentials or the session expired
     """
-    get_by_path(root, items[:-1])[items[-1]] = value
+    pass
 
 
-#Read the metadata file of Landsat
-def landsat_config_file(tile_path):
+def new_session(pool_size=10, retries=3):
     """
-    Read a LandSat MTL config file to a Python dict
+    Create a requests session whose connection pool is large enough for
+    the parallel downloads and the many short catalogue calls
+
+    Parameters
+    ----------
+    pool_size : int
+        Maximum number of connections kept open per host
+    retries : int
+        Number of retries of the failed connections
     """
 
-    f = open(tile_path)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
 
-    group_path = []
-    config = {}
+    return session
 
-    for line in f:
-        line = line.lstrip(' ').rstrip() #remove leading whitespaces and trainling newlines
 
-        if line.startswith('GROUP'):
-            group_name = line.split(' = ')[1]
-            group_path.append(group_name)
-            set_by_path(root=config, items=group_path, value={})
+def paginate(fetch_page, start, provider=None):
+    """
+    Iterate over the items of a paged API. The next page is requested in a
+    background thread while the items of the current one are consumed.
 
-        elif line.startswith('END_GROUP'):
-            del group_path[-1]
+    Parameters
+    ----------
+    fetch_page : callable
+        fetch_page(start) returns the list of items of the page and the start
+        of the next page (None for the last page)
+    start : start of the first page
+    provider : str
+        Label of the search metrics of every page (see metrics)
 
-        elif line.startswith('END'):
-            continue
+    Returns
+    -------
+    Generator over the items of all the pages
+    """
 
-        else:
-            key, value  = line.split(' = ')
-            try:
-                set_by_path(root=config, items=group_path + [key], value=json.loads(value))
-            except Exception:
-                set_by_path(root=config, items=group_path + [key], value=value)
-    f.close()
-    config = config['L1_METADATA_FILE']
-    return config
+    def measured_page(start):
+        with metrics.stage('search', provider=provider) as m:
+            items, next_start = fetch_page(start)
+            m.add(results=len(items))
+        return items, next_start
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(measured_page, start)
+        while future is not None:
+            items, start = future.result()
+            future = pool.submit(measured_page, start) if start is not None else None
+            for item in items:
+                yield item
+
+
+def folder_size(path):
+    """
+    Size in bytes of the files of a folder and its subfolders
+    """
+
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+
+def hash_file(filename, hasher, chunk_size=1024*1024):
+    """
+    Update a hashlib object with the content of a file
+    """
+
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
 
 
-def open_compressed(byte_stream, file_format, output_folder):
+def download_file(session, url, filename, chunk_size=1024*1024, throttle=None, hasher=None, **kwargs):
     """
-    Extract and save a stream of bytes of a compressed file from memory.
+    Stream the content of an url to disk in fixed size chunks, so the
+    product is never held whole in memory.
+
+    The bytes are written to `filename`.part, which is renamed to `filename`
+    once the size announced by the server has been received. If a partial
+    file is found from an interrupted download, only the missing bytes are
+    requested with an HTTP Range header.
+
     Parameters
     ----------
-    byte_stream : bytes
+    session : requests.Session
+    url : str
+    filename : str
+        Staging file where the content is written
+    chunk_size : int
+        Size in bytes of the chunks written to disk
+    throttle : callable
+        throttle(nbytes) is called for every chunk, eg. to share a bandwidth budget
+    hasher : hashlib object
+        Updated with the content of the file while it is downloaded, only
+        the bytes of a resumed partial file are read again from disk
+    kwargs : extra arguments for session.get (eg. auth)
+
+    Returns
+    -------
+    filename : str
+        Path of the downloaded file
+    checked : bool
+        The size of the file has been checked against the one announced by
+        the server. It is False when the server does not announce it (eg.
+        chunked or compressed responses) or the file was already downloaded.
+
+    Raises
+    ------
+    IOError
+        The downloaded size does not match the size announced by the server
+    AuthenticationError
+        The session is not authorized to download the file
+    """
+
+    if os.path.isfile(filename):
+        if hasher is not None:
+            hash_file(filename, hasher, chunk_size)
+        return filename, False
+
+    part = '{}.part'.format(filename)
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+
+    extra_headers = kwargs.pop('headers', {})
+    headers = dict(extra_headers)
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+
+    response = session.get(url, stream=True, allow_redirects=True, headers=headers, **kwargs)
+
+    if response.status_code == 416:
+        # the partial file can not be resumed, start from scratch
+        response.close()
+        os.remove(part)
+        return download_file(session, url, filename, chunk_size=chunk_size, throttle=throttle,
+                             hasher=hasher, headers=extra_headers, **kwargs)
+    if response.status_code in (401, 403) or response.headers.get('Content-Type', '').startswith('text/html'):
+        # the products are never html, this is the login page of the provider
+        response.close()
+        raise AuthenticationError('Not authorized to download {}'.format(url))
+    response.raise_for_status()
+
+    total = None
+    if response.status_code == 206:
+        content_range = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('Content-Range', ''))
+        if content_range is None or int(content_range.group(1)) != offset:
+            response.close()
+            os.remove(part)
+            return download_file(session, url, filename, chunk_size=chunk_size, throttle=throttle,
+                             hasher=hasher, headers=extra_headers, **kwargs)
+        if content_range.group(2) != '*':
+            total = int(content_range.group(2))
+        mode = 'ab'
+    else:
+        # the server ignored the Range header and sends the whole file
+        if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+            total = int(response.headers['Content-Length'])
+        mode = 'wb'
+
+    if offset and mode == 'ab':
+        metrics.log('Resuming {} from byte {}'.format(os.path.basename(filename), offset))
+        if hasher is not None:
+            hash_file(part, hasher, chunk_size)
+
+    with open(part, mode) as f:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            if throttle is not None:
+                throttle(len(chunk))
+    response.close()
+
+    size = os.path.getsize(part)
+    metrics.add(bytes_transferred=size - offset if mode == 'ab' else size)
+    if total is not None and size != total:
+        raise IOError('Incomplete download of {}: {} of {} bytes'.format(filename, size, total))
+
+    os.rename(part, filename)
+
+    return filename, total is not None
+
+
+def open_compressed(byte_stream, file_format, output_folder, chunk_size=1024*1024, members=None):
+    """
+    Extract and save a compressed file.
+    Parameters
+    ----------
+    byte_stream : bytes, str or file object
+        Content of the compressed file, path to the file or a readable
+        stream. Tarballs are extracted member by member, so a non seekable
+        stream (eg. the raw socket of an HTTP response) is never buffered.
+        Zip files need random access, non seekable streams are spooled to a
+        temporary file first.
     file_format : str
         Compatible file formats: tarballs, zip files
     output_folder : str
         Folder to extract the stream
+    chunk_size : int
+        Size in bytes of the chunks used to spool non seekable zip streams
+    members : str
+        Regular expression of the member names to extract. By default all
+        the members are extracted.
     Returns
     -------
-    Folder name of the extracted files.
+    Folder name of the extracted files. A ValueError is raised if the
+    archive has no members to extract.
     """
 
     tar_extensions = ['tar', 'bz2', 'tb2', 'tbz', 'tbz2', 'gz', 'tgz', 'lz', 'lzma', 'tlz', 'xz', 'txz', 'Z', 'tZ']
-    if file_format in tar_extensions:
-        tar = tarfile.open(mode="r:{}".format(file_format), fileobj=io.BytesIO(byte_stream))
-        tar.extractall(output_folder)
-        folder_name = tar.getnames()[0]
-        return os.path.join(output_folder, folder_name)
-
-    elif file_format == 'zip':
-        zf = zipfile.ZipFile(io.BytesIO(byte_stream))
-        zf.extractall(output_folder)
-        folder_name = zf.namelist()[0].split('/')[0]
-        return os.path.join(output_folder, folder_name)
+    if file_format not in tar_extensions and file_format != 'zip':
+        raise ValueError('Invalid file format for the compressed byte_stream')
 
+    close = False
+    if isinstance(byte_stream, bytes):
+        fileobj = io.BytesIO(byte_stream)
+    elif isinstance(byte_stream, string_types):
+        fileobj = open(byte_stream, 'rb')
+        close = True
     else:
-        raise ValueError('Invalid file format for the compressed byte_stream')
+        fileobj = byte_stream
+
+    seekable = getattr(fileobj, 'seekable', lambda: False)()
+    wanted = (lambda name: True) if members is None else re.compile(members).search
+    archive = byte_stream if isinstance(byte_stream, string_types) else 'the stream'
+
+    try:
+        if file_format in tar_extensions:
+            # the compression is detected from the stream itself
+            mode = 'r:*' if seekable else 'r|*'
+            folder_name, extracted = None, 0
+            with tarfile.open(mode=mode, fileobj=fileobj) as tar:
+                for member in tar:
+                    if folder_name is None:
+                        folder_name = member.name
+                    if wanted(member.name):
+                        tar.extract(member, output_folder)
+                        metrics.add(bytes_written=member.size, files=1)
+                        extracted += 1
+            if not extracted:
+                raise ValueError('No members to extract in {}'.format(archive))
+            return os.path.join(output_folder, folder_name)
+
+        else:
+            if not seekable:
+                spool = tempfile.TemporaryFile(dir=output_folder)
+                shutil.copyfileobj(fileobj, spool, chunk_size)
+                spool.seek(0)
+                fileobj, close = spool, True
+            with zipfile.ZipFile(fileobj) as zf:
+                extracted = [m for m in zf.infolist() if wanted(m.filename)]
+                if not extracted:
+                    raise ValueError('No members to extract in {}'.format(archive))
+                zf.extractall(output_folder, members=extracted)
+                folder_name = zf.namelist()[0].split('/')[0]
+            metrics.add(bytes_written=sum(m.file_size for m in extracted), files=len(extracted))
+            return os.path.join(output_folder, folder_name)
+
+    finally:
+        if close:
+            fileobj.close()
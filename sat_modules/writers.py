@@ -0,0 +1,280 @@
+"""
+Output backends of the Sentinel and Landsat bands
+
+Writers
+-------
+netcdf : one netCDF file per dataset (previous output)
+zarr : one chunked Zarr group per dataset, every band is an array and every
+    chunk a file, so windows of the bands can be read in parallel
+cog : one Cloud Optimized GeoTIFF per dataset with a band per variable.
+    The bands are written to a tiled GeoTIFF and converted to COG on close.
+datacube : the scene is appended as a time slice to the datacube of the
+    region (see datacube)
+
+All the writers take the bands window by window, carry the same variables,
+encoding profile (see nc_encoding) and CRS metadata, and are used as:
+
+    out = open_writer('zarr', path, description, coordinates, bands)
+    out.write(name, arr, window=(xoff, yoff, xsize, ysize))
+    out.close()
+"""
+
+#APIs
+import time
+import threading
+import numpy as np
+
+from osgeo import gdal
+from netCDF4 import Dataset
+
+from sat_modules import geo_utils
+from sat_modules import nc_encoding
+from sat_modules.datacube import datacube_writer
+
+try:
+    import zarr
+    import numcodecs
+except ImportError:
+    zarr = None
+
+#Chunks of the profiles without spatial chunks (the Zarr and COG outputs are always tiled)
+DEFAULT_CHUNKS = (512, 512)
+
+GDAL_TYPES = {'f4': gdal.GDT_Float32, 'f8': gdal.GDT_Float64, 'i2': gdal.GDT_Int16, 'i4': gdal.GDT_Int32}
+
+
+def window_slices(window):
+
+    if window is None:
+        return Ellipsis
+    xoff, yoff, xsize, ysize = window
+    return slice(yoff, yoff + ysize), slice(xoff, xoff + xsize)
+
+
+class netcdf_writer:
+
+    extension = '.nc'
+
+    def __init__(self, path, description, coordinates, bands, encoding='legacy', latlon=False, grid_cache=None):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the output without extension
+        description : str
+        coordinates : dict
+            geotransform, geoprojection, Xsize and Ysize of the output
+        bands : list
+            (name, thermal) of the variables
+        encoding : str or dict
+            Encoding profile of the bands (see nc_encoding.ENCODINGS)
+        latlon : bool
+            Add the 2D longitudes and latitudes of the pixels
+        grid_cache : str
+            Folder where the lat/lon grids are cached between scenes
+        """
+
+        shape = (coordinates['Ysize'], coordinates['Xsize'])
+
+        with nc_encoding.NETCDF_LOCK:
+            # create a file (Dataset object, also the root group).
+            self.dsout = Dataset(path + self.extension, 'w', format='NETCDF4')
+            self.dsout.description = description
+            self.dsout.history = 'Created {}'.format(time.ctime(time.time()))
+            self.dsout.source = 'netCDF4 python module'
+
+            # coordinates and grid mapping.
+            dims = geo_utils.write_coordinates(self.dsout, coordinates, latlon=latlon, grid_cache=grid_cache)
+
+            for name, thermal in bands:
+
+                datatype, kwargs, attrs = nc_encoding.variable_encoding(encoding, shape, thermal=thermal)
+                band = self.dsout.createVariable(name, datatype, dims, **kwargs)
+
+                band.setncatts(attrs)
+                band.standard_name = name
+                band.units = 'rad'
+                band.setncattr('grid_mapping', 'spatial_ref')
+                if latlon:
+                    band.coordinates = 'lat lon'
+
+    def write(self, name, arr, window=None):
+
+        with nc_encoding.NETCDF_LOCK:
+            var = self.dsout.variables[name]
+            var[window_slices(window)] = nc_encoding.prepare(var, arr)
+
+    def close(self):
+        with nc_encoding.NETCDF_LOCK:
+            self.dsout.close()
+
+
+class zarr_writer:
+
+    extension = '.zarr'
+
+    def __init__(self, path, description, coordinates, bands, encoding='legacy', latlon=False, grid_cache=None):
+        """
+        Same parameters as netcdf_writer. The arrays follow the xarray
+        conventions (_ARRAY_DIMENSIONS) and the metadata is consolidated on close.
+        """
+
+        if zarr is None:
+            raise ImportError('The zarr writer needs the zarr package (pip install "zarr>=3")')
+
+        gt, projection = coordinates['geotransform'], coordinates['geoprojection']
+        cols, rows = coordinates['Xsize'], coordinates['Ysize']
+
+        # Zarr format 2, the format of the xarray conventions (_ARRAY_DIMENSIONS) and of the numcodecs codecs
+        self.root = zarr.open_group(path + self.extension, mode='w', zarr_format=2)
+        self.root.attrs.update({'description': description,
+                                'history': 'Created {}'.format(time.ctime(time.time())),
+                                'source': 'zarr python module'})
+
+        # coordinates and grid mapping.
+        units = geo_utils.linear_units(projection)
+        x, y = geo_utils.projected_axes(gt, cols, rows)
+        for axis, values in (('x', x), ('y', y)):
+            var = self.root.create_array(axis, shape=values.shape, chunks=values.shape, dtype=values.dtype)
+            var[:] = values
+            var.attrs.update({'_ARRAY_DIMENSIONS': [axis],
+                              'standard_name': 'projection_{}_coordinate'.format(axis),
+                              'long_name': '{} coordinate of projection'.format(axis),
+                              'units': units,
+                              'axis': axis.upper()})
+
+        crs = self.root.create_array('spatial_ref', shape=(), dtype='i4')
+        crs.attrs.update(geo_utils.crs_attributes(gt, projection))
+        crs.attrs['_ARRAY_DIMENSIONS'] = []
+
+        if latlon:
+            chunks = tuple(min(c, s) for c, s in zip(DEFAULT_CHUNKS, (rows, cols)))
+            for name, units in (('lon', 'degrees_east'), ('lat', 'degrees_north')):
+                var = self.root.create_array(name, shape=(rows, cols), chunks=chunks, dtype='f4')
+                var.attrs.update({'_ARRAY_DIMENSIONS': ['y', 'x'],
+                                  'standard_name': {'lon': 'longitude', 'lat': 'latitude'}[name],
+                                  'units': units})
+            for r, lons, lats in geo_utils.lonlat_rows(gt, projection, cols, rows, cache_dir=grid_cache):
+                self.root['lon'][r:r + lons.shape[0]] = lons
+                self.root['lat'][r:r + lats.shape[0]] = lats
+
+        self.packing = {}
+        for name, thermal in bands:
+
+            datatype, kwargs, attrs = nc_encoding.variable_encoding(encoding, (rows, cols), thermal=thermal)
+            chunks = kwargs.get('chunksizes') or tuple(min(c, s) for c, s in zip(DEFAULT_CHUNKS, (rows, cols)))
+            compressor = numcodecs.Zlib(level=kwargs.get('complevel', 4)) if kwargs.get('zlib') else None
+            filters = [numcodecs.Shuffle(elementsize=np.dtype(datatype).itemsize)] if kwargs.get('shuffle') else None
+
+            band = self.root.create_array(name, shape=(rows, cols), chunks=chunks, dtype=datatype,
+                                          fill_value=kwargs['fill_value'], compressors=compressor, filters=filters)
+            band.attrs.update(attrs)
+            band.attrs.update({'_ARRAY_DIMENSIONS': ['y', 'x'],
+                               'standard_name': name,
+                               'units': 'rad',
+                               'grid_mapping': 'spatial_ref'})
+            if latlon:
+                band.attrs['coordinates'] = 'lat lon'
+
+            self.packing[name] = (datatype, attrs, kwargs['fill_value'], kwargs.get('least_significant_digit'))
+
+    def write(self, name, arr, window=None):
+
+        self.root[name][window_slices(window)] = nc_encoding.pack(arr, *self.packing[name])
+
+    def close(self):
+        zarr.consolidate_metadata(self.root.store)
+
+
+class cog_writer:
+
+    extension = '.tif'
+
+    def __init__(self, path, description, coordinates, bands, encoding='legacy', latlon=False, grid_cache=None):
+        """
+        Same parameters as netcdf_writer. The lat/lon grids are not written,
+        the readers compute them from the geotransform and projection.
+        """
+
+        cols, rows = coordinates['Xsize'], coordinates['Ysize']
+
+        self.path = path + self.extension
+        self.tmp_path = path + '.tmp' + self.extension
+
+        # a GDAL dataset is not thread safe, the band threads write one window at a time
+        self.lock = threading.Lock()
+
+        self.packing, self.index = {}, {}
+        for i, (name, thermal) in enumerate(bands):
+            datatype, kwargs, attrs = nc_encoding.variable_encoding(encoding, (rows, cols), thermal=thermal)
+            self.packing[name] = (datatype, attrs, kwargs['fill_value'], kwargs.get('least_significant_digit'))
+            self.index[name] = i + 1
+
+        # all the bands of a GeoTIFF have the same datatype and tiling
+        datatype, _, fill_value, _ = self.packing[bands[0][0]]
+        chunk = (kwargs.get('chunksizes') or DEFAULT_CHUNKS)[0]
+        self.blocksize = 16 * int(np.ceil(chunk / 16.))  # the tiles are multiple of 16
+        self.options = ['COMPRESS=DEFLATE', 'LEVEL={}'.format(kwargs.get('complevel', 6)),
+                        'PREDICTOR=YES'] if kwargs.get('zlib') else ['COMPRESS=NONE']
+
+        # the bands are written to an uncompressed tiled GeoTIFF, so the windows can be written in any order
+        self.ds = gdal.GetDriverByName('GTiff').Create(self.tmp_path, cols, rows, len(bands), GDAL_TYPES[datatype],
+                                                       ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
+                                                        'BIGTIFF=IF_SAFER'])
+        self.ds.SetGeoTransform(coordinates['geotransform'])
+        self.ds.SetProjection(coordinates['geoprojection'])
+        self.ds.SetMetadata({'description': description,
+                             'history': 'Created {}'.format(time.ctime(time.time())),
+                             'source': 'GDAL python module'})
+
+        for name, i in self.index.items():
+            band = self.ds.GetRasterBand(i)
+            band.SetDescription(name)
+            band.SetNoDataValue(float(fill_value))
+            band.SetMetadata({'standard_name': name, 'units': 'rad'})
+            attrs = self.packing[name][1]
+            if attrs:
+                band.SetScale(attrs['scale_factor'])
+                band.SetOffset(attrs['add_offset'])
+
+    def write(self, name, arr, window=None):
+
+        xoff, yoff = window[:2] if window else (0, 0)
+        packed = nc_encoding.pack(arr, *self.packing[name])
+        with self.lock:
+            self.ds.GetRasterBand(self.index[name]).WriteArray(packed, xoff, yoff)
+
+    def close(self):
+
+        try:
+            self.ds.FlushCache()
+            cog = gdal.GetDriverByName('COG').CreateCopy(self.path, self.ds, 0,
+                                                         self.options + ['BLOCKSIZE={}'.format(self.blocksize),
+                                                                         'BIGTIFF=IF_SAFER'])
+            if cog is None:
+                raise IOError('Unable to write {}'.format(self.path))
+            cog = None
+        finally:
+            self.ds = None
+            gdal.Unlink(self.tmp_path)
+
+
+WRITERS = {'netcdf': netcdf_writer, 'zarr': zarr_writer, 'cog': cog_writer, 'datacube': datacube_writer}
+
+
+def open_writer(writer, path, description, coordinates, bands, **kwargs):
+    """
+    Open the output of a dataset
+
+    Parameters
+    ----------
+    writer : str
+        Name of a writer of WRITERS
+    path : str
+        Path of the output without extension
+    Other parameters as netcdf_writer
+    """
+
+    if writer not in WRITERS:
+        raise ValueError('Unknown writer {}. The available writers are: {}'.format(writer, list(WRITERS)))
+    return WRITERS[writer](path, description, coordinates, bands, **kwargs)
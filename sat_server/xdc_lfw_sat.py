@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 import argparse
 import json
+import os
 
 from sat_modules import config
 from sat_modules import utils
 from sat_modules import download_sentinel
 from sat_modules import download_landsat
+from sat_modules import supervisor
+from sat_modules import metrics
+from sat_modules import scene_store
 
 parser = argparse.ArgumentParser(description='Gets data from satellite')
 
@@ -26,6 +30,16 @@ sd, ed = utils.valid_date(sat_args['start_date'], sat_args['end_date'])
 #configure the tree of datasets path
 utils.configuration_path(path, sat_args['region'])
 
+#timings and counters of the stages (JSON lines, or a Prometheus textfile for the .prom files)
+if sat_args.get('metrics'):
+    metrics.configure(sat_args['metrics'], format=sat_args.get('metrics_format'))
+
+#products and outputs shared by the regions, the least recently used are removed above store_max_gb
+store = None
+if sat_args.get('store'):
+    max_gb = sat_args.get('store_max_gb')
+    store = scene_store.scene_store(os.path.join(path, 'store'), max_size=max_gb * 1e9 if max_gb else None)
+
 if sat_args['sat_type'] == "Sentinel2":
 
     s2_credentials = config.sentinel_pass
@@ -39,7 +53,15 @@ if sat_args['sat_type'] == "Sentinel2":
                'cloud': sat_args['cloud'],
                'username': s2_credentials['username'],
                'password': s2_credentials['password'],
-               'path': path}
+               'path': path,
+               'workers': sat_args.get('sentinel_workers', 2),
+               'use_cache': sat_args.get('use_cache', True),
+               'extract': sat_args.get('extract', 'all'),
+               'crop': sat_args.get('crop', False),
+               'encoding': sat_args.get('encoding', 'legacy'),
+               'latlon': sat_args.get('latlon', False),
+               'writer': sat_args.get('writer', 'netcdf'),
+               'store': store}
 
     #download sentinel files
     s = download_sentinel.download_sentinel(**S2_args)
@@ -57,7 +79,17 @@ elif sat_args['sat_type'] == "Landsat8":
                'cloud': sat_args['cloud'],
                'username': l8_credentials['username'],
                'password': l8_credentials['password'],
-               'path': path}
+               'path': path,
+               'workers': sat_args.get('landsat_workers', 4),
+               'use_cache': sat_args.get('use_cache', True),
+               'extract': sat_args.get('extract', 'all'),
+               'crop': sat_args.get('crop', False),
+               'encoding': sat_args.get('encoding', 'legacy'),
+               'latlon': sat_args.get('latlon', False),
+               'writer': sat_args.get('writer', 'netcdf'),
+               'blockwise': sat_args.get('blockwise', False),
+               'band_workers': sat_args.get('band_workers', 1),
+               'store': store}
 
     #download landsat files
     l = download_landsat.download_landsat(**l8_args)
@@ -65,6 +97,11 @@ elif sat_args['sat_type'] == "Landsat8":
 
 elif sat_args['sat_type'] == 'All':
 
+    #both providers run at the same time sharing the CPU and bandwidth budget
+    sup = supervisor.supervisor(cpu=sat_args.get('cpu'),
+                                transfers=sat_args.get('transfers'),
+                                max_rate=sat_args.get('max_rate'))
+
     #ESA credentials
     s2_credentials = config.sentinel_pass
 
@@ -77,11 +114,16 @@ elif sat_args['sat_type'] == 'All':
                'cloud': sat_args['cloud'],
                'username': s2_credentials['username'],
                'password': s2_credentials['password'],
-               'path': path}
-
-    #download sentinel files
-    s = download_sentinel.download_sentinel(**S2_args)
-    s.download()
+               'path': path,
+               'workers': sat_args.get('sentinel_workers', 2),
+               'use_cache': sat_args.get('use_cache', True),
+               'extract': sat_args.get('extract', 'all'),
+               'crop': sat_args.get('crop', False),
+               'encoding': sat_args.get('encoding', 'legacy'),
+               'latlon': sat_args.get('latlon', False),
+               'writer': sat_args.get('writer', 'netcdf'),
+               'store': store,
+               'supervisor': sup}
 
     #NASA credentials
     l8_credentials = config.landsat_pass
@@ -94,8 +136,20 @@ elif sat_args['sat_type'] == 'All':
                'cloud': sat_args['cloud'],
                'username': l8_credentials['username'],
                'password': l8_credentials['password'],
-               'path': path}
-
-    #download landsat files
+               'path': path,
+               'workers': sat_args.get('landsat_workers', 4),
+               'use_cache': sat_args.get('use_cache', True),
+               'extract': sat_args.get('extract', 'all'),
+               'crop': sat_args.get('crop', False),
+               'encoding': sat_args.get('encoding', 'legacy'),
+               'latlon': sat_args.get('latlon', False),
+               'writer': sat_args.get('writer', 'netcdf'),
+               'blockwise': sat_args.get('blockwise', False),
+               'band_workers': sat_args.get('band_workers', 1),
+               'store': store,
+               'supervisor': sup}
+
+    #download sentinel and landsat files
+    s = download_sentinel.download_sentinel(**S2_args)
     l = download_landsat.download_landsat(**l8_args)
-    l.download()
+    sup.run({'Sentinel2': s.download, 'Landsat8': l.download})
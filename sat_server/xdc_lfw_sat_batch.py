@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+"""
+Download and process the scenes of many regions with a single search,
+download and processing of every product (see sat_modules.batch).
+
+sat_args is the JSON of xdc_lfw_sat.py with 'regions' (name and coordinates
+of every region) instead of 'region' and 'coordinates'. Example:
+
+    -sat_args '{"regions": {"CdP": {"W": -2.830, "S": 41.820, "E": -2.690, "N": 41.910}, ...},
+                "start_date": "2019-01-01", "end_date": "2019-02-01", "sat_type": "All", "cloud": 100}'
+"""
+import argparse
+import json
+import os
+
+from sat_modules import config
+from sat_modules import utils
+from sat_modules import download_sentinel
+from sat_modules import download_landsat
+from sat_modules import supervisor
+from sat_modules import metrics
+from sat_modules import scene_store
+from sat_modules import batch
+
+parser = argparse.ArgumentParser(description='Gets data from satellite for many regions')
+
+parser.add_argument("-sat_args", action="store",
+                    required=False, type=str)
+
+parser.add_argument('-path',
+                   help='output path',
+                   required=True)
+
+args = parser.parse_args()
+sat_args = json.loads(args.sat_args)
+path = args.path
+
+#Check the format date and if end_date > start_date
+sd, ed = utils.valid_date(sat_args['start_date'], sat_args['end_date'])
+
+#configure the tree of datasets path
+regions = sat_args['regions']
+for region in regions:
+    utils.configuration_path(path, region)
+
+#timings and counters of the stages (JSON lines, or a Prometheus textfile for the .prom files)
+if sat_args.get('metrics'):
+    metrics.configure(sat_args['metrics'], format=sat_args.get('metrics_format'))
+
+#the products are downloaded once for all the regions into the store
+max_gb = sat_args.get('store_max_gb')
+store = scene_store.scene_store(os.path.join(path, 'store'), max_size=max_gb * 1e9 if max_gb else None)
+
+#all the providers and regions share the CPU and bandwidth budget
+sup = supervisor.supervisor(cpu=sat_args.get('cpu'),
+                            transfers=sat_args.get('transfers'),
+                            max_rate=sat_args.get('max_rate'))
+
+providers = {}
+
+if sat_args['sat_type'] in ('Sentinel2', 'All'):
+
+    s2_credentials = config.sentinel_pass
+
+    S2_args = {'inidate': sd,
+               'enddate': ed,
+               'platform': 'Sentinel-2',
+               'producttype': 'S2MSI1C',
+               'cloud': sat_args['cloud'],
+               'username': s2_credentials['username'],
+               'password': s2_credentials['password'],
+               'path': path,
+               'workers': sat_args.get('sentinel_workers', 2),
+               'use_cache': sat_args.get('use_cache', True),
+               'extract': sat_args.get('extract', 'all'),
+               'crop': sat_args.get('crop', False),
+               'encoding': sat_args.get('encoding', 'legacy'),
+               'latlon': sat_args.get('latlon', False),
+               'writer': sat_args.get('writer', 'netcdf'),
+               'store': store,
+               'supervisor': sup}
+
+    providers['Sentinel2'] = lambda region, coordinates: download_sentinel.download_sentinel(
+        region=region, coordinates=coordinates, **S2_args)
+
+if sat_args['sat_type'] in ('Landsat8', 'All'):
+
+    l8_credentials = config.landsat_pass
+
+    l8_args = {'inidate': sd,
+               'enddate': ed,
+               'producttype': 'LANDSAT_8_C1',
+               'cloud': sat_args['cloud'],
+               'username': l8_credentials['username'],
+               'password': l8_credentials['password'],
+               'path': path,
+               'workers': sat_args.get('landsat_workers', 4),
+               'use_cache': sat_args.get('use_cache', True),
+               'extract': sat_args.get('extract', 'all'),
+               'crop': sat_args.get('crop', False),
+               'encoding': sat_args.get('encoding', 'legacy'),
+               'latlon': sat_args.get('latlon', False),
+               'writer': sat_args.get('writer', 'netcdf'),
+               'blockwise': sat_args.get('blockwise', False),
+               'band_workers': sat_args.get('band_workers', 1),
+               'store': store,
+               'supervisor': sup}
+
+    providers['Landsat8'] = lambda region, coordinates: download_landsat.download_landsat(
+        region=region, coordinates=coordinates, **l8_args)
+
+#one search per group of neighbouring regions, one download and processing per product
+batch.batch(regions, providers, store, supervisor=sup, max_waste=sat_args.get('max_waste', 0.5)).run()